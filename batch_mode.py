@@ -0,0 +1,220 @@
+"""
+Пакетный режим GigaChat (POST /batches) для ночной переиндексации.
+
+Запросы chat/completions собираются в JSONL (строка — {"id": ..., "request": {...}}),
+отправляются пакетными задачами, статус опрашивается через GET /batches?batch_id=...,
+результаты скачиваются через GET /files/{output_file_id}/content и сопоставляются
+с запросами по id. Задержка — минуты и часы, зато нет лимитов частоты на каждый запрос
+и ниже стоимость (пакетный режим доступен при оплате pay-as-you-go).
+
+Состояние отправленных задач хранится в JSON-файле (state_path): если прогон прервался
+во время ожидания, повторный запуск с тем же содержимым пакета не отправляет его заново,
+а продолжает опрашивать уже созданную задачу.
+"""
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from img_parse import (
+    GIGA_FILES_URL,
+    AccessToken,
+    _extract_content,
+    _update_token_stats,
+    get_client,
+)
+
+# эндпоинт GigaChat API для пакетных задач
+GIGA_BATCHES_URL = os.getenv(
+    "GIGA_CHAT_BATCHES_URL",
+    "https://gigachat.devices.sberbank.ru/api/v1/batches",
+)
+
+# Сколько запросов класть в одну пакетную задачу
+GIGA_BATCH_MAX_REQUESTS = int(os.getenv("GIGA_BATCH_MAX_REQUESTS", "1000"))
+# Интервал опроса статуса задач (секунды) и сколько всего ждать (часы)
+GIGA_BATCH_POLL_SECONDS = float(os.getenv("GIGA_BATCH_POLL_SECONDS", "30"))
+GIGA_BATCH_TIMEOUT_HOURS = float(os.getenv("GIGA_BATCH_TIMEOUT_HOURS", "24"))
+
+
+def build_batch_jsonl(requests_by_id: Dict[str, dict]) -> bytes:
+    """JSONL пакетной задачи: по строке на запрос chat/completions."""
+    lines = [
+        json.dumps({"id": request_id, "request": payload}, ensure_ascii=False, separators=(",", ":"))
+        for request_id, payload in requests_by_id.items()
+    ]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def submit_batch(jsonl: bytes, access_token: AccessToken) -> dict:
+    """Создать пакетную задачу (POST /batches?method=chat_completions)."""
+    resp = get_client().send(
+        "POST",
+        GIGA_BATCHES_URL,
+        access_token,
+        content_type="application/octet-stream",
+        params={"method": "chat_completions"},
+        data=jsonl,
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+
+def get_batch(batch_id: str, access_token: AccessToken) -> dict:
+    """Статус пакетной задачи (GET /batches?batch_id=...)."""
+    resp = get_client().send(
+        "GET",
+        GIGA_BATCHES_URL,
+        access_token,
+        content_type="application/json",
+        params={"batch_id": batch_id},
+    )
+    resp.raise_for_status()
+    for batch in resp.json().get("batches") or []:
+        if batch.get("id") == batch_id:
+            return batch
+    raise RuntimeError(f"GigaChat не вернул пакетную задачу {batch_id}")
+
+
+def download_batch_output(output_file_id: str, access_token: AccessToken) -> bytes:
+    """Файл результатов пакетной задачи (GET /files/{file_id}/content)."""
+    resp = get_client().send("GET", f"{GIGA_FILES_URL}/{output_file_id}/content", access_token)
+    resp.raise_for_status()
+    return resp.content
+
+
+def parse_batch_output(output: bytes) -> tuple[Dict[str, str], Dict[str, str]]:
+    """
+    Разбор JSONL результатов: ({id: текст ответа}, {id: текст ошибки}).
+    usage каждого ответа учитывается в общей статистике токенов.
+    """
+    answers: Dict[str, str] = {}
+    errors: Dict[str, str] = {}
+    for line in output.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        request_id = item.get("id")
+        result = item.get("result")
+        if isinstance(result, dict) and result.get("choices"):
+            _update_token_stats(result)
+            answers[request_id] = _extract_content(result)
+        else:
+            errors[request_id] = json.dumps(item.get("error") or result or item, ensure_ascii=False)
+    return answers, errors
+
+
+class BatchState:
+    """
+    Отправленные, но ещё не скачанные пакетные задачи: {sha256 JSONL: {batch_id, phase, ...}}.
+    Файл переписывается атомарно, как манифест пайплайна.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.data = {"batches": {}}
+        if self.path.exists():
+            self.data = json.loads(self.path.read_text(encoding="utf-8"))
+
+    def get(self, jsonl_hash: str) -> str | None:
+        entry = self.data["batches"].get(jsonl_hash)
+        return entry["batch_id"] if entry else None
+
+    def hashes(self, phase: str) -> List[str]:
+        return [key for key, entry in self.data["batches"].items() if entry.get("phase") == phase]
+
+    def put(self, jsonl_hash: str, batch_id: str, requests: int, phase: str) -> None:
+        self.data["batches"][jsonl_hash] = {
+            "batch_id": batch_id,
+            "phase": phase,
+            "requests": requests,
+            "submitted_at": time.time(),
+        }
+        self._save()
+
+    def remove(self, jsonl_hash: str) -> None:
+        self.data["batches"].pop(jsonl_hash, None)
+        self._save()
+
+    def _save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(self.data, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp_path, self.path)
+
+
+def run_chat_batches(
+    requests_by_id: Dict[str, dict],
+    access_token: AccessToken,
+    state_path: Path,
+    label: str = "",
+    max_requests: int = GIGA_BATCH_MAX_REQUESTS,
+    poll_seconds: float = GIGA_BATCH_POLL_SECONDS,
+    timeout_hours: float = GIGA_BATCH_TIMEOUT_HOURS,
+) -> Dict[str, str]:
+    """
+    Выполнить запросы chat/completions пакетными задачами и дождаться результатов.
+    label — название фазы для лога; по нему же задачи разных фаз различаются в state_path.
+    Возвращает {id запроса: текст ответа}; запросы с ошибкой и из задач, не завершившихся
+    за timeout_hours, в результат не попадают (незавершённые задачи остаются в state_path
+    и подхватываются следующим запуском).
+    """
+    if not requests_by_id:
+        return {}
+    state = BatchState(state_path)
+    # Порядок строк фиксирован: одинаковые запросы дают тот же JSONL и ту же задачу в state_path
+    ids = sorted(requests_by_id)
+
+    # Все части отправляем сразу, чтобы GigaChat обрабатывал их параллельно
+    pending: List[tuple[str, str]] = []
+    for start in range(0, len(ids), max(1, max_requests)):
+        chunk = {request_id: requests_by_id[request_id] for request_id in ids[start:start + max_requests]}
+        jsonl = build_batch_jsonl(chunk)
+        jsonl_hash = hashlib.sha256(jsonl).hexdigest()
+        batch_id = state.get(jsonl_hash)
+        if batch_id is not None:
+            print(f"Пакет{label}: задача {batch_id} уже отправлена ранее ({len(chunk)} запросов), ждём результат")
+        else:
+            batch_id = submit_batch(jsonl, access_token)["id"]
+            state.put(jsonl_hash, batch_id, len(chunk), label)
+            print(f"Пакет{label}: отправлена задача {batch_id} ({len(chunk)} запросов)")
+        pending.append((jsonl_hash, batch_id))
+
+    # Задачи этой фазы из прошлых запусков с другим содержимым (страницы изменились
+    # или ответы уже в кэше) больше не понадобятся
+    current = {jsonl_hash for jsonl_hash, _ in pending}
+    for jsonl_hash in state.hashes(label):
+        if jsonl_hash not in current:
+            print(f"Пакет{label}: задача {state.get(jsonl_hash)} прошлого запуска не соответствует запросам, забыта")
+            state.remove(jsonl_hash)
+
+    answers: Dict[str, str] = {}
+    deadline = time.monotonic() + timeout_hours * 3600
+    while pending:
+        still_pending = []
+        for jsonl_hash, batch_id in pending:
+            batch = get_batch(batch_id, access_token)
+            if batch.get("status") != "completed":
+                still_pending.append((jsonl_hash, batch_id))
+                continue
+            output_file_id = batch.get("output_file_id")
+            if not output_file_id:
+                raise RuntimeError(f"Пакетная задача {batch_id} завершена без output_file_id: {batch}")
+            batch_answers, batch_errors = parse_batch_output(download_batch_output(output_file_id, access_token))
+            answers.update(batch_answers)
+            for request_id, error in batch_errors.items():
+                print(f"Пакет{label}: запрос {request_id} завершился ошибкой: {error}")
+            state.remove(jsonl_hash)
+            print(f"Пакет{label}: задача {batch_id} готова, ответов: {len(batch_answers)}, ошибок: {len(batch_errors)}")
+        pending = still_pending
+        if pending:
+            if time.monotonic() >= deadline:
+                print(
+                    f"Пакет{label}: не дождались задач {', '.join(b for _, b in pending)}; "
+                    f"повторный запуск продолжит их ожидание ({state_path})"
+                )
+                break
+            time.sleep(poll_seconds)
+    return answers
@@ -0,0 +1,270 @@
+"""
+Структурированная выгрузка фрагментов для загрузки в RAG без разбора markdown.
+
+По каждому PDF, как только для него завершены этапы 3–4, пишется хранилище фрагментов
+out/<pdf>/chunks.jsonl (и out/<pdf>/chunks.parquet, если установлен pyarrow) — по строке
+на фрагмент:
+  - stage2 — фрагменты инструкции страницы page_XXX/instruction.txt (по разделам «#»);
+  - stage4 — смысловые строки instructions_incremental.md, страница — из тега
+    [SOURCE: page XXX] (сам тег из текста убирается).
+Поля: pdf, pdf_file, pdf_sha256, page, stage, seq, section, text, text_sha256, source_sha256
+(хэш файла, из которого взят фрагмент). Строки идут по страницам: сначала строки без
+страницы, затем для каждой страницы — stage2, stage4.
+
+Общий индекс out/chunks_index.json: для каждого PDF — файлы хранилища, число строк
+и смещения блоков страниц в chunks.jsonl ({"001": [offset, length, rows]}),
+чтобы читать одну страницу без просмотра файла (read_page_rows).
+"""
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # Parquet необязателен: без pyarrow пишется только JSONL
+    pa = None
+    pq = None
+
+from md_chunks import SOURCE_TAG_RE, split_markdown_chunks
+from pipeline_manifest import file_hash
+from response_cache import content_hash
+
+CHUNKS_JSONL = "chunks.jsonl"
+CHUNKS_PARQUET = "chunks.parquet"
+CHUNK_INDEX_NAME = "chunks_index.json"
+CHUNK_INDEX_VERSION = 1
+
+STAGE_PAGE = "stage2"
+STAGE_DOCUMENT = "stage4"
+
+# Ключ блока строк без страницы (заголовок документа и т.п.) в индексе
+NO_PAGE_KEY = "-"
+
+_HEADING_PREFIX = "#"
+
+if pa is not None:
+    PARQUET_SCHEMA = pa.schema(
+        [
+            ("pdf", pa.string()),
+            ("pdf_file", pa.string()),
+            ("pdf_sha256", pa.string()),
+            ("page", pa.int32()),
+            ("stage", pa.string()),
+            ("seq", pa.int32()),
+            ("section", pa.string()),
+            ("text", pa.string()),
+            ("text_sha256", pa.string()),
+            ("source_sha256", pa.string()),
+        ]
+    )
+
+
+def _page_rows(pdf_out_dir: Path, page_count: int | None = None) -> Iterator[tuple[int, List[dict]]]:
+    """
+    Фрагменты instruction.txt по страницам: (номер страницы, строки stage2).
+    page_count — число страниц PDF из манифеста: каталоги page_XXX с большим номером
+    остались от прежней версии PDF и не выгружаются.
+    """
+    page_dirs = sorted(p for p in pdf_out_dir.iterdir() if p.is_dir() and p.name.startswith("page_"))
+    for page_dir in page_dirs:
+        instr_path = page_dir / "instruction.txt"
+        if not instr_path.exists():
+            continue
+        page_num = int(page_dir.name.split("_", 1)[-1])
+        if page_count is not None and page_num > page_count:
+            continue
+        source_sha256 = file_hash(instr_path)
+        chunks = split_markdown_chunks(instr_path.read_text(encoding="utf-8"))
+        yield page_num, [
+            {
+                "page": page_num,
+                "stage": STAGE_PAGE,
+                "section": chunk.section,
+                "text": chunk.text,
+                "source_sha256": source_sha256,
+            }
+            for chunk in chunks
+        ]
+
+
+def _document_rows(incremental_path: Path) -> Dict[int | None, List[dict]]:
+    """Смысловые строки instructions_incremental.md по страницам тегов (None — строки без тега)."""
+    rows: Dict[int | None, List[dict]] = {}
+    if not incremental_path.exists():
+        return rows
+    source_sha256 = file_hash(incremental_path)
+    section = ""
+    for line in incremental_path.read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith(_HEADING_PREFIX) and not SOURCE_TAG_RE.search(line):
+            section = line.lstrip("#").strip()
+            continue
+        tag = SOURCE_TAG_RE.search(line)
+        text = SOURCE_TAG_RE.sub("", line).strip()
+        if not text:
+            continue
+        page = int(tag.group(1)) if tag else None
+        rows.setdefault(page, []).append(
+            {"page": page, "stage": STAGE_DOCUMENT, "section": section, "text": text, "source_sha256": source_sha256}
+        )
+    return rows
+
+
+class _ChunkStoreWriter:
+    """
+    Пишет хранилище одного PDF блоками по страницам во временные файлы;
+    close() заменяет ими прежние разом, как манифест пайплайна.
+    """
+
+    def __init__(self, pdf_out_dir: Path, pdf_info: dict, parquet: bool) -> None:
+        self.jsonl_path = pdf_out_dir / CHUNKS_JSONL
+        self.parquet_path = pdf_out_dir / CHUNKS_PARQUET
+        self._tmp_jsonl = self.jsonl_path.with_suffix(".jsonl.tmp")
+        self._tmp_parquet = self.parquet_path.with_suffix(".parquet.tmp")
+        self._common = {
+            "pdf": pdf_out_dir.name,
+            "pdf_file": pdf_info.get("name"),
+            "pdf_sha256": pdf_info.get("sha256"),
+        }
+        self._jsonl = open(self._tmp_jsonl, "wb")
+        self._parquet = pq.ParquetWriter(self._tmp_parquet, PARQUET_SCHEMA) if parquet and pa is not None else None
+        self.pages: Dict[str, List[int]] = {}
+        self.rows = 0
+
+    def write_block(self, page: int | None, rows: List[dict]) -> None:
+        if not rows:
+            return
+        full_rows = []
+        # seq — порядковый номер строки в пределах страницы и этапа
+        seqs: Dict[str, int] = {}
+        for row in rows:
+            seq = seqs.get(row["stage"], 0)
+            seqs[row["stage"]] = seq + 1
+            full_rows.append(
+                {
+                    **self._common,
+                    "page": row["page"],
+                    "stage": row["stage"],
+                    "seq": seq,
+                    "section": row["section"],
+                    "text": row["text"],
+                    "text_sha256": content_hash(row["text"].encode("utf-8")),
+                    "source_sha256": row["source_sha256"],
+                }
+            )
+        data = "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in full_rows).encode("utf-8")
+        offset = self._jsonl.tell()
+        self._jsonl.write(data)
+        key = NO_PAGE_KEY if page is None else f"{page:03d}"
+        self.pages[key] = [offset, len(data), len(full_rows)]
+        self.rows += len(full_rows)
+        if self._parquet is not None:
+            # Группа строк Parquet на страницу: читатель может выбрать страницы без чтения файла целиком
+            self._parquet.write_table(pa.Table.from_pylist(full_rows, schema=PARQUET_SCHEMA))
+
+    def abort(self) -> None:
+        """Прогон упал посередине: временные файлы удаляются, прежнее хранилище остаётся."""
+        self._jsonl.close()
+        self._tmp_jsonl.unlink(missing_ok=True)
+        if self._parquet is not None:
+            self._parquet.close()
+            self._tmp_parquet.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        self._jsonl.close()
+        os.replace(self._tmp_jsonl, self.jsonl_path)
+        if self._parquet is not None:
+            self._parquet.close()
+            os.replace(self._tmp_parquet, self.parquet_path)
+        elif self.parquet_path.exists():
+            # Устаревший Parquet прошлого прогона не должен расходиться с JSONL
+            self.parquet_path.unlink()
+
+
+def export_pdf_chunks(pdf_out_dir: Path, pdf_info: dict | None = None, parquet: bool = True) -> dict:
+    """
+    Записать хранилище фрагментов одного PDF (out/<pdf>/chunks.jsonl[, chunks.parquet]).
+    pdf_info — сведения об исходном PDF из манифеста (имя, sha256, число страниц).
+    Возвращает запись для общего индекса (см. update_chunk_index).
+    """
+    pdf_out_dir = Path(pdf_out_dir)
+    pdf_info = pdf_info or {}
+    document_rows = _document_rows(pdf_out_dir / "instructions_incremental.md")
+    writer = _ChunkStoreWriter(pdf_out_dir, pdf_info, parquet)
+    try:
+        writer.write_block(None, document_rows.pop(None, []))
+        for page_num, rows in _page_rows(pdf_out_dir, pdf_info.get("page_count")):
+            writer.write_block(page_num, rows + document_rows.pop(page_num, []))
+        # Теги страниц, для которых нет instruction.txt (модель ошиблась в номере)
+        for page_num in sorted(document_rows):
+            writer.write_block(page_num, document_rows[page_num])
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return {
+        "pdf_file": pdf_info.get("name"),
+        "pdf_sha256": pdf_info.get("sha256"),
+        "jsonl": f"{pdf_out_dir.name}/{CHUNKS_JSONL}",
+        "parquet": f"{pdf_out_dir.name}/{CHUNKS_PARQUET}" if writer.parquet_path.exists() else None,
+        "rows": writer.rows,
+        "pages": writer.pages,
+        "updated_at": time.time(),
+    }
+
+
+def _load_chunk_index(out_root: Path) -> dict:
+    path = Path(out_root) / CHUNK_INDEX_NAME
+    if path.exists():
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except ValueError:
+            data = None
+        if isinstance(data, dict) and data.get("version") == CHUNK_INDEX_VERSION:
+            data.setdefault("pdfs", {})
+            return data
+    return {"version": CHUNK_INDEX_VERSION, "pdfs": {}}
+
+
+def update_chunk_index(out_root: Path, pdf_name: str, entry: dict) -> Path:
+    """Записать в out/chunks_index.json запись PDF; PDF, чьих хранилищ больше нет, убрать."""
+    out_root = Path(out_root)
+    data = _load_chunk_index(out_root)
+    data["pdfs"][pdf_name] = entry
+    for name in list(data["pdfs"]):
+        if not (out_root / data["pdfs"][name]["jsonl"]).exists():
+            del data["pdfs"][name]
+    path = out_root / CHUNK_INDEX_NAME
+    tmp_path = path.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp_path, path)
+    return path
+
+
+def export_and_index(pdf_out_dir: Path, out_root: Path, pdf_info: dict | None = None, parquet: bool = True) -> dict:
+    """export_pdf_chunks + update_chunk_index: хранилище PDF и его запись в общем индексе."""
+    entry = export_pdf_chunks(pdf_out_dir, pdf_info, parquet)
+    update_chunk_index(out_root, Path(pdf_out_dir).name, entry)
+    return entry
+
+
+def read_page_rows(out_root: Path, pdf_name: str, page_num: int | None) -> List[dict]:
+    """Строки хранилища одной страницы PDF по смещению из индекса (None — строки без страницы)."""
+    out_root = Path(out_root)
+    entry = _load_chunk_index(out_root)["pdfs"].get(pdf_name)
+    if entry is None:
+        return []
+    block = entry["pages"].get(NO_PAGE_KEY if page_num is None else f"{page_num:03d}")
+    if block is None:
+        return []
+    offset, length, _ = block
+    with open(out_root / entry["jsonl"], "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    return [json.loads(line) for line in data.decode("utf-8").splitlines() if line.strip()]
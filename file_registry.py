@@ -0,0 +1,139 @@
+"""
+Реестр загруженных в хранилище GigaChat файлов (SQLite): хэш содержимого изображения -> file_id.
+
+Одно и то же изображение (страница при повторном прогоне, повтор после ошибки, одинаковые
+вырезанные области) загружается один раз, дальше переиспользуется его file_id.
+Перед прогоном реестр сверяется со списком файлов хранилища (GET /files): записи о файлах,
+которых там уже нет (удалены, истекли, другой ключ авторизации), отбрасываются.
+
+Реестр помнит все загруженные через него файлы, поэтому по нему же хранилище и очищается
+(POST /files/{file}/delete): в конце прогона (--cleanup-files) или по запросу:
+
+    python file_registry.py --registry-path out/.giga_files.sqlite
+"""
+import argparse
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, List
+
+
+class FileRegistry:
+    """
+    Таблица «file_id -> хэш содержимого». По одному хэшу может быть несколько файлов
+    (параллельные загрузки одного изображения) — все они попадут под очистку.
+    Одно соединение SQLite на процесс, доступ из потоков под блокировкой.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.reused = 0
+        self.uploaded = 0
+        # Переиспользуются только файлы, загруженные не раньше этого момента (см. trust_since)
+        self._trusted_since = 0.0
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " file_id TEXT PRIMARY KEY,"
+            " content_sha256 TEXT NOT NULL,"
+            " filename TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " uploaded_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS files_by_content ON files (content_sha256)")
+        self._conn.commit()
+
+    def get(self, content_sha256: str) -> str | None:
+        """file_id уже загруженного изображения с таким содержимым (последний по времени)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_id FROM files WHERE content_sha256 = ? AND uploaded_at >= ?"
+                " ORDER BY uploaded_at DESC LIMIT 1",
+                (content_sha256, self._trusted_since),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE files SET last_used = ? WHERE file_id = ?", (time.time(), row[0]))
+            self._conn.commit()
+            self.reused += 1
+            return row[0]
+
+    def put(self, content_sha256: str, file_id: str, filename: str, size: int) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files (file_id, content_sha256, filename, size, uploaded_at, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (file_id, content_sha256, filename, size, now, now),
+            )
+            self._conn.commit()
+            self.uploaded += 1
+
+    def forget(self, file_ids: Iterable[str]) -> None:
+        with self._lock:
+            self._conn.executemany("DELETE FROM files WHERE file_id = ?", [(fid,) for fid in file_ids])
+            self._conn.commit()
+
+    def file_ids(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT file_id FROM files ORDER BY uploaded_at")]
+
+    def trust_since(self, timestamp: float) -> None:
+        """
+        Не переиспользовать файлы, загруженные раньше timestamp (сверить реестр с хранилищем
+        не удалось). Записи о них остаются, чтобы файлы можно было удалить при очистке.
+        """
+        with self._lock:
+            self._trusted_since = timestamp
+
+    def sync(self, remote_file_ids: Iterable[str]) -> int:
+        """Оставить только файлы, которые есть в хранилище (GET /files). Возвращает число отброшенных."""
+        remote = set(remote_file_ids)
+        stale = [fid for fid in self.file_ids() if fid not in remote]
+        self.forget(stale)
+        return len(stale)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files"
+            ).fetchone()
+        return {"reused": self.reused, "uploaded": self.uploaded, "entries": entries, "bytes": size}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Очистка хранилища файлов GigaChat от изображений, загруженных пайплайном."
+    )
+    parser.add_argument(
+        "--registry-path",
+        type=str,
+        required=True,
+        help="Файл реестра загрузок (по умолчанию пайплайн пишет его в <out-dir>/.giga_files.sqlite).",
+    )
+    args = parser.parse_args()
+
+    # img_parse сам использует реестр, поэтому импортируется только здесь
+    from img_parse import TokenManager, cleanup_uploaded_files
+
+    registry = FileRegistry(Path(args.registry_path))
+    access_token = TokenManager()
+    try:
+        print(f"Файлов в реестре: {registry.stats()['entries']}")
+        print(f"Удалено из хранилища GigaChat: {cleanup_uploaded_files(registry, access_token)}")
+    finally:
+        registry.close()
+
+
+if __name__ == "__main__":
+    main()
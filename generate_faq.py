@@ -1,13 +1,23 @@
 import argparse
-import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Dict, List, Tuple
 
-from img_parse import get_creds, giga_free_answer, get_token_stats
-
-
-PAGE_HEADER_RE = re.compile(r"^##\s*Страница\s+(\d+)\s*$", re.MULTILINE)
-SOURCE_TAG_RE = re.compile(r"\[SOURCE:\s*page\s*(\d{1,3})\s*\]", re.IGNORECASE)
+from img_parse import (
+    GIGA_POOL_SIZE,
+    AccessToken,
+    TokenManager,
+    configure_client,
+    get_token_stats,
+    giga_free_answer,
+    giga_free_answer_stream,
+    set_response_cache,
+    stream_to_file,
+)
+from md_chunks import PAGE_HEADER_RE, SOURCE_TAG_RE, ContextSelector, split_markdown_chunks
+from response_cache import ResponseCache, content_hash
+from token_budget import PROCEED, SPLIT, TokenBudget
 
 
 def _split_by_page_headers(md: str) -> List[Tuple[int, str]]:
@@ -59,70 +69,247 @@ def _build_doc_context(md: str, max_chars: int = 8000) -> str:
     return md[:max_chars] + "\n\n[...ОБРЕЗАНО...]\n"
 
 
+FAQ_SYS_PROMPT = (
+    "Ты старший методолог и аналитик операционных процессов банка. "
+    "По тексту памятки по работе в АС составь FAQ для сотрудников.\n"
+    "Критично:\n"
+    "- НЕЛЬЗЯ придумывать функционал, кнопки, экраны или шаги, которых нет в тексте.\n"
+    "- Вопросы и ответы должны быть строго отвечаемыми по предоставленному тексту.\n"
+    "- Используй профессиональный сленг (АС, карточка, форма, поле, статус, маршрут, сверка, валидация и т.п.), "
+    "но не добавляй сущности, которых нет.\n"
+    "- В ответах будь подробным, но без домыслов: только то, что следует из текста.\n"
+    "- Формат ответа СТРОГО задан ниже, без лишних комментариев.\n"
+)
+
+# Ожидаемая длина ответа на страницу (3–5 пар вопрос/ответ) для планировщика бюджета токенов
+FAQ_COMPLETION_TOKENS = 2000
+
+
+def build_faq_question(
+    full_doc_context: str,
+    page_num: int,
+    page_text: str,
+    pamphlet_name: str,
+    relevant_context: str = "",
+) -> str:
+    """
+    Вопрос по странице. Общий контекст документа идёт первым (одинаковое начало промпта
+    у всех страниц), фрагменты, подобранные под страницу (relevant_context), — после него.
+    """
+    relevant_block = ""
+    if relevant_context:
+        relevant_block = (
+            "Ниже приведены фрагменты документа, связанные с этой страницей "
+            "(соседние страницы и похожие разделы):\n"
+            "----------------------------------------\n"
+            f"{relevant_context}\n"
+            "----------------------------------------\n\n"
+        )
+    return (
+        "Ниже приведён общий контекст документа (может быть обрезан):\n"
+        "----------------------------------------\n"
+        f"{full_doc_context}\n"
+        "----------------------------------------\n\n"
+        f"{relevant_block}"
+        f"Ниже приведён текст страницы №{page_num:03d}:\n"
+        "----------------------------------------\n"
+        f"{page_text}\n"
+        "----------------------------------------\n\n"
+        "Сгенерируй 3–5 максимально продуманных элементов FAQ по этой странице.\n"
+        "Требования:\n"
+        "- вопросы должны быть практическими (что делать/как проверить/какие условия/какие статусы/что означает и т.п.);\n"
+        "- вопросы не должны повторяться по смыслу;\n"
+        "- вопросы должны учитывать контекст документа, но опираться на факты из текста страницы;\n"
+        "- используй профессиональный сленг, соответствующий банковским АС;\n\n"
+        "Формат ВЫВОДА (строго, повторить блок 3–5 раз):\n\n"
+        "ВОПРОС: <текст вопроса>\n\n"
+        "ИНСТРУКЦИЯ: <подробный ответ>\n\n"
+        f'[SOURCE - "{pamphlet_name} - {page_num:03d}"]\n\n'
+        "Правила формата:\n"
+        "- после строки [SOURCE - \"...\"] сразу начинается следующий блок или конец ответа;\n"
+        "- никаких списков маркерами, никаких заголовков, никаких лишних строк до/после;\n"
+        "- в источнике всегда используй ровно этот шаблон и текущий номер страницы.\n"
+    )
+
+
+def _plan_faq_questions(
+    budget: TokenBudget,
+    full_doc_context: str,
+    page_num: int,
+    page_text: str,
+    pamphlet_name: str,
+    output_tokens: int,
+    relevant_context: str = "",
+) -> List[Tuple[str, int | None]]:
+    """
+    Вопросы по странице с проверкой размера до отправки: [(вопрос, max_tokens)].
+      - proceed: один вопрос как есть, max_tokens не больше оставшегося окна модели;
+      - compress: контекст сокращается до места, оставшегося после страницы и ответа, —
+        сначала фрагменты страницы, чтобы общий контекст документа остался общим началом;
+      - split: страница сама не помещается — FAQ строится по её частям.
+    """
+    expected = min(output_tokens, FAQ_COMPLETION_TOKENS)
+    question = build_faq_question(full_doc_context, page_num, page_text, pamphlet_name, relevant_context)
+    plan = budget.plan(
+        FAQ_SYS_PROMPT, question, expected, required_tokens=budget.count(page_text), max_tokens=output_tokens
+    )
+    if plan.action == PROCEED:
+        return [(question, plan.max_tokens)]
+
+    parts = [page_text]
+    if plan.action == SPLIT:
+        # На часть страницы — не больше половины окна, остальное под контекст документа
+        base = budget.prompt_tokens(FAQ_SYS_PROMPT, build_faq_question("", page_num, "", pamphlet_name))
+        part_limit = max(1, (budget.context_tokens - base - max(expected, budget.min_completion_tokens)) // 2)
+        parts = budget.split_text(page_text, part_limit)
+        if len(parts) > 1:
+            print(f"Страница {page_num:03d} не помещается в окно модели, FAQ строится по частям: {len(parts)}")
+
+    planned = []
+    for part in parts:
+        # Рамка раздела фрагментов тоже занимает место в промпте
+        frame = build_faq_question("", page_num, part, pamphlet_name, " " if relevant_context else "")
+        room = budget.room_for(FAQ_SYS_PROMPT, frame, expected)
+        head_tokens = budget.count(full_doc_context)
+        if head_tokens <= room:
+            head, relevant = full_doc_context, budget.fit_text(relevant_context, room - head_tokens)
+        else:
+            head, relevant = budget.fit_text(full_doc_context, room), ""
+        question = build_faq_question(head, page_num, part, pamphlet_name, relevant)
+        plan = budget.plan(FAQ_SYS_PROMPT, question, expected, max_tokens=output_tokens)
+        planned.append((question, plan.max_tokens))
+    return planned
+
+
+def _faq_session_id(pamphlet_name: str, full_doc_context: str) -> str:
+    """Один X-Session-ID на документ (одинаковый между запусками при том же контексте)."""
+    return "faq-" + content_hash(f"{pamphlet_name}\n{full_doc_context}".encode("utf-8"))[:32]
+
+
 def generate_faq_for_pages(
     pages: List[Tuple[int, str]],
     full_doc_context: str,
-    access_token: str,
+    access_token: AccessToken,
     pamphlet_name: str,
     output_tokens: int = 10000,
+    stream: bool = False,
+    progress_path: Path | None = None,
+    budget: TokenBudget | None = None,
+    workers: int = 1,
+    session_id: str | None = None,
+    context_selector: ContextSelector | None = None,
+    context_tokens: int = 4000,
 ) -> str:
     """
     Для каждой страницы генерируем 3–5 пар ВОПРОС/ИНСТРУКЦИЯ (FAQ).
     Возвращаем markdown.
-    """
-    sys_prompt = (
-        "Ты старший методолог и аналитик операционных процессов банка. "
-        "По тексту памятки по работе в АС составь FAQ для сотрудников.\n"
-        "Критично:\n"
-        "- НЕЛЬЗЯ придумывать функционал, кнопки, экраны или шаги, которых нет в тексте.\n"
-        "- Вопросы и ответы должны быть строго отвечаемыми по предоставленному тексту.\n"
-        "- Используй профессиональный сленг (АС, карточка, форма, поле, статус, маршрут, сверка, валидация и т.п.), "
-        "но не добавляй сущности, которых нет.\n"
-        "- В ответах будь подробным, но без домыслов: только то, что следует из текста.\n"
-        "- Формат ответа СТРОГО задан ниже, без лишних комментариев.\n"
-    )
-
-    out_chunks: List[str] = []
-
-    for page_num, page_text in pages:
-        if not page_text.strip():
-            continue
 
-        question = (
-            "Ниже приведён общий контекст документа (может быть обрезан):\n"
-            "----------------------------------------\n"
-            f"{full_doc_context}\n"
-            "----------------------------------------\n\n"
-            f"Ниже приведён текст страницы №{page_num:03d}:\n"
-            "----------------------------------------\n"
-            f"{page_text}\n"
-            "----------------------------------------\n\n"
-            "Сгенерируй 3–5 максимально продуманных элементов FAQ по этой странице.\n"
-            "Требования:\n"
-            "- вопросы должны быть практическими (что делать/как проверить/какие условия/какие статусы/что означает и т.п.);\n"
-            "- вопросы не должны повторяться по смыслу;\n"
-            "- вопросы должны учитывать контекст документа, но опираться на факты из текста страницы;\n"
-            "- используй профессиональный сленг, соответствующий банковским АС;\n\n"
-            "Формат ВЫВОДА (строго, повторить блок 3–5 раз):\n\n"
-            "ВОПРОС: <текст вопроса>\n\n"
-            "ИНСТРУКЦИЯ: <подробный ответ>\n\n"
-            f'[SOURCE - "{pamphlet_name} - {page_num:03d}"]\n\n'
-            "Правила формата:\n"
-            "- после строки [SOURCE - \"...\"] сразу начинается следующий блок или конец ответа;\n"
-            "- никаких списков маркерами, никаких заголовков, никаких лишних строк до/после;\n"
-            "- в источнике всегда используй ровно этот шаблон и текущий номер страницы.\n"
-        )
+    context_selector — к общему full_doc_context добавляются фрагменты, подобранные под
+    каждую страницу (соседние страницы и похожие фрагменты документа, не больше context_tokens).
 
-        faq = giga_free_answer(
-            question=question,
-            access_token=access_token,
-            sys_prompt=sys_prompt,
-            max_tokens=output_tokens,
-        ).strip()
+    Страницы обрабатываются параллельно, до workers запросов одновременно; порядок
+    страниц в результате сохраняется. Все запросы документа идут с одним X-Session-ID
+    (session_id, по умолчанию — по названию памятки и документу), а контекст стоит
+    в начале промпта сразу после системного промпта: одинаковый префикс GigaChat берёт
+    из кэша токенов (usage.precached_prompt_tokens). Первая страница отправляется
+    отдельно, чтобы префикс попал в кэш до параллельных запросов. Фрагменты context_selector
+    идут после общего контекста, поэтому префикс остаётся общим.
 
-        out_chunks.append(f"## FAQ — Страница {page_num:03d}\n\n{faq}\n")
+    stream=True: ответы приходят потоком (SSE) и по мере генерации пишутся в progress_path
+    (при workers=1 — уже готовые страницы + текущая, иначе каждая страница в свой файл
+    <progress_path>.NNN); после готовой страницы/документа файлы удаляются.
+    Время до первого токена печатается по каждой странице и в итоге.
 
-    return "\n\n".join(out_chunks).strip() + "\n"
+    budget (--token-budget): размер запроса проверяется в токенах до отправки
+    (см. _plan_faq_questions), max_tokens не выходит за окно модели.
+    """
+    if stream and progress_path is None:
+        raise ValueError("Для stream=True нужен progress_path")
+    workers = max(1, int(workers))
+    if session_id is None:
+        document = full_doc_context if context_selector is None else context_selector.document_hash
+        session_id = _faq_session_id(pamphlet_name, document)
+
+    pages = [(page_num, page_text) for page_num, page_text in pages if page_text.strip()]
+    # Готовые блоки по позиции страницы в pages
+    chunks: Dict[int, str] = {}
+    first_token_times: List[float] = []
+    lock = threading.Lock()
+
+    def faq_for_page(position: int, page_num: int, page_text: str) -> None:
+        relevant = "" if context_selector is None else context_selector.select(page_num, page_text, context_tokens)
+        if budget is None:
+            question = build_faq_question(full_doc_context, page_num, page_text, pamphlet_name, relevant)
+            planned = [(question, output_tokens)]
+        else:
+            planned = _plan_faq_questions(
+                budget, full_doc_context, page_num, page_text, pamphlet_name, output_tokens, relevant
+            )
+
+        header = f"## FAQ — Страница {page_num:03d}\n\n"
+        target = progress_path if workers == 1 else progress_path.with_name(f"{progress_path.name}.{page_num:03d}")
+        answers: List[str] = []
+        for question, max_tokens in planned:
+            if stream:
+                prefix = header + "".join(a + "\n\n" for a in answers)
+                if workers == 1:
+                    with lock:
+                        done = "\n\n".join(chunks[i] for i in sorted(chunks))
+                    prefix = (done + "\n\n" if done else "") + prefix
+                result = stream_to_file(
+                    giga_free_answer_stream(
+                        question,
+                        access_token,
+                        sys_prompt=FAQ_SYS_PROMPT,
+                        max_tokens=max_tokens,
+                        session_id=session_id,
+                    ),
+                    target,
+                    prefix=prefix,
+                )
+                answers.append(result.text.strip())
+                if result.first_token_s is not None:
+                    with lock:
+                        first_token_times.append(result.first_token_s)
+                    print(
+                        f"Страница {page_num:03d}: первый токен через {result.first_token_s:.1f} с, "
+                        f"ответ за {result.total_s:.1f} с"
+                    )
+            else:
+                answers.append(
+                    giga_free_answer(
+                        question=question,
+                        access_token=access_token,
+                        sys_prompt=FAQ_SYS_PROMPT,
+                        max_tokens=max_tokens,
+                        session_id=session_id,
+                    ).strip()
+                )
+        if stream and workers > 1:
+            target.unlink(missing_ok=True)
+        faq = "\n\n".join(answers)
+        with lock:
+            chunks[position] = f"{header}{faq}\n"
+
+    if pages:
+        faq_for_page(0, *pages[0])
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="faq") as pool:
+        futures = [
+            pool.submit(faq_for_page, position, page_num, page_text)
+            for position, (page_num, page_text) in enumerate(pages[1:], start=1)
+        ]
+        for future in as_completed(futures):
+            future.result()
+
+    if stream:
+        progress_path.unlink(missing_ok=True)
+        if first_token_times:
+            print(
+                f"Время до первого токена: среднее {sum(first_token_times) / len(first_token_times):.1f} с, "
+                f"максимум {max(first_token_times):.1f} с ({len(first_token_times)} ответов)"
+            )
+
+    return "\n\n".join(chunks[i] for i in sorted(chunks)).strip() + "\n"
 
 
 def main() -> None:
@@ -158,6 +345,65 @@ def main() -> None:
         help="Лимит output tokens (max_tokens) для одного ответа модели. По умолчанию 10000.",
     )
 
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help=(
+            "Сколько страниц обрабатывать параллельно. Запросы документа идут с одним X-Session-ID, "
+            "общий контекст GigaChat берёт из кэша токенов. По умолчанию 4."
+        ),
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help=(
+            "Получать ответы потоком (SSE): FAQ пишется в <out>.partial по мере генерации, "
+            "время до первого токена печатается по каждой странице."
+        ),
+    )
+
+    parser.add_argument(
+        "--token-budget",
+        action="store_true",
+        help=(
+            "Считать размер запросов в токенах (/tokens/count): контекст документа сокращается до "
+            "--context-tokens, страницы, не помещающиеся в окно модели, делятся на части."
+        ),
+    )
+    parser.add_argument(
+        "--context-mode",
+        choices=("relevant", "head"),
+        default="relevant",
+        help=(
+            "Контекст документа в промпте страницы: relevant — начало документа, общее для всех страниц, "
+            "и после него соседние страницы и лексически похожие фрагменты (по умолчанию); "
+            "head — только начало документа."
+        ),
+    )
+    parser.add_argument(
+        "--context-tokens",
+        type=int,
+        default=4000,
+        help=(
+            "Размер контекста документа в токенах (в режиме relevant половина — общее начало документа, "
+            "половина — фрагменты страницы). Без --token-budget токены оцениваются "
+            "по длине текста (~3 символа на токен). По умолчанию 4000."
+        ),
+    )
+
+    parser.add_argument(
+        "--cache-path",
+        type=str,
+        default="",
+        help="Файл кэша ответов GigaChat (SQLite). По умолчанию общий с пайплайном: <out>/.giga_cache.sqlite.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Не использовать кэш ответов.",
+    )
+
     args = parser.parse_args()
     in_path = Path(args.md)
     if not in_path.exists():
@@ -165,11 +411,18 @@ def main() -> None:
 
     md_text = in_path.read_text(encoding="utf-8")
 
-    # Авторизация
-    creds = get_creds()
-    access_token = creds.get("access_token")
-    if not access_token:
-        raise RuntimeError(f"Токен не получен от NGW. Ответ: {creds}")
+    # Кэш ответов: типовой путь к md — out/<pdf>/instructions_*.md, кэш пайплайна лежит в out/
+    if not args.no_cache:
+        cache_path = Path(args.cache_path) if args.cache_path else in_path.parent.parent / ".giga_cache.sqlite"
+        set_response_cache(ResponseCache(cache_path))
+
+    # Пул соединений не меньше числа параллельных запросов
+    configure_client(pool_size=max(GIGA_POOL_SIZE, args.workers))
+
+    # Авторизация: токен обновляется автоматически на длинных прогонах
+    access_token = TokenManager()
+    access_token.get_token()
+    budget = TokenBudget(access_token) if args.token_budget else None
 
     # Парсинг страниц: сначала пробуем формат с SOURCE-тегами, иначе — по заголовкам
     by_source = _group_lines_by_source_tags(md_text)
@@ -177,10 +430,23 @@ def main() -> None:
     if by_source:
         for page_num in sorted(by_source.keys()):
             pages.append((page_num, "\n".join(by_source[page_num])))
-        doc_context = _build_doc_context(md_text, max_chars=12000)
     else:
         pages = _split_by_page_headers(md_text)
-        doc_context = _build_doc_context(md_text, max_chars=12000)
+    context_selector = None
+    relevant_tokens = 0
+    if args.context_mode == "relevant":
+        # Общее начало документа + фрагменты под каждую страницу (по страницам и разделам)
+        chunks = split_markdown_chunks(md_text)
+        chunk_tokens = budget.count_many([chunk.text for chunk in chunks]) if budget is not None else None
+        head_tokens = args.context_tokens // 2
+        context_selector = ContextSelector(chunks, chunk_tokens, head_tokens=head_tokens)
+        doc_context = context_selector.head()
+        relevant_tokens = args.context_tokens - head_tokens
+    elif budget is not None:
+        # Контекст в настоящих токенах модели, а не в символах
+        doc_context = budget.fit_text(md_text.strip(), args.context_tokens)
+    else:
+        doc_context = _build_doc_context(md_text, max_chars=args.context_tokens * 3)
 
     if not pages:
         raise ValueError(
@@ -196,15 +462,21 @@ def main() -> None:
         parent_name = in_path.parent.name
         pamphlet_name = parent_name if parent_name else in_path.stem
 
+    out_path = Path(args.out) if args.out else in_path.with_name(f"{in_path.stem}_faq.md")
     faq_md = generate_faq_for_pages(
         pages=pages,
         full_doc_context=doc_context,
         access_token=access_token,
         pamphlet_name=pamphlet_name,
         output_tokens=args.output_tokens,
+        stream=args.stream,
+        progress_path=out_path.with_name(out_path.name + ".partial"),
+        budget=budget,
+        workers=args.workers,
+        context_selector=context_selector,
+        context_tokens=relevant_tokens,
     )
 
-    out_path = Path(args.out) if args.out else in_path.with_name(f"{in_path.stem}_faq.md")
     out_path.write_text(faq_md, encoding="utf-8")
     print(f"FAQ сохранён: {out_path}")
 
@@ -213,8 +485,11 @@ def main() -> None:
         "\nИТОГО по токенам в этом запуске (FAQ):\n"
         f"- prompt_tokens     = {stats.get('prompt_tokens', 0)}\n"
         f"- completion_tokens = {stats.get('completion_tokens', 0)}\n"
-        f"- total_tokens      = {stats.get('total_tokens', 0)}"
+        f"- total_tokens      = {stats.get('total_tokens', 0)}\n"
+        f"- precached_prompt_tokens = {stats.get('precached_prompt_tokens', 0)} (из кэша GigaChat)"
     )
+    if budget is not None:
+        print(f"Бюджет токенов, решения по запросам: {budget.summary()}")
 
 
 if __name__ == "__main__":
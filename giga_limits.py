@@ -0,0 +1,227 @@
+"""
+Повторы запросов и клиентское ограничение частоты для GigaChat.
+
+- RetryPolicy: экспоненциальная задержка с джиттером для 429/5xx и сетевых ошибок,
+  с учётом заголовка Retry-After (429 и 503);
+- RateLimiter: token bucket по каждой модели — запросов в секунду и токенов в минуту,
+  чтобы параллельные воркеры выбирали квоту, но не упирались в 429.
+
+Модуль не зависит от HTTP-библиотеки: клиенты (img_parse.GigaChatClient и
+img_parse_async.AsyncGigaChatClient) сами спят на вычисленное время
+(time.sleep или asyncio.sleep).
+"""
+import datetime
+import email.utils
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Tuple
+
+
+# ---------- Повторы ----------
+
+@dataclass
+class RetryPolicy:
+    """
+    max_attempts — сколько всего попыток (1 = без повторов);
+    base_delay   — задержка перед первым повтором, секунды (дальше растёт вдвое);
+    max_delay    — потолок задержки, в том числе для Retry-After.
+    """
+
+    max_attempts: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+    retry_statuses: frozenset = frozenset({429, 500, 502, 503, 504})
+    # Коды, для которых сервер может прислать Retry-After
+    retry_after_statuses: frozenset = frozenset({429, 503})
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        return cls(
+            max_attempts=max(1, int(os.getenv("GIGA_MAX_ATTEMPTS", "5"))),
+            base_delay=float(os.getenv("GIGA_RETRY_BASE_DELAY", "1.0")),
+            max_delay=float(os.getenv("GIGA_RETRY_MAX_DELAY", "60")),
+        )
+
+    def should_retry(self, status: int, attempt: int) -> bool:
+        """attempt — номер только что сделанной попытки, с нуля."""
+        return status in self.retry_statuses and attempt + 1 < self.max_attempts
+
+    def can_retry(self, attempt: int) -> bool:
+        return attempt + 1 < self.max_attempts
+
+    def delay(self, attempt: int, status: int | None = None, retry_after: str | None = None) -> float:
+        """
+        Пауза перед следующей попыткой.
+        Если сервер указал Retry-After (429/503) — ждём столько, сколько он просит;
+        иначе «full jitter»: случайное значение от 0 до base_delay * 2**attempt.
+        """
+        if status in self.retry_after_statuses:
+            server_delay = parse_retry_after(retry_after)
+            if server_delay is not None:
+                return min(server_delay, self.max_delay)
+        cap = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(0, cap)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After бывает числом секунд или HTTP-датой."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+# ---------- Ограничение частоты ----------
+
+class TokenBucket:
+    """
+    Классический token bucket: rate единиц в секунду, ёмкость capacity.
+    reserve() списывает единицы сразу (баланс может уйти в минус) и возвращает,
+    сколько секунд нужно подождать, — так ожидание можно выполнить и в потоке,
+    и в корутине, не держа блокировку.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill_locked(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float = 1.0) -> float:
+        with self._lock:
+            self._refill_locked()
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def adjust(self, delta: float) -> None:
+        """Вернуть (delta > 0) или дополнительно списать (delta < 0) единицы."""
+        with self._lock:
+            self._refill_locked()
+            self._tokens = min(self.capacity, self._tokens + delta)
+
+
+@dataclass
+class ModelLimit:
+    """Лимиты одной модели; 0 — без ограничения."""
+
+    rps: float = 0.0
+    tpm: float = 0.0
+
+
+@dataclass
+class RateLimiter:
+    """
+    Лимиты по моделям: запросов в секунду (rps) и токенов в минуту (tpm).
+    Для моделей без явной настройки действует default.
+
+    Токены заранее неизвестны, поэтому перед запросом списывается оценка
+    (estimate_tokens), а после ответа разница с фактическим usage.total_tokens
+    возвращается или доплачивается через settle().
+    """
+
+    default: ModelLimit = field(default_factory=ModelLimit)
+    per_model: Dict[str, ModelLimit] = field(default_factory=dict)
+    _buckets: Dict[str, Tuple[TokenBucket | None, TokenBucket | None]] = field(default_factory=dict, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        """
+        GIGA_RATE_LIMIT_RPS / GIGA_RATE_LIMIT_TPM — лимиты по умолчанию;
+        GIGA_RATE_LIMITS — лимиты по моделям в формате "модель=rps:tpm,модель=rps:tpm".
+        """
+        return cls(
+            default=ModelLimit(
+                rps=float(os.getenv("GIGA_RATE_LIMIT_RPS", "0")),
+                tpm=float(os.getenv("GIGA_RATE_LIMIT_TPM", "0")),
+            ),
+            per_model=parse_model_limits(os.getenv("GIGA_RATE_LIMITS", "")),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        limits = [self.default, *self.per_model.values()]
+        return any(limit.rps > 0 or limit.tpm > 0 for limit in limits)
+
+    def _buckets_for(self, model: str) -> Tuple[TokenBucket | None, TokenBucket | None]:
+        with self._lock:
+            buckets = self._buckets.get(model)
+            if buckets is None:
+                limit = self.per_model.get(model, self.default)
+                rps_bucket = TokenBucket(limit.rps, capacity=max(1.0, limit.rps)) if limit.rps > 0 else None
+                tpm_bucket = TokenBucket(limit.tpm / 60.0, capacity=limit.tpm) if limit.tpm > 0 else None
+                buckets = (rps_bucket, tpm_bucket)
+                self._buckets[model] = buckets
+            return buckets
+
+    def reserve(self, model: str, estimated_tokens: int = 0) -> float:
+        """Списать один запрос и оценку токенов; вернуть время ожидания в секундах."""
+        rps_bucket, tpm_bucket = self._buckets_for(model)
+        wait = 0.0
+        if rps_bucket is not None:
+            wait = max(wait, rps_bucket.reserve(1.0))
+        if tpm_bucket is not None and estimated_tokens > 0:
+            wait = max(wait, tpm_bucket.reserve(float(estimated_tokens)))
+        return wait
+
+    def settle(self, model: str, estimated_tokens: int, actual_tokens: int | None) -> None:
+        """Скорректировать бюджет токенов по фактическому usage."""
+        if actual_tokens is None:
+            return
+        _, tpm_bucket = self._buckets_for(model)
+        if tpm_bucket is not None:
+            tpm_bucket.adjust(float(estimated_tokens - actual_tokens))
+
+
+def parse_model_limits(spec: str) -> Dict[str, ModelLimit]:
+    """'GigaChat-2-Pro=5:100000,GigaChat-2-Max=2:50000' -> {модель: ModelLimit}."""
+    limits: Dict[str, ModelLimit] = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        model, _, values = item.partition("=")
+        rps, _, tpm = values.partition(":")
+        try:
+            limits[model.strip()] = ModelLimit(rps=float(rps or 0), tpm=float(tpm or 0))
+        except ValueError as e:
+            raise ValueError(f"Некорректный лимит в GIGA_RATE_LIMITS: {item!r}") from e
+    return limits
+
+
+def estimate_tokens(payload: dict | None) -> Tuple[str | None, int]:
+    """
+    Модель и грубая оценка токенов запроса chat/completions до отправки:
+    ~3 символа на токен для промпта плюс max_tokens ответа (если задан).
+    Для запросов без поля model возвращаем (None, 0) — они не лимитируются.
+    """
+    if not isinstance(payload, dict) or not payload.get("model"):
+        return None, 0
+    chars = 0
+    for message in payload.get("messages") or []:
+        content = message.get("content") if isinstance(message, dict) else None
+        if isinstance(content, str):
+            chars += len(content)
+    completion = payload.get("max_tokens")
+    return payload["model"], chars // 3 + (completion if isinstance(completion, int) else 0)
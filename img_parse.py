@@ -4,10 +4,22 @@ import json
 import datetime
 import base64
 import io
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Union
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from dotenv import load_dotenv
 
+from giga_limits import RateLimiter, RetryPolicy, estimate_tokens
+from file_registry import FileRegistry
+from response_cache import ResponseCache, cache_key, content_hash
+from run_metrics import CallTimer, record_usage
+
 load_dotenv()
 
 # ---------- Настройки ----------
@@ -34,6 +46,17 @@ GIGA_FILES_URL = os.getenv(
     "https://gigachat.devices.sberbank.ru/api/v1/files",
 )
 
+# За сколько секунд до expires_at обновлять access_token заранее
+GIGA_TOKEN_REFRESH_MARGIN = float(os.getenv("GIGA_TOKEN_REFRESH_MARGIN", "120"))
+
+# Пул keep-alive соединений и таймауты HTTP (секунды)
+GIGA_POOL_SIZE = int(os.getenv("GIGA_POOL_SIZE", "10"))
+GIGA_CONNECT_TIMEOUT = float(os.getenv("GIGA_CONNECT_TIMEOUT", "10"))
+GIGA_READ_TIMEOUT = float(os.getenv("GIGA_READ_TIMEOUT", "120"))
+
+# Лимит GigaChat на одно изображение в запросе (api.yml, POST /files)
+MAX_IMAGE_BYTES = 15 * 1024 * 1024
+
 # Модели для текста и мультимодальных запросов
 TEXT_MODEL = os.getenv("GIGA_TEXT_MODEL", "GigaChat-2-Pro")
 VISION_MODEL = os.getenv("GIGA_VISION_MODEL", "GigaChat-2-Pro")
@@ -49,11 +72,15 @@ SYS_PROMPT = (
 	"- если на странице приведен скриншот элемента интерфейса АС, не приводи дословное содержание, опиши смысл иллюстрации в рамках текущей инструкции"
 )
 
-# Глобальная статистика по токенам за время работы процесса
+# Глобальная статистика по токенам за время работы процесса.
+# Обновляется из нескольких потоков (параллельный этап 2), поэтому под блокировкой.
+_TOKEN_STATS_LOCK = threading.Lock()
 TOKEN_STATS = {
     "prompt_tokens": 0,
     "completion_tokens": 0,
     "total_tokens": 0,
+    # Токены промпта, взятые из кэша на стороне GigaChat (общий префикс запросов одной сессии)
+    "precached_prompt_tokens": 0,
 }
 
 
@@ -62,15 +89,272 @@ def _update_token_stats(data: dict) -> None:
     usage = data.get("usage")
     if not isinstance(usage, dict):
         return
-    for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
-        value = usage.get(key)
-        if isinstance(value, int):
-            TOKEN_STATS[key] += value
+    with _TOKEN_STATS_LOCK:
+        for key in ("prompt_tokens", "completion_tokens", "total_tokens", "precached_prompt_tokens"):
+            value = usage.get(key)
+            if isinstance(value, int):
+                TOKEN_STATS[key] += value
+    record_usage(usage)
 
 
 def get_token_stats() -> dict:
     """Вернуть копию статистики токенов."""
-    return dict(TOKEN_STATS)
+    with _TOKEN_STATS_LOCK:
+        return dict(TOKEN_STATS)
+
+
+# ---------- HTTP-клиент ----------
+
+class GigaChatClient:
+    """
+    HTTP-клиент GigaChat с общим пулом keep-alive соединений.
+    Все запросы к NGW и GigaChat идут через одну requests.Session,
+    поэтому TCP+TLS рукопожатие выполняется один раз на соединение пула,
+    а не на каждый запрос.
+    Запросы через send() дополнительно повторяются при 429/5xx и сетевых ошибках
+    (retry_policy) и проходят через клиентский лимитер частоты (rate_limiter).
+    """
+
+    def __init__(
+        self,
+        pool_size: int = GIGA_POOL_SIZE,
+        connect_timeout: float = GIGA_CONNECT_TIMEOUT,
+        read_timeout: float = GIGA_READ_TIMEOUT,
+        verify: bool = False,
+        retry_policy: RetryPolicy | None = None,
+        rate_limiter: RateLimiter | None = None,
+    ) -> None:
+        self.pool_size = max(1, int(pool_size))
+        self.timeout = (connect_timeout, read_timeout)
+        self.verify = verify
+        self.retry_policy = retry_policy or RetryPolicy.from_env()
+        self.rate_limiter = rate_limiter or RateLimiter.from_env()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs.setdefault("verify", self.verify)
+        return self.session.request(method, url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def send(
+        self,
+        method: str,
+        url: str,
+        access_token: "AccessToken | None" = None,
+        content_type: str | None = None,
+        headers: dict | None = None,
+        **kwargs,
+    ) -> requests.Response:
+        """
+        Запрос к GigaChat/NGW с повторами и ограничением частоты.
+        - access_token (строка или TokenManager) добавляет заголовок Authorization;
+          при HTTP 401 и TokenManager токен один раз обновляется и запрос повторяется;
+        - 429/5xx и сетевые ошибки повторяются по retry_policy (с учётом Retry-After);
+        - запросы с json-телом, где указана модель, учитываются в rate_limiter.
+        Возвращается последний ответ: если повторы исчерпаны, код ошибки проверяет вызывающий.
+        """
+        model, estimated = estimate_tokens(kwargs.get("json"))
+        token = resolve_token(access_token) if access_token is not None else None
+        token_refreshed = False
+        attempt = 0
+        call = CallTimer(url, model)
+        reserved = False
+
+        while True:
+            if model:
+                # Токены резервируются один раз на вызов: повтор занимает только слот запроса
+                wait = self.rate_limiter.reserve(model, 0 if reserved else estimated)
+                reserved = True
+                if wait > 0:
+                    time.sleep(wait)
+                    call.queue_wait_s += wait
+
+            request_headers = dict(headers or {})
+            if token is not None:
+                request_headers.update(_auth_headers(token, content_type))
+            started = time.monotonic()
+            try:
+                resp = self.request(method, url, headers=request_headers, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                call.http_s += time.monotonic() - started
+                if not self.retry_policy.can_retry(attempt):
+                    if model:
+                        # Запрос не дошёл до модели: резерв токенов возвращается
+                        self.rate_limiter.settle(model, estimated, 0)
+                    call.finish(None, kwargs)
+                    raise
+                delay = self.retry_policy.delay(attempt)
+                time.sleep(delay)
+                call.retry_wait_s += delay
+                attempt += 1
+                call.retries = attempt
+                continue
+            call.http_s += time.monotonic() - started
+
+            if resp.status_code == 401 and isinstance(access_token, TokenManager) and not token_refreshed:
+                access_token.invalidate(token)
+                token = access_token.get_token()
+                token_refreshed = True
+                # Отброшенный ответ (в том числе stream=True) освобождает соединение пула
+                resp.close()
+                continue
+
+            if self.retry_policy.should_retry(resp.status_code, attempt):
+                delay = self.retry_policy.delay(attempt, resp.status_code, resp.headers.get("Retry-After"))
+                resp.close()
+                time.sleep(delay)
+                call.retry_wait_s += delay
+                attempt += 1
+                call.retries = attempt
+                continue
+
+            if model and not resp.ok:
+                self.rate_limiter.settle(model, estimated, 0)
+            # Потоковый ответ читает вызывающий код: usage придёт в последнем событии SSE,
+            # резерв уточняет stream_chat_completion
+            elif model and not kwargs.get("stream"):
+                self.rate_limiter.settle(model, estimated, _usage_total_tokens(resp))
+            call.finish(resp.status_code, kwargs)
+            return resp
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+
+_CLIENT: GigaChatClient | None = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_client() -> GigaChatClient:
+    """Общий для процесса клиент GigaChat (создаётся при первом обращении)."""
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = GigaChatClient()
+        return _CLIENT
+
+
+def configure_client(**kwargs) -> GigaChatClient:
+    """
+    Пересоздать общий клиент с другими параметрами пула/таймаутов
+    (аргументы как у GigaChatClient). Старая сессия закрывается.
+    """
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is not None:
+            _CLIENT.close()
+        _CLIENT = GigaChatClient(**kwargs)
+        return _CLIENT
+
+
+def _usage_total_tokens(resp: requests.Response) -> int | None:
+    try:
+        usage = resp.json().get("usage") or {}
+    except (ValueError, AttributeError):
+        return None
+    value = usage.get("total_tokens")
+    return value if isinstance(value, int) else None
+
+
+# ---------- Кэш ответов ----------
+
+# Кэш ответов модели (None — кэш выключен). Включается вызывающим кодом через set_response_cache.
+_RESPONSE_CACHE: ResponseCache | None = None
+
+
+def set_response_cache(cache: ResponseCache | None) -> None:
+    """Подключить (или отключить, передав None) кэш ответов для всех вызовов модели."""
+    global _RESPONSE_CACHE
+    _RESPONSE_CACHE = cache
+
+
+def get_response_cache() -> ResponseCache | None:
+    return _RESPONSE_CACHE
+
+
+def _text_cache_key(payload: dict) -> str | None:
+    return cache_key(payload) if _RESPONSE_CACHE is not None else None
+
+
+def _ocr_cache_key(content: bytes) -> str | None:
+    """Ключ распознавания: промпт + хэш байтов изображения (file_id меняется при каждой загрузке)."""
+    if _RESPONSE_CACHE is None:
+        return None
+    return cache_key(build_ocr_payload(""), [content_hash(content)])
+
+
+def _regions_cache_key(images: List[bytes], text_layer: str) -> str | None:
+    """Ключ запроса по областям: промпт и текстовый слой + хэши байтов всех фрагментов."""
+    if _RESPONSE_CACHE is None:
+        return None
+    payload = build_regions_payload([""] * len(images), text_layer)
+    return cache_key(payload, [content_hash(image) for image in images])
+
+
+def _ocr_batch_cache_key(images: List[bytes], page_nums: List[int]) -> str | None:
+    if _RESPONSE_CACHE is None:
+        return None
+    payload = build_ocr_batch_payload([""] * len(images), page_nums)
+    return cache_key(payload, [content_hash(image) for image in images])
+
+
+def _cache_get(key: str | None) -> str | None:
+    if key is None or _RESPONSE_CACHE is None:
+        return None
+    return _RESPONSE_CACHE.get(key)
+
+
+def _cache_put(key: str | None, value: str) -> None:
+    if key is not None and _RESPONSE_CACHE is not None:
+        _RESPONSE_CACHE.put(key, value)
+
+
+# ---------- Реестр загруженных файлов ----------
+
+# Реестр «хэш изображения -> file_id» (None — каждое изображение загружается заново).
+# Включается вызывающим кодом через set_file_registry.
+_FILE_REGISTRY: FileRegistry | None = None
+
+
+def set_file_registry(registry: FileRegistry | None) -> None:
+    """Подключить (или отключить, передав None) реестр загрузок для всех загрузок изображений."""
+    global _FILE_REGISTRY
+    _FILE_REGISTRY = registry
+
+
+def get_file_registry() -> FileRegistry | None:
+    return _FILE_REGISTRY
+
+
+# Блокировки загрузки по хэшу содержимого (только при подключённом реестре)
+_UPLOAD_LOCKS: Dict[str, threading.Lock] = {}
+_UPLOAD_LOCKS_GUARD = threading.Lock()
+
+
+def _upload_lock(content: bytes) -> threading.Lock:
+    with _UPLOAD_LOCKS_GUARD:
+        return _UPLOAD_LOCKS.setdefault(content_hash(content), threading.Lock())
+
+
+def _registry_get(content: bytes) -> str | None:
+    if _FILE_REGISTRY is None:
+        return None
+    return _FILE_REGISTRY.get(content_hash(content))
+
+
+def _registry_put(content: bytes, file_id: str, filename: str) -> None:
+    if _FILE_REGISTRY is not None:
+        _FILE_REGISTRY.put(content_hash(content), file_id, filename, len(content))
 
 
 # ---------- Вспомогательные функции ----------
@@ -79,97 +363,85 @@ def generate_id() -> str:
     return str(uuid.uuid4())
 
 
-def get_creds() -> dict:
-    """Получаем access_token через NGW (как в твоём коде)."""
+def _build_creds_request() -> tuple[dict, dict]:
+    """Заголовки и тело запроса токена к NGW."""
     headers = {
         "Authorization": f"Bearer {GIGA_CHAT_AUTH_DATA}",
         "RqUID": generate_id(),
         "Content-Type": "application/x-www-form-urlencoded",
     }
     data = {"scope": GIGA_CHAT_SCOPE}
-
-    r = requests.post(NGW_URL, headers=headers, data=data, verify=False)
-    json_response = json.loads(r.text)
-    return json_response
+    return headers, data
 
 
-def upload_image_to_files(path: str, access_token: str) -> str:
-    """
-    Загружаем изображение в хранилище GigaChat и получаем идентификатор файла,
-    который потом передаётся в messages[*].attachments, как описано в доке.
-    """
-    filename = os.path.basename(path)
+def _image_mime_type(filename: str) -> str:
     ext = os.path.splitext(filename)[1].lower()
     if ext in (".jpg", ".jpeg"):
-        mime_type = "image/jpeg"
-    elif ext == ".png":
-        mime_type = "image/png"
-    else:
-        # Библиотека и API в любом случае поймут JPEG/PNG, другие форматы лучше не использовать
-        raise ValueError("Поддерживаются только изображения JPG/JPEG или PNG.")
+        return "image/jpeg"
+    if ext == ".png":
+        return "image/png"
+    # Библиотека и API в любом случае поймут JPEG/PNG, другие форматы лучше не использовать
+    raise ValueError("Поддерживаются только изображения JPG/JPEG или PNG.")
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-    }
 
-    with open(path, "rb") as f:
-        files = {
-            "file": (filename, f, mime_type),
-        }
-        # Согласно спецификации FileUpload, дополнительно можно указать purpose=general
-        data = {
-            "purpose": "general",
-        }
-        resp = requests.post(
-            GIGA_FILES_URL,
-            headers=headers,
-            files=files,
-            data=data,
-            timeout=120,
-            verify=False,
+def _check_image_size(content: bytes) -> None:
+    """Изображение больше лимита API не загружаем: ответ всё равно был бы 413."""
+    if len(content) > MAX_IMAGE_BYTES:
+        raise ValueError(
+            f"Изображение {len(content) / 1024 / 1024:.1f} Мб больше лимита GigaChat "
+            f"{MAX_IMAGE_BYTES // 1024 // 1024} Мб: уменьшите разрешение рендеринга."
         )
 
-    # Отдельно обрабатываем 400, чтобы увидеть текст ошибки от GigaChat и не падать трассировкой
+
+def _format_error_body(body: str) -> str:
+    """Текст ошибки от GigaChat: JSON красиво форматируем, остальное оставляем как есть."""
     try:
-        resp.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        if resp.status_code == 400:
-            try:
-                err_payload = resp.json()
-            except ValueError:
-                err_text = resp.text
-            else:
-                err_text = json.dumps(err_payload, ensure_ascii=False, indent=2)
-            raise ValueError(
-                "Ошибка загрузки файла в GigaChat (HTTP 400 Bad Request).\n"
-                "Проверьте формат запроса к /api/v1/files.\n"
-                f"Ответ сервера:\n{err_text}"
-            ) from e
-        raise
-    data = resp.json()
-    # загрузка файла токены не тарифицирует по chat/completions, usage здесь нет
+        err_payload = json.loads(body)
+    except ValueError:
+        return body
+    return json.dumps(err_payload, ensure_ascii=False, indent=2)
+
+
+def _upload_error_400(body: str) -> ValueError:
+    return ValueError(
+        "Ошибка загрузки файла в GigaChat (HTTP 400 Bad Request).\n"
+        "Проверьте формат запроса к /api/v1/files.\n"
+        f"Ответ сервера:\n{_format_error_body(body)}"
+    )
 
+
+def _extract_file_id(data: dict) -> str:
     # Пытаемся аккуратно вытащить идентификатор файла из разных возможных полей
     file_id = data.get("id") or data.get("file_id") or data.get("fileId")
     if not file_id:
         raise RuntimeError(f"Не удалось получить идентификатор файла из ответа GigaChat: {data}")
-
     return file_id
 
 
-# ---------- Текстовый диалог через REST ----------
+def _extract_content(data: dict) -> str:
+    """Текст ответа модели из объекта chat/completions."""
+    # мультимодальные ответы GigaChat обычно возвращают content как массив блоков[web:62][web:67]
+    content = data["choices"][0]["message"]["content"]
+    if isinstance(content, list):
+        texts = []
+        for block in content:
+            if isinstance(block, dict) and block.get("type") in ("output_text", "text"):
+                texts.append(block.get("text", ""))
+        if texts:
+            return "\n".join(texts)
+    # fallback: если вдруг контент строкой
+    if isinstance(content, str):
+        return content
+    return str(content)
 
-def giga_free_answer(
+
+def build_text_payload(
     question: str,
-    access_token: str,
-    sys_prompt: str = "Ты банковский работник, ответь на заданный вопрос максимально лаконично",
+    sys_prompt: str,
     history=None,
     max_tokens: int | None = None,
-) -> str:
-    """
-    Обычный текстовый запрос к GigaChat через REST (без картинок).
-    Заодно учитываем usage из ответа для подсчёта токенов.
-    """
+) -> dict:
+    """Тело запроса chat/completions для обычного текстового диалога."""
     if history is None:
         history = []
 
@@ -195,48 +467,15 @@ def giga_free_answer(
     }
     if isinstance(max_tokens, int):
         payload["max_tokens"] = max_tokens
+    return payload
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-
-    resp = requests.post(
-        GIGA_API_URL,
-        headers=headers,
-        json=payload,
-        timeout=120,
-        verify=False,
-    )
-
-    try:
-        resp.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-        # Для текстовых запросов достаточно пробросить ошибку наверх
-        raise e
-
-    data = resp.json()
-    _update_token_stats(data)
 
-    content = data["choices"][0]["message"]["content"]
-    if isinstance(content, str):
-        return content
-    return str(content)
-
-
-# ---------- Распознавание инструкции с изображения через REST ----------
-
-def ocr_instruction_via_rest(image_path: str, access_token: str) -> str:
+def build_ocr_payload(file_id: str) -> dict:
     """
-    Отправляем в GigaChat-Pro изображение + промпт
-    и получаем подробное текстовое описание инструкции.[web:67][web:69]
+    Тело запроса распознавания инструкции по изображению строго по схеме из readme_gigachat_api.md:
+    model + messages[ {role, content, attachments: [file_id]} ]
     """
-    # 1. Загружаем изображение в файловое хранилище GigaChat и получаем file_id
-    file_id = upload_image_to_files(image_path, access_token)
-
-    # 2. Строим payload строго по схеме из readme_gigachat_api.md:
-    #    model + messages[ {role, content, attachments: [file_id]} ]
-    payload = {
+    return {
         "model": VISION_MODEL,
         "temperature": 0.01,
         "messages": [
@@ -261,62 +500,611 @@ def ocr_instruction_via_rest(image_path: str, access_token: str) -> str:
         ],
     }
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
+
+def build_regions_payload(file_ids: List[str], text_layer: str) -> dict:
+    """
+    Тело запроса по вырезанным областям страницы (скриншоты, рисунки) и её текстовому слою.
+    По ограничению API каждое изображение идёт в отдельном сообщении (одно вложение
+    на сообщение, до 10 на запрос); последнее сообщение — текстовый слой и задание.
+    Модель сразу возвращает итоговую инструкцию по странице, отдельный запрос
+    на объединение с текстовым слоем не нужен.
+    """
+    total = len(file_ids)
+    messages = [{"role": "system", "content": SYS_PROMPT}]
+    for idx, file_id in enumerate(file_ids, start=1):
+        messages.append(
+            {
+                "role": "user",
+                "content": f"Фрагмент страницы {idx} из {total}: скриншот или рисунок со страницы инструкции.",
+                "attachments": [file_id],
+            }
+        )
+    messages.append(
+        {
+            "role": "user",
+            "content": (
+                f"Выше — {total} фрагмент(ов) страницы инструкции по работе в АС в кредитном "
+                "отделе банка: скриншоты интерфейса и рисунки, вырезанные со страницы.\n"
+                "Ниже — текстовый слой этой же страницы, извлечённый из PDF:\n"
+                "----------------------------------------\n"
+                f"{text_layer}\n"
+                "----------------------------------------\n\n"
+                "Задача: составь итоговую инструкцию по странице. Основа — текстовый слой; "
+                "дополни его тем, что видно только на фрагментах. Скриншоты интерфейса "
+                "не переписывай дословно, используй их как пояснение, например: "
+                "на скриншоте показано, как перейти в нужный раздел.\n\n"
+                "Строгие правила:\n"
+                "1) Используй ТОЛЬКО информацию из текстового слоя и фрагментов.\n"
+                "2) Нельзя добавлять новые шаги, кнопки, поля, сценарии или рекомендации.\n"
+                "3) Можно убирать повторы и исправлять явные артефакты извлечения текста.\n"
+                "4) Если информации мало, просто перепиши её аккуратно и ничего не добавляй."
+            ),
+        }
+    )
+    return {"model": VISION_MODEL, "temperature": 0.01, "messages": messages}
+
+
+# Лимит API: одно изображение на сообщение, до 10 изображений в запросе
+MAX_IMAGES_PER_REQUEST = 10
+
+_PAGE_DELIMITER_RE = re.compile(r"^\s*=== PAGE (\d+) ===\s*$", re.MULTILINE)
+
+
+def page_delimiter(page_num: int) -> str:
+    return f"=== PAGE {page_num:03d} ==="
+
+
+def build_ocr_batch_payload(file_ids: List[str], page_nums: List[int]) -> dict:
+    """
+    Распознавание нескольких страниц одним запросом: изображение каждой страницы
+    в своём сообщении (одно вложение на сообщение), ответ — тексты страниц,
+    разделённые строками вида "=== PAGE 001 ===" (см. split_ocr_batch_answer).
+    """
+    messages = [{"role": "system", "content": SYS_PROMPT}]
+    for file_id, page_num in zip(file_ids, page_nums):
+        messages.append(
+            {
+                "role": "user",
+                "content": f"Изображение страницы {page_num:03d} инструкции.",
+                "attachments": [file_id],
+            }
+        )
+    layout = "\n".join(f"{page_delimiter(num)}\n<текст страницы {num:03d}>" for num in page_nums)
+    messages.append(
+        {
+            "role": "user",
+            "content": (
+                f"Выше — изображения {len(page_nums)} страниц инструкции по работе в АС "
+                "в кредитном отделе банка. "
+                "Для КАЖДОЙ страницы перепиши текст её инструкции практически дословно, "
+                "можно только чуть структурировать оформление (заголовки, списки).\n\n"
+                "Не добавляй никаких новых шагов, рекомендаций или обобщающих фраз, "
+                "которых нет на изображении. Не переноси текст с одной страницы на другую. "
+                "Если приведен скриншот интерфейса, не приводи дословно содержимое, просто используй "
+                "в инструкции как пояснение.\n\n"
+                "Формат ответа строго такой, разделители страниц пиши отдельными строками "
+                "ровно в этом виде и порядке:\n"
+                f"{layout}"
+            ),
+        }
+    )
+    return {"model": VISION_MODEL, "temperature": 0.01, "messages": messages}
+
+
+def split_ocr_batch_answer(answer: str, page_nums: List[int]) -> Dict[int, str]:
+    """
+    Разделяем ответ пакетного распознавания по разделителям страниц.
+    ValueError, если разделители не совпадают со списком страниц (пропуски, повторы,
+    лишние страницы) или текст какой-то страницы пуст — тогда страницы распознаются по одной.
+    """
+    matches = list(_PAGE_DELIMITER_RE.finditer(answer))
+    found = [int(m.group(1)) for m in matches]
+    if found != list(page_nums):
+        raise ValueError(
+            f"Ответ пакетного распознавания не разделился по страницам: ожидались {list(page_nums)}, "
+            f"получены {found}"
+        )
+    result: Dict[int, str] = {}
+    for idx, m in enumerate(matches):
+        end = matches[idx + 1].start() if idx + 1 < len(matches) else len(answer)
+        text = answer[m.end():end].strip()
+        if not text:
+            raise ValueError(f"Пустой текст страницы {found[idx]} в ответе пакетного распознавания")
+        result[found[idx]] = text
+    return result
+
+
+def _ocr_error_message(status_code: int, body: str) -> str | None:
+    """
+    Человеко-читаемое сообщение для ошибок 413 и 400 распознавания
+    (вместо трассировки). Для остальных кодов возвращаем None.
+    """
+    if status_code == 413:
+        return (
+            "Ошибка GigaChat: HTTP 413 Request Entity Too Large. "
+            "Изображение или запрос слишком большой. "
+            "Попробуйте уменьшить разрешение/размер файла и повторить попытку."
+        )
+    if status_code == 400:
+        # Показываем, что именно не понравилось API, вместо необработанного исключения
+        return (
+            "Ошибка GigaChat: HTTP 400 Bad Request.\n"
+            "Проверьте корректность модели и формата запроса.\n"
+            f"Ответ сервера:\n{_format_error_body(body)}"
+        )
+    return None
+
+
+def _auth_headers(access_token: str, content_type: str | None = None) -> dict:
+    headers = {"Authorization": f"Bearer {access_token}"}
+    if content_type:
+        headers["Content-Type"] = content_type
+    return headers
+
+
+def get_creds() -> dict:
+    """Получаем access_token через NGW (как в твоём коде)."""
+    headers, data = _build_creds_request()
+    r = get_client().send("POST", NGW_URL, headers=headers, data=data)
+    json_response = json.loads(r.text)
+    return json_response
+
+
+# ---------- Токен доступа ----------
+
+def _parse_expires_at(creds: dict) -> float | None:
+    """expires_at из ответа NGW (миллисекунды) в секундах unix time."""
+    value = creds.get("expires_at")
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    # NGW отдаёт миллисекунды; на всякий случай поддерживаем и секунды
+    return value / 1000 if value > 10**11 else float(value)
+
+
+class TokenManager:
+    """
+    Кэш access_token NGW с заблаговременным обновлением.
+    - токен обновляется за refresh_margin секунд до expires_at;
+    - после 401 вызывающий код сообщает invalidate(token), и следующий get_token() берёт новый;
+    - обновление идёт под блокировкой, поэтому параллельные воркеры
+      делают ровно один запрос к NGW, а не «лавину».
+    """
+
+    # Если NGW не вернул expires_at, считаем, что токен живёт 30 минут
+    DEFAULT_TTL = 30 * 60
+
+    def __init__(
+        self,
+        fetch: Callable[[], dict] | None = None,
+        refresh_margin: float = GIGA_TOKEN_REFRESH_MARGIN,
+    ) -> None:
+        self._fetch = fetch or get_creds
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._token: str | None = None
+        self._expires_at = 0.0
+        self.refresh_count = 0
+
+    def needs_refresh(self) -> bool:
+        return self._token is None or time.time() >= self._expires_at - self.refresh_margin
+
+    def get_token(self) -> str:
+        token = self._token
+        if token is not None and not self.needs_refresh():
+            return token
+        with self._lock:
+            # Пока ждали блокировку, токен мог обновить другой поток
+            if self.needs_refresh():
+                self._refresh_locked()
+            return self._token
+
+    def invalidate(self, token: str) -> None:
+        """Пометить токен недействительным (после 401). Уже обновлённый токен не трогаем."""
+        with self._lock:
+            if self._token == token:
+                self._token = None
+
+    def _refresh_locked(self) -> None:
+        creds = self._fetch()
+        token = creds.get("access_token")
+        if not token:
+            raise RuntimeError(
+                f"Токен не получен от NGW. Ответ: {creds}. "
+                "Проверьте переменную окружения GIGA_ACCESS_KEY и доступ к NGW."
+            )
+        expires_at = _parse_expires_at(creds)
+        self._token = token
+        self._expires_at = expires_at if expires_at is not None else time.time() + self.DEFAULT_TTL
+        self.refresh_count += 1
+
+
+# Где ожидается токен, можно передать строку или TokenManager
+AccessToken = Union[str, TokenManager]
+
+
+def resolve_token(access_token: AccessToken) -> str:
+    if isinstance(access_token, TokenManager):
+        return access_token.get_token()
+    return access_token
+
+
+def upload_image_to_files(path: str, access_token: AccessToken) -> str:
+    """
+    Загружаем изображение в хранилище GigaChat и получаем идентификатор файла,
+    который потом передаётся в messages[*].attachments, как описано в доке.
+    """
+    # Читаем файл целиком: при повторе запроса (401) тело отправляется заново
+    with open(path, "rb") as f:
+        content = f.read()
+    return upload_image_bytes(content, os.path.basename(path), access_token)
+
+
+def upload_image_bytes(content: bytes, filename: str, access_token: AccessToken) -> str:
+    """
+    Загрузка изображения из памяти (например, JPEG, закодированного page_render без записи
+    на диск). filename нужен только для имени и MIME-типа в multipart.
+    С подключённым реестром загрузок уже загруженное изображение повторно не загружается.
+    """
+    mime_type = _image_mime_type(filename)
+    _check_image_size(content)
+    if _FILE_REGISTRY is None:
+        return _post_image(content, filename, mime_type, access_token)
+    # Одинаковые изображения из параллельных потоков загружаются один раз
+    with _upload_lock(content):
+        file_id = _registry_get(content)
+        if file_id is None:
+            file_id = _post_image(content, filename, mime_type, access_token)
+            _registry_put(content, file_id, filename)
+    return file_id
+
+
+def _post_image(content: bytes, filename: str, mime_type: str, access_token: AccessToken) -> str:
+    files = {
+        "file": (filename, content, mime_type),
+    }
+    # Согласно спецификации FileUpload, дополнительно можно указать purpose=general
+    data = {
+        "purpose": "general",
     }
+    resp = get_client().send(
+        "POST",
+        GIGA_FILES_URL,
+        access_token,
+        files=files,
+        data=data,
+    )
+
+    # Отдельно обрабатываем 400, чтобы увидеть текст ошибки от GigaChat и не падать трассировкой
+    try:
+        resp.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        if resp.status_code == 400:
+            raise _upload_error_400(resp.text) from e
+        raise
+    # загрузка файла токены не тарифицирует по chat/completions, usage здесь нет
+    return _extract_file_id(resp.json())
+
+
+def list_files(access_token: AccessToken) -> List[dict]:
+    """Список файлов в хранилище GigaChat (GET /files)."""
+    resp = get_client().send("GET", GIGA_FILES_URL, access_token)
+    resp.raise_for_status()
+    return resp.json().get("data") or []
+
+
+def delete_file(file_id: str, access_token: AccessToken) -> bool:
+    """Удалить файл из хранилища (POST /files/{file}/delete). False — файла там уже нет."""
+    resp = get_client().send("POST", f"{GIGA_FILES_URL}/{file_id}/delete", access_token)
+    if resp.status_code == 404:
+        return False
+    resp.raise_for_status()
+    return bool(resp.json().get("deleted", True))
+
+
+def sync_file_registry(registry: FileRegistry, access_token: AccessToken) -> int:
+    """
+    Сверить реестр загрузок со списком файлов хранилища: file_id, которых там нет,
+    переиспользовать нельзя. Возвращает число отброшенных записей.
+    """
+    return registry.sync(item["id"] for item in list_files(access_token) if item.get("id"))
+
+
+def cleanup_uploaded_files(registry: FileRegistry, access_token: AccessToken) -> int:
+    """
+    Удалить из хранилища GigaChat все файлы реестра и очистить реестр.
+    Файлы, которых в хранилище уже нет, просто забываются. Возвращает число удалённых.
+    """
+    deleted = 0
+    for file_id in registry.file_ids():
+        if delete_file(file_id, access_token):
+            deleted += 1
+        registry.forget([file_id])
+    return deleted
+
+
+# ---------- Текстовый диалог через REST ----------
+
+def _session_headers(session_id: str | None) -> dict:
+    return {"X-Session-ID": session_id} if session_id else {}
+
+
+def giga_free_answer(
+    question: str,
+    access_token: AccessToken,
+    sys_prompt: str = "Ты банковский работник, ответь на заданный вопрос максимально лаконично",
+    history=None,
+    max_tokens: int | None = None,
+    session_id: str | None = None,
+) -> str:
+    """
+    Обычный текстовый запрос к GigaChat через REST (без картинок).
+    Заодно учитываем usage из ответа для подсчёта токенов.
+    Если подключён кэш ответов, повторный одинаковый запрос в сеть не уходит.
+    session_id — заголовок X-Session-ID: запросы одной сессии с общим началом промпта
+    GigaChat обрабатывает с кэшем токенов (usage.precached_prompt_tokens).
+    """
+    payload = build_text_payload(question, sys_prompt, history=history, max_tokens=max_tokens)
+    key = _text_cache_key(payload)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
 
-    resp = requests.post(
+    resp = get_client().send(
+        "POST",
         GIGA_API_URL,
-        headers=headers,
+        access_token,
+        content_type="application/json",
+        headers=_session_headers(session_id),
         json=payload,
-        timeout=120,
-        verify=False,
     )
 
-    # Обработка ошибок HTTP (в т.ч. 413 и 400)
     try:
         resp.raise_for_status()
     except requests.exceptions.HTTPError as e:
-        if resp.status_code == 413:
-            # Возвращаем человеко-читаемое сообщение вместо падения скрипта
-            return (
-                "Ошибка GigaChat: HTTP 413 Request Entity Too Large. "
-                "Изображение или запрос слишком большой. "
-                "Попробуйте уменьшить разрешение/размер файла и повторить попытку."
-            )
-        if resp.status_code == 400:
-            # Показываем, что именно не понравилось API, вместо необработанного исключения
-            try:
-                err_payload = resp.json()
-            except ValueError:
-                err_text = resp.text
-            else:
-                err_text = json.dumps(err_payload, ensure_ascii=False, indent=2)
-            return (
-                "Ошибка GigaChat: HTTP 400 Bad Request.\n"
-                "Проверьте корректность модели и формата запроса.\n"
-                f"Ответ сервера:\n{err_text}"
-            )
-        # Для остальных ошибок — пробрасываем исключение дальше
+        # Для текстовых запросов достаточно пробросить ошибку наверх
         raise e
 
     data = resp.json()
     _update_token_stats(data)
+    content = _extract_content(data)
+    _cache_put(key, content)
+    return content
 
-    # мультимодальные ответы GigaChat обычно возвращают content как массив блоков[web:62][web:67]
-    content = data["choices"][0]["message"]["content"]
-    if isinstance(content, list):
-        texts = []
-        for block in content:
-            if isinstance(block, dict) and block.get("type") in ("output_text", "text"):
-                texts.append(block.get("text", ""))
-        if texts:
-            return "\n".join(texts)
-    # fallback: если вдруг контент строкой
-    if isinstance(content, str):
-        return content
-    return str(content)
+
+def stream_chat_completion(
+    payload: dict,
+    access_token: AccessToken,
+    session_id: str | None = None,
+) -> Iterator[str]:
+    """
+    Запрос chat/completions со stream=true: фрагменты ответа (delta.content) отдаются
+    по мере генерации из событий SSE «data: {...}» до «data: [DONE]».
+    Таймаут чтения действует на каждый фрагмент, а не на весь ответ целиком.
+    """
+    client = get_client()
+    stream_payload = {**payload, "stream": True}
+    resp = client.send(
+        "POST",
+        GIGA_API_URL,
+        access_token,
+        content_type="application/json",
+        headers={"Accept": "text/event-stream", **_session_headers(session_id)},
+        json=stream_payload,
+        stream=True,
+    )
+    total_tokens = None
+    try:
+        resp.raise_for_status()
+        # SSE всегда в UTF-8, даже если сервер не указал charset
+        resp.encoding = "utf-8"
+        for line in resp.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            # usage приходит в последнем событии
+            _update_token_stats(chunk)
+            usage_total = (chunk.get("usage") or {}).get("total_tokens")
+            if isinstance(usage_total, int):
+                total_tokens = usage_total
+            for choice in chunk.get("choices") or []:
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    yield content
+    finally:
+        resp.close()
+        # Резерв токенов, сделанный send, уточняется по usage последнего события
+        model, estimated = estimate_tokens(stream_payload)
+        if model and resp.ok:
+            client.rate_limiter.settle(model, estimated, total_tokens)
+
+
+def giga_free_answer_stream(
+    question: str,
+    access_token: AccessToken,
+    sys_prompt: str = "Ты банковский работник, ответь на заданный вопрос максимально лаконично",
+    history=None,
+    max_tokens: int | None = None,
+    session_id: str | None = None,
+) -> Iterator[str]:
+    """
+    Тот же запрос, что giga_free_answer, но с потоковой выдачей (SSE): генератор фрагментов ответа.
+    Кэш общий с giga_free_answer (поле stream в ключ не входит): из кэша ответ отдаётся
+    одним фрагментом, а полностью полученный поток сохраняется в кэш.
+    """
+    payload = build_text_payload(question, sys_prompt, history=history, max_tokens=max_tokens)
+    key = _text_cache_key(payload)
+    cached = _cache_get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    parts: List[str] = []
+    for delta in stream_chat_completion(payload, access_token, session_id=session_id):
+        parts.append(delta)
+        yield delta
+    _cache_put(key, "".join(parts))
+
+
+class StreamResult(NamedTuple):
+    text: str
+    # Время до первого фрагмента и до конца ответа, секунды (first_token_s — None, если ответ пустой)
+    first_token_s: float | None
+    total_s: float
+
+
+def stream_to_file(deltas: Iterable[str], path: Path, prefix: str = "") -> StreamResult:
+    """
+    Пишет фрагменты потокового ответа в файл по мере получения (после prefix),
+    чтобы длинная генерация была видна на диске и не терялась целиком при обрыве.
+    Замеряет время до первого фрагмента: запрос уходит при первом чтении генератора.
+    """
+    started = time.monotonic()
+    first_token_s = None
+    parts: List[str] = []
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(prefix)
+        for delta in deltas:
+            if first_token_s is None:
+                first_token_s = time.monotonic() - started
+            parts.append(delta)
+            f.write(delta)
+            f.flush()
+    return StreamResult("".join(parts), first_token_s, time.monotonic() - started)
+
+
+# ---------- Распознавание инструкции с изображения через REST ----------
+
+def ocr_instruction_via_rest(image_path: str, access_token: AccessToken) -> str:
+    """
+    Отправляем в GigaChat-Pro изображение + промпт
+    и получаем подробное текстовое описание инструкции.[web:67][web:69]
+    При попадании в кэш ответов изображение даже не загружается.
+    """
+    with open(image_path, "rb") as f:
+        content = f.read()
+    return ocr_instruction_from_bytes(content, os.path.basename(image_path), access_token)
+
+
+def ocr_instruction_from_bytes(content: bytes, filename: str, access_token: AccessToken) -> str:
+    """То же, что ocr_instruction_via_rest, но изображение уже в памяти."""
+    key = _ocr_cache_key(content)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    # 1. Загружаем изображение в файловое хранилище GigaChat и получаем file_id
+    file_id = upload_image_bytes(content, filename, access_token)
+
+    # 2. Запрос к модели с file_id во вложениях
+    resp = get_client().send(
+        "POST",
+        GIGA_API_URL,
+        access_token,
+        content_type="application/json",
+        json=build_ocr_payload(file_id),
+    )
+
+    # Обработка ошибок HTTP (в т.ч. 413 и 400). Текст ошибки не возвращаем как результат,
+    # иначе он попадёт в instruction.txt как содержимое страницы
+    try:
+        resp.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        message = _ocr_error_message(resp.status_code, resp.text)
+        if message is not None:
+            raise ValueError(message) from e
+        # Для остальных ошибок (повторы исчерпаны) — пробрасываем исключение дальше
+        raise e
+
+    data = resp.json()
+    _update_token_stats(data)
+    content = _extract_content(data)
+    _cache_put(key, content)
+    return content
+
+
+def ocr_regions_with_text(images: List[bytes], text_layer: str, access_token: AccessToken) -> str:
+    """
+    Итоговая инструкция по странице из вырезанных областей (JPEG в памяти, до 10 штук)
+    и текстового слоя — один мультимодальный запрос вместо распознавания всей страницы
+    и отдельного объединения.
+    """
+    key = _regions_cache_key(images, text_layer)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    file_ids = [
+        upload_image_bytes(image, f"region_{idx:02d}.jpg", access_token)
+        for idx, image in enumerate(images, start=1)
+    ]
+    resp = get_client().send(
+        "POST",
+        GIGA_API_URL,
+        access_token,
+        content_type="application/json",
+        json=build_regions_payload(file_ids, text_layer),
+    )
+    try:
+        resp.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        message = _ocr_error_message(resp.status_code, resp.text)
+        if message is not None:
+            raise ValueError(message) from e
+        raise e
+
+    data = resp.json()
+    _update_token_stats(data)
+    content = _extract_content(data)
+    _cache_put(key, content)
+    return content
+
+
+def ocr_pages_batch(images: List[bytes], page_nums: List[int], access_token: AccessToken) -> Dict[int, str]:
+    """
+    Распознавание до MAX_IMAGES_PER_REQUEST страниц одним мультимодальным запросом.
+    Возвращает {номер страницы: текст}. Если ответ не удалось разделить по страницам —
+    ValueError (в кэш такой ответ не попадает), вызывающий код распознаёт страницы по одной.
+    """
+    if not images or len(images) != len(page_nums) or len(images) > MAX_IMAGES_PER_REQUEST:
+        raise ValueError(
+            f"В пакете распознавания должно быть от 1 до {MAX_IMAGES_PER_REQUEST} страниц, "
+            f"по одному изображению на страницу"
+        )
+    key = _ocr_batch_cache_key(images, page_nums)
+    cached = _cache_get(key)
+    if cached is not None:
+        return split_ocr_batch_answer(cached, page_nums)
+
+    file_ids = [
+        upload_image_bytes(image, f"page_{num:03d}.jpg", access_token)
+        for image, num in zip(images, page_nums)
+    ]
+    resp = get_client().send(
+        "POST",
+        GIGA_API_URL,
+        access_token,
+        content_type="application/json",
+        json=build_ocr_batch_payload(file_ids, page_nums),
+    )
+    try:
+        resp.raise_for_status()
+    except requests.exceptions.HTTPError as e:
+        message = _ocr_error_message(resp.status_code, resp.text)
+        if message is not None:
+            raise ValueError(message) from e
+        raise e
+
+    data = resp.json()
+    _update_token_stats(data)
+    content = _extract_content(data)
+    pages = split_ocr_batch_answer(content, page_nums)
+    _cache_put(key, content)
+    return pages
 
 
 # ---------- main ----------
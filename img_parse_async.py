@@ -0,0 +1,423 @@
+"""
+Асинхронная версия API из img_parse.py на aiohttp.
+
+Один AsyncGigaChatClient держит общий пул соединений (aiohttp.TCPConnector)
+и семафор, ограничивающий число одновременных запросов. Так один процесс
+может вести тысячи запросов «в полёте» без отдельного потока на каждый.
+
+Промпты, формат запросов и разбор ответов общие с img_parse.py.
+"""
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List, Mapping, NamedTuple
+
+try:
+    import aiohttp
+except ImportError as e:
+    raise ImportError(
+        "Для асинхронного клиента GigaChat требуется библиотека aiohttp. "
+        "Установите её командой: pip install aiohttp"
+    ) from e
+
+from giga_limits import RateLimiter, RetryPolicy, estimate_tokens
+from response_cache import content_hash
+from run_metrics import CallTimer
+from img_parse import (
+    GIGA_API_URL,
+    GIGA_CONNECT_TIMEOUT,
+    GIGA_FILES_URL,
+    GIGA_POOL_SIZE,
+    GIGA_READ_TIMEOUT,
+    NGW_URL,
+    AccessToken,
+    TokenManager,
+    _auth_headers,
+    _build_creds_request,
+    _cache_get,
+    _cache_put,
+    _check_image_size,
+    _extract_content,
+    _extract_file_id,
+    _image_mime_type,
+    _ocr_batch_cache_key,
+    _ocr_cache_key,
+    _regions_cache_key,
+    _registry_get,
+    _registry_put,
+    _text_cache_key,
+    _ocr_error_message,
+    _update_token_stats,
+    _upload_error_400,
+    MAX_IMAGES_PER_REQUEST,
+    build_ocr_batch_payload,
+    build_ocr_payload,
+    build_regions_payload,
+    build_text_payload,
+    get_file_registry,
+    resolve_token,
+    split_ocr_batch_answer,
+)
+
+
+async def resolve_token_async(access_token: AccessToken) -> str:
+    """
+    Токен для асинхронного запроса. Обновление TokenManager (сетевой вызов NGW)
+    выполняется в отдельном потоке, чтобы не блокировать event loop;
+    блокировка внутри TokenManager гарантирует один запрос к NGW на всех.
+    """
+    if isinstance(access_token, TokenManager) and access_token.needs_refresh():
+        return await asyncio.to_thread(access_token.get_token)
+    return resolve_token(access_token)
+
+
+def _usage_total_tokens(body: str) -> int | None:
+    try:
+        usage = json.loads(body).get("usage") or {}
+    except (ValueError, AttributeError):
+        return None
+    value = usage.get("total_tokens")
+    return value if isinstance(value, int) else None
+
+
+class _Response(NamedTuple):
+    status: int
+    body: str
+    request_info: "aiohttp.RequestInfo"
+    headers: Mapping[str, str]
+
+    def raise_for_status(self) -> None:
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(
+                request_info=self.request_info,
+                history=(),
+                status=self.status,
+                message=self.body[:500],
+            )
+
+
+class AsyncGigaChatClient:
+    """
+    Асинхронный клиент GigaChat.
+    pool_size    — лимит соединений в пуле;
+    concurrency  — лимит одновременных запросов (по умолчанию равен pool_size);
+    retry_policy, rate_limiter — как у img_parse.GigaChatClient; чтобы синхронные
+    и асинхронные вызовы делили одну квоту, передайте лимитер общего клиента.
+
+    Использование:
+        async with AsyncGigaChatClient(concurrency=32) as client:
+            creds = await client.get_creds()
+            text = await client.giga_free_answer("вопрос", creds["access_token"])
+    """
+
+    def __init__(
+        self,
+        pool_size: int = GIGA_POOL_SIZE,
+        concurrency: int | None = None,
+        connect_timeout: float = GIGA_CONNECT_TIMEOUT,
+        read_timeout: float = GIGA_READ_TIMEOUT,
+        verify: bool = False,
+        retry_policy: RetryPolicy | None = None,
+        rate_limiter: RateLimiter | None = None,
+    ) -> None:
+        self.retry_policy = retry_policy or RetryPolicy.from_env()
+        self.rate_limiter = rate_limiter or RateLimiter.from_env()
+        self.pool_size = max(1, int(pool_size))
+        self.concurrency = max(1, int(concurrency or self.pool_size))
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.verify = verify
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self._session: aiohttp.ClientSession | None = None
+        # Блокировки загрузки по хэшу содержимого: одинаковые изображения загружаются один раз
+        self._upload_locks: Dict[str, asyncio.Lock] = {}
+
+    async def __aenter__(self) -> "AsyncGigaChatClient":
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+    def start(self) -> None:
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                ssl=None if self.verify else False,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            raise RuntimeError("AsyncGigaChatClient не запущен: используйте 'async with' или start().")
+        return self._session
+
+    async def _post(self, url: str, call: CallTimer | None = None, **kwargs) -> _Response:
+        """
+        POST под семафором; тело ответа читается целиком.
+        Ошибки 4xx/5xx не бросаются здесь: вызывающий код сам решает,
+        какие из них обрабатывать мягко (как 400/413 в img_parse.py).
+        call — замеры вызова: ожидание семафора и время HTTP.
+        """
+        queued = time.monotonic()
+        async with self.semaphore:
+            started = time.monotonic()
+            try:
+                async with self.session.post(url, **kwargs) as resp:
+                    return _Response(resp.status, await resp.text(), resp.request_info, resp.headers)
+            finally:
+                if call is not None:
+                    call.queue_wait_s += started - queued
+                    call.http_s += time.monotonic() - started
+
+    async def _send(
+        self,
+        url: str,
+        access_token: AccessToken | None = None,
+        content_type: str | None = None,
+        headers: dict | None = None,
+        form_factory=None,
+        upload_bytes: int | None = None,
+        **kwargs,
+    ) -> _Response:
+        """
+        POST с повторами и лимитером частоты, как GigaChatClient.send:
+        429/5xx и сетевые ошибки повторяются по retry_policy (с учётом Retry-After),
+        при 401 и TokenManager токен обновляется и запрос повторяется один раз.
+        form_factory — функция, собирающая aiohttp.FormData (её нельзя отправить повторно);
+        upload_bytes — объём загружаемого файла для телеметрии (размер FormData не вычислить).
+        """
+        model, estimated = estimate_tokens(kwargs.get("json"))
+        token = await resolve_token_async(access_token) if access_token is not None else None
+        token_refreshed = False
+        attempt = 0
+        call = CallTimer(url, model)
+        reserved = False
+
+        while True:
+            if model:
+                # Токены резервируются один раз на вызов: повтор занимает только слот запроса
+                wait = self.rate_limiter.reserve(model, 0 if reserved else estimated)
+                reserved = True
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    call.queue_wait_s += wait
+
+            request_headers = dict(headers or {})
+            if token is not None:
+                request_headers.update(_auth_headers(token, content_type))
+            if form_factory is not None:
+                kwargs["data"] = form_factory()
+            try:
+                resp = await self._post(url, call, headers=request_headers, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if not self.retry_policy.can_retry(attempt):
+                    if model:
+                        # Запрос не дошёл до модели: резерв токенов возвращается
+                        self.rate_limiter.settle(model, estimated, 0)
+                    call.finish(None, kwargs, upload_bytes)
+                    raise
+                delay = self.retry_policy.delay(attempt)
+                await asyncio.sleep(delay)
+                call.retry_wait_s += delay
+                attempt += 1
+                call.retries = attempt
+                continue
+
+            if resp.status == 401 and isinstance(access_token, TokenManager) and not token_refreshed:
+                access_token.invalidate(token)
+                token = await resolve_token_async(access_token)
+                token_refreshed = True
+                continue
+
+            if self.retry_policy.should_retry(resp.status, attempt):
+                delay = self.retry_policy.delay(attempt, resp.status, resp.headers.get("Retry-After"))
+                await asyncio.sleep(delay)
+                call.retry_wait_s += delay
+                attempt += 1
+                call.retries = attempt
+                continue
+
+            if model:
+                actual = _usage_total_tokens(resp.body) if resp.status < 400 else 0
+                self.rate_limiter.settle(model, estimated, actual)
+            call.finish(resp.status, kwargs, upload_bytes)
+            return resp
+
+    # ---------- API ----------
+
+    async def get_creds(self) -> dict:
+        """Получаем access_token через NGW."""
+        headers, data = _build_creds_request()
+        resp = await self._send(NGW_URL, headers=headers, data=data)
+        return json.loads(resp.body)
+
+    async def upload_image_to_files(self, path: str, access_token: AccessToken) -> str:
+        """Загружаем изображение в хранилище GigaChat и получаем идентификатор файла."""
+        # Чтение файла страницы быстрое, отдельный поток под него не нужен
+        with open(path, "rb") as f:
+            content = f.read()
+        return await self.upload_image_bytes(content, os.path.basename(path), access_token)
+
+    async def upload_image_bytes(self, content: bytes, filename: str, access_token: AccessToken) -> str:
+        """Загрузка изображения из памяти, как img_parse.upload_image_bytes."""
+        mime_type = _image_mime_type(filename)
+        _check_image_size(content)
+        if get_file_registry() is None:
+            return await self._post_image(content, filename, mime_type, access_token)
+        async with self._upload_locks.setdefault(content_hash(content), asyncio.Lock()):
+            # Реестр загрузок и кэш ответов — синхронный SQLite: обращения к ним уходят в поток,
+            # чтобы не блокировать event loop
+            file_id = await asyncio.to_thread(_registry_get, content)
+            if file_id is None:
+                file_id = await self._post_image(content, filename, mime_type, access_token)
+                await asyncio.to_thread(_registry_put, content, file_id, filename)
+        return file_id
+
+    async def _post_image(self, content: bytes, filename: str, mime_type: str, access_token: AccessToken) -> str:
+        def make_form() -> aiohttp.FormData:
+            form = aiohttp.FormData()
+            form.add_field("file", content, filename=filename, content_type=mime_type)
+            form.add_field("purpose", "general")
+            return form
+
+        resp = await self._send(GIGA_FILES_URL, access_token, form_factory=make_form, upload_bytes=len(content))
+        if resp.status == 400:
+            raise _upload_error_400(resp.body)
+        resp.raise_for_status()
+        return _extract_file_id(json.loads(resp.body))
+
+    async def giga_free_answer(
+        self,
+        question: str,
+        access_token: AccessToken,
+        sys_prompt: str = "Ты банковский работник, ответь на заданный вопрос максимально лаконично",
+        history=None,
+        max_tokens: int | None = None,
+    ) -> str:
+        """Обычный текстовый запрос к GigaChat (без картинок). Кэш ответов общий с img_parse."""
+        payload = build_text_payload(question, sys_prompt, history=history, max_tokens=max_tokens)
+        key = _text_cache_key(payload)
+        cached = await asyncio.to_thread(_cache_get, key)
+        if cached is not None:
+            return cached
+        resp = await self._send(
+            GIGA_API_URL,
+            access_token,
+            content_type="application/json",
+            json=payload,
+        )
+        resp.raise_for_status()
+
+        data = json.loads(resp.body)
+        _update_token_stats(data)
+        content = _extract_content(data)
+        await asyncio.to_thread(_cache_put, key, content)
+        return content
+
+    async def ocr_instruction_via_rest(self, image_path: str, access_token: AccessToken) -> str:
+        """Распознавание инструкции по изображению (загрузка + мультимодальный запрос)."""
+        with open(image_path, "rb") as f:
+            content = f.read()
+        return await self.ocr_instruction_from_bytes(content, os.path.basename(image_path), access_token)
+
+    async def ocr_instruction_from_bytes(self, content: bytes, filename: str, access_token: AccessToken) -> str:
+        """То же, что ocr_instruction_via_rest, но изображение уже в памяти."""
+        key = _ocr_cache_key(content)
+        cached = await asyncio.to_thread(_cache_get, key)
+        if cached is not None:
+            return cached
+        file_id = await self.upload_image_bytes(content, filename, access_token)
+        resp = await self._send(
+            GIGA_API_URL,
+            access_token,
+            content_type="application/json",
+            json=build_ocr_payload(file_id),
+        )
+        if resp.status >= 400:
+            message = _ocr_error_message(resp.status, resp.body)
+            if message is not None:
+                raise ValueError(message)
+            resp.raise_for_status()
+
+        data = json.loads(resp.body)
+        _update_token_stats(data)
+        content = _extract_content(data)
+        await asyncio.to_thread(_cache_put, key, content)
+        return content
+
+    async def ocr_regions_with_text(
+        self, images: List[bytes], text_layer: str, access_token: AccessToken
+    ) -> str:
+        """Асинхронный аналог img_parse.ocr_regions_with_text: фрагменты загружаются параллельно."""
+        key = _regions_cache_key(images, text_layer)
+        cached = await asyncio.to_thread(_cache_get, key)
+        if cached is not None:
+            return cached
+        file_ids = await asyncio.gather(
+            *(
+                self.upload_image_bytes(image, f"region_{idx:02d}.jpg", access_token)
+                for idx, image in enumerate(images, start=1)
+            )
+        )
+        resp = await self._send(
+            GIGA_API_URL,
+            access_token,
+            content_type="application/json",
+            json=build_regions_payload(list(file_ids), text_layer),
+        )
+        if resp.status >= 400:
+            message = _ocr_error_message(resp.status, resp.body)
+            if message is not None:
+                raise ValueError(message)
+            resp.raise_for_status()
+
+        data = json.loads(resp.body)
+        _update_token_stats(data)
+        content = _extract_content(data)
+        await asyncio.to_thread(_cache_put, key, content)
+        return content
+
+    async def ocr_pages_batch(
+        self, images: List[bytes], page_nums: List[int], access_token: AccessToken
+    ) -> Dict[int, str]:
+        """Асинхронный аналог img_parse.ocr_pages_batch."""
+        if not images or len(images) != len(page_nums) or len(images) > MAX_IMAGES_PER_REQUEST:
+            raise ValueError(
+                f"В пакете распознавания должно быть от 1 до {MAX_IMAGES_PER_REQUEST} страниц, "
+                f"по одному изображению на страницу"
+            )
+        key = _ocr_batch_cache_key(images, page_nums)
+        cached = await asyncio.to_thread(_cache_get, key)
+        if cached is not None:
+            return split_ocr_batch_answer(cached, page_nums)
+        file_ids = await asyncio.gather(
+            *(
+                self.upload_image_bytes(image, f"page_{num:03d}.jpg", access_token)
+                for image, num in zip(images, page_nums)
+            )
+        )
+        resp = await self._send(
+            GIGA_API_URL,
+            access_token,
+            content_type="application/json",
+            json=build_ocr_batch_payload(list(file_ids), page_nums),
+        )
+        if resp.status >= 400:
+            message = _ocr_error_message(resp.status, resp.body)
+            if message is not None:
+                raise ValueError(message)
+            resp.raise_for_status()
+
+        data = json.loads(resp.body)
+        _update_token_stats(data)
+        content = _extract_content(data)
+        pages = split_ocr_batch_answer(content, page_nums)
+        await asyncio.to_thread(_cache_put, key, content)
+        return pages
@@ -0,0 +1,178 @@
+"""
+Разбиение итоговых markdown-документов пайплайна на фрагменты и выбор релевантных
+фрагментов под страницу.
+
+Поддерживаются оба формата:
+  - instructions_merged.md: разделы «## Страница NNN»;
+  - instructions_incremental.md: каждая смысловая строка с тегом [SOURCE: page XXX].
+Фрагмент — подряд идущие строки одной страницы и одного раздела (заголовки «#»),
+не длиннее MAX_CHUNK_CHARS.
+
+ContextSelector подбирает для страницы контекст в пределах бюджета токенов:
+соседние страницы и фрагменты, лексически похожие на текст страницы (TF-IDF по основам
+слов). Начало документа (head_tokens) общее для всех страниц и в подбор не входит:
+одинаковое начало промпта GigaChat берёт из кэша токенов.
+"""
+import hashlib
+import math
+import re
+from collections import Counter
+from typing import Dict, List, NamedTuple
+
+PAGE_HEADER_RE = re.compile(r"^##\s*Страница\s+(\d+)\s*$", re.MULTILINE)
+SOURCE_TAG_RE = re.compile(r"\[SOURCE:\s*page\s*(\d{1,3})\s*\]", re.IGNORECASE)
+_HEADING_RE = re.compile(r"^#{1,6}\s+(.+?)\s*$")
+_WORD_RE = re.compile(r"\w+")
+
+# Максимальная длина фрагмента, символы
+MAX_CHUNK_CHARS = 1500
+# Слова короче не учитываются при сравнении, длиннее — обрезаются до основы
+_MIN_WORD_LEN = 3
+_STEM_LEN = 6
+# Прибавка к оценке фрагментов соседних страниц: вес / расстояние в страницах
+NEIGHBOUR_WEIGHT = 0.3
+NEIGHBOUR_PAGES = 2
+
+GAP_MARK = "[...]"
+
+
+class Chunk(NamedTuple):
+    index: int
+    # Страница источника (None — текст до первой страницы, например заголовок документа)
+    page: int | None
+    # Ближайший заголовок раздела «#» над фрагментом ("" — нет)
+    section: str
+    text: str
+
+
+def split_markdown_chunks(md: str, max_chars: int = MAX_CHUNK_CHARS) -> List[Chunk]:
+    """Фрагменты документа по границам страниц (заголовки «## Страница NNN», теги SOURCE) и разделов."""
+    chunks: List[Chunk] = []
+    lines: List[str] = []
+    size = 0
+    header_page: int | None = None
+    section = ""
+    chunk_page: int | None = None
+    chunk_section = ""
+
+    def flush() -> None:
+        nonlocal lines, size
+        text = "\n".join(lines).strip()
+        if text:
+            chunks.append(Chunk(len(chunks), chunk_page, chunk_section, text))
+        lines, size = [], 0
+
+    for raw_line in md.splitlines():
+        line = raw_line.rstrip()
+        page_header = PAGE_HEADER_RE.match(line)
+        if page_header:
+            flush()
+            header_page = int(page_header.group(1))
+            section = ""
+            chunk_page, chunk_section = header_page, section
+            continue
+        heading = _HEADING_RE.match(line)
+        if heading:
+            flush()
+            section = heading.group(1)
+        tag = SOURCE_TAG_RE.search(line)
+        page = int(tag.group(1)) if tag else header_page
+        if line.strip() and (page != chunk_page or section != chunk_section or size + len(line) > max_chars):
+            flush()
+            chunk_page, chunk_section = page, section
+        lines.append(line)
+        size += len(line) + 1
+    flush()
+    return chunks
+
+
+def approx_tokens(text: str) -> int:
+    """Грубая оценка токенов без запроса к модели: ~3 символа на токен (как в giga_limits)."""
+    return len(text) // 3 + 1
+
+
+def _terms(text: str) -> Counter:
+    words = _WORD_RE.findall(SOURCE_TAG_RE.sub(" ", text).lower())
+    return Counter(word[:_STEM_LEN] for word in words if len(word) >= _MIN_WORD_LEN and not word.isdigit())
+
+
+class ContextSelector:
+    """
+    Индекс фрагментов одного документа для выбора контекста по странице.
+    chunk_tokens — размеры фрагментов в токенах (например, из token_budget);
+    по умолчанию — оценка approx_tokens.
+    head_tokens — сколько токенов начальных фрагментов документа отдать под общее
+    начало (head()); select() их не выбирает.
+    """
+
+    def __init__(self, chunks: List[Chunk], chunk_tokens: List[int] | None = None, head_tokens: int = 0) -> None:
+        self.chunks = chunks
+        self.chunk_tokens = chunk_tokens if chunk_tokens is not None else [approx_tokens(c.text) for c in chunks]
+        self.head_size = 0
+        used = 0
+        for tokens in self.chunk_tokens:
+            if used + tokens > head_tokens:
+                break
+            self.head_size += 1
+            used += tokens
+        self.document_hash = hashlib.sha256("\n".join(c.text for c in chunks).encode("utf-8")).hexdigest()
+        terms = [_terms(chunk.text) for chunk in chunks]
+        df: Counter = Counter()
+        for chunk_terms in terms:
+            df.update(chunk_terms.keys())
+        total = len(chunks)
+        self._idf: Dict[str, float] = {term: math.log((total + 1) / (count + 1)) + 1 for term, count in df.items()}
+        self._vectors = [self._vector(chunk_terms) for chunk_terms in terms]
+
+    def _vector(self, terms: Counter) -> Dict[str, float]:
+        vector = {term: count * self._idf.get(term, 0.0) for term, count in terms.items()}
+        norm = math.sqrt(sum(value * value for value in vector.values()))
+        return {term: value / norm for term, value in vector.items()} if norm else {}
+
+    def score(self, page_num: int, page_vector: Dict[str, float], chunk: Chunk) -> float:
+        vector = self._vectors[chunk.index]
+        similarity = sum(value * vector.get(term, 0.0) for term, value in page_vector.items())
+        if chunk.page is not None and 0 < abs(chunk.page - page_num) <= NEIGHBOUR_PAGES:
+            similarity += NEIGHBOUR_WEIGHT / abs(chunk.page - page_num)
+        return similarity
+
+    def head(self) -> str:
+        """Общее для всех страниц начало документа: первые head_size фрагментов."""
+        return self._format(self.chunks[:self.head_size])
+
+    def select(self, page_num: int, page_text: str, max_tokens: int) -> str:
+        """
+        Контекст для страницы page_num не больше max_tokens: фрагменты других страниц
+        (текст самой страницы и так есть в промпте, начало документа — в head()) по убыванию
+        оценки, затем в порядке документа; между несмежными фрагментами — пометка [...].
+        """
+        page_vector = self._vector(_terms(page_text))
+        candidates = sorted(
+            (chunk for chunk in self.chunks[self.head_size:] if chunk.page != page_num),
+            key=lambda chunk: (-self.score(page_num, page_vector, chunk), chunk.index),
+        )
+        selected: List[Chunk] = []
+        used = 0
+        for chunk in candidates:
+            tokens = self.chunk_tokens[chunk.index]
+            if used + tokens > max_tokens:
+                continue
+            selected.append(chunk)
+            used += tokens
+        return self._format(sorted(selected, key=lambda c: c.index))
+
+    @staticmethod
+    def _format(chunks: List[Chunk]) -> str:
+        """Фрагменты в порядке документа; между несмежными — пометка [...]."""
+        parts: List[str] = []
+        previous: Chunk | None = None
+        for chunk in chunks:
+            if previous is not None and chunk.index != previous.index + 1:
+                parts.append(GAP_MARK)
+            # У фрагментов из разделов «## Страница NNN» нет тегов — помечаем страницу
+            if chunk.page is not None and not SOURCE_TAG_RE.search(chunk.text):
+                if previous is None or previous.page != chunk.page or parts[-1] == GAP_MARK:
+                    parts.append(f"## Страница {chunk.page:03d}")
+            parts.append(chunk.text)
+            previous = chunk
+        return "\n".join(parts)
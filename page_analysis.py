@@ -0,0 +1,143 @@
+"""
+Классификация страниц PDF для выбора маршрута этапа 2.
+
+По данным PyMuPDF (встроенные изображения, векторная графика, объём текстового слоя)
+решаем, нужен ли странице мультимодальный вызов:
+  - "text"   — страница целиком представлена текстовым слоем: нет значимых изображений
+               и векторных рисунков, текста достаточно. Достаточно одного текстового
+               запроса на приведение текста к инструкции;
+  - "vision" — на странице есть скриншоты/рисунки или текстового слоя почти нет (скан):
+               нужен разбор изображения и объединение с текстовым слоем.
+
+Для страниц "vision" с отдельными скриншотами/рисунками на фоне текста классификатор
+также возвращает их области (figure_regions): этап 2 может отправить модели только
+вырезанные области вместе с текстовым слоем, а не всю страницу.
+
+Пороги подобраны консервативно: при сомнении страница уходит в "vision".
+"""
+from typing import Dict, List, NamedTuple, Tuple
+
+import fitz
+
+ROUTE_TEXT = "text"
+ROUTE_VISION = "vision"
+
+# Меньше стольких символов текста — вероятно, скан или страница-картинка
+MIN_TEXT_CHARS = 40
+# Изображение значимо, если занимает не меньше этой доли страницы (логотипы и значки не в счёт)
+MIN_IMAGE_AREA_RATIO = 0.02
+# Доля страницы под векторной графикой (схемы, нарисованные экраны), начиная с которой нужен vision
+MIN_DRAWING_AREA_RATIO = 0.05
+# Фигуры тоньше этого (pt) — линии таблиц, подчёркивания, разделители; на смысл не влияют
+THIN_DRAWING_PT = 3.0
+# Фигуры почти во всю страницу — фон или рамка
+BACKGROUND_AREA_RATIO = 0.9
+
+
+# Лимит GigaChat: одно изображение на сообщение и до 10 изображений в запросе
+MAX_REGIONS = 10
+# Если области рисунков покрывают больше этой доли страницы, вырезать их нет смысла
+MAX_REGIONS_AREA_RATIO = 0.6
+# Отступ вокруг области (pt), чтобы не обрезать края и подписи; он же склеивает соседние фигуры
+REGION_PADDING_PT = 6.0
+# Страницы со слишком сложной векторной графикой не режем: слияние фигур дорогое, а толку мало
+MAX_DRAWINGS_FOR_REGIONS = 2000
+
+
+class PageRoute(NamedTuple):
+    route: str
+    reason: str
+    metrics: Dict[str, float]
+    # Области изображений и рисунков (x0, y0, x1, y1) для вырезания; пусто — отправлять страницу целиком
+    regions: List[Tuple[float, float, float, float]] = []
+
+
+def classify_page(page) -> PageRoute:
+    """Маршрут этапа 2 для страницы fitz.Page."""
+    page_rect = page.rect
+    page_area = max(page_rect.width * page_rect.height, 1.0)
+
+    text_chars = len("".join(page.get_text("text").split()))
+
+    # Изображения: get_images() — быстрый ответ «есть ли вообще», get_image_info() — где они стоят
+    image_ratio = 0.0
+    images = 0
+    image_rects = []
+    if page.get_images(full=True):
+        for info in page.get_image_info():
+            bbox = page_rect & fitz.Rect(info["bbox"])
+            if bbox.is_empty:
+                continue
+            ratio = bbox.width * bbox.height / page_area
+            if ratio >= MIN_IMAGE_AREA_RATIO:
+                images += 1
+                image_ratio += ratio
+                image_rects.append(bbox)
+
+    drawing_ratio = 0.0
+    drawing_rects = []
+    for drawing in page.get_drawings():
+        rect = page_rect & drawing["rect"]
+        if rect.is_empty or rect.width < THIN_DRAWING_PT or rect.height < THIN_DRAWING_PT:
+            continue
+        ratio = rect.width * rect.height / page_area
+        if ratio >= BACKGROUND_AREA_RATIO:
+            continue
+        drawing_ratio += ratio
+        drawing_rects.append(rect)
+
+    metrics = {
+        "text_chars": text_chars,
+        "images": images,
+        "image_ratio": round(min(image_ratio, 1.0), 4),
+        "drawing_ratio": round(min(drawing_ratio, 1.0), 4),
+    }
+
+    if text_chars < MIN_TEXT_CHARS:
+        # Скан: текстового слоя нет, нужна вся страница
+        return PageRoute(ROUTE_VISION, f"мало текста ({text_chars} символов), возможно скан", metrics)
+    if images or drawing_ratio >= MIN_DRAWING_AREA_RATIO:
+        regions = []
+        if len(drawing_rects) <= MAX_DRAWINGS_FOR_REGIONS:
+            regions = figure_regions(page_rect, image_rects + drawing_rects)
+        reason = (
+            f"изображений на странице: {images}"
+            if images
+            else f"векторная графика: {drawing_ratio:.0%} страницы"
+        )
+        return PageRoute(ROUTE_VISION, reason, metrics, regions)
+    return PageRoute(ROUTE_TEXT, "только текст", metrics)
+
+
+def figure_regions(page_rect, rects: List) -> List[Tuple[float, float, float, float]]:
+    """
+    Области рисунков для вырезания: прямоугольники изображений и фигур расширяются
+    на REGION_PADDING_PT и сливаются, пока пересекаются. Мелкие области (значки)
+    отбрасываются. Пустой список — вырезать не стоит (областей слишком много
+    или они покрывают почти всю страницу), отправляется страница целиком.
+    """
+    page_area = max(page_rect.width * page_rect.height, 1.0)
+    pad = (-REGION_PADDING_PT, -REGION_PADDING_PT, REGION_PADDING_PT, REGION_PADDING_PT)
+    merged = [(fitz.Rect(rect) + pad) & page_rect for rect in rects]
+    changed = True
+    while changed:
+        changed = False
+        result = []
+        for rect in merged:
+            for i, other in enumerate(result):
+                if rect.intersects(other):
+                    result[i] = other | rect
+                    changed = True
+                    break
+            else:
+                result.append(rect)
+        merged = result
+
+    regions = [rect for rect in merged if rect.width * rect.height / page_area >= MIN_IMAGE_AREA_RATIO]
+    if not regions or len(regions) > MAX_REGIONS:
+        return []
+    if sum(rect.width * rect.height for rect in regions) / page_area > MAX_REGIONS_AREA_RATIO:
+        return []
+    # Порядок чтения: сверху вниз, слева направо
+    regions.sort(key=lambda rect: (round(rect.y0), rect.x0))
+    return [(round(r.x0, 2), round(r.y0, 2), round(r.x1, 2), round(r.y1, 2)) for r in regions]
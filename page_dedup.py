@@ -0,0 +1,123 @@
+"""
+Поиск одинаковых и почти одинаковых страниц во всём наборе PDF (обложки, юридические
+подвалы, повторяющиеся скриншоты), чтобы GigaChat обрабатывал каждую такую страницу один раз.
+
+Дубликатом считается страница с тем же маршрутом этапа 2, тем же текстовым слоем
+(точный хэш нормализованного текста, text_fp) и, для страниц с разбором изображения,
+похожим изображением: расстояние Хэмминга между перцептивными хэшами (dHash) не больше
+порога. У страниц почти без текстового слоя (сканы) одинаковый text_fp ничего не говорит
+о содержании, поэтому для них нужно точное совпадение изображения (image_fp). Канонической считается первая встреченная страница (в порядке PDF и страниц);
+её instruction.txt копируется в дубликаты.
+"""
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import fitz
+
+# Размер сетки dHash: 9x8 пикселей -> 64 бита
+_DHASH_WIDTH = 9
+_DHASH_HEIGHT = 8
+# Ширина уменьшенной копии страницы, по которой считается dHash
+_DHASH_RENDER_WIDTH = 90
+# Порог расстояния Хэмминга (из 64 бит) для «почти одинаковых» изображений
+DHASH_MAX_DISTANCE = 4
+# Меньше стольких символов текстового слоя (без пробелов) — страница считается сканом
+DEDUP_MIN_TEXT_CHARS = 40
+
+
+def image_dhash(page) -> str:
+    """
+    Перцептивный хэш страницы (difference hash): уменьшенная серая копия делится
+    на сетку 9x8, бит = «ячейка светлее соседней справа». Устойчив к пересжатию,
+    небольшому сдвигу цвета и разрешению рендеринга. 16 hex-символов.
+    """
+    scale = _DHASH_RENDER_WIDTH / max(page.rect.width, 1.0)
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), colorspace=fitz.csGRAY, alpha=False)
+    width, height, stride, samples = pix.width, pix.height, pix.stride, pix.samples
+
+    cells = []
+    for row in range(_DHASH_HEIGHT):
+        y0 = row * height // _DHASH_HEIGHT
+        y1 = max(y0 + 1, (row + 1) * height // _DHASH_HEIGHT)
+        for col in range(_DHASH_WIDTH):
+            x0 = col * width // _DHASH_WIDTH
+            x1 = max(x0 + 1, (col + 1) * width // _DHASH_WIDTH)
+            total = sum(sum(samples[y * stride + x0:y * stride + x1]) for y in range(y0, y1))
+            cells.append(total / ((y1 - y0) * (x1 - x0)))
+
+    bits = 0
+    for row in range(_DHASH_HEIGHT):
+        for col in range(_DHASH_WIDTH - 1):
+            left = cells[row * _DHASH_WIDTH + col]
+            right = cells[row * _DHASH_WIDTH + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return f"{bits:016x}"
+
+
+def hamming_distance(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def _text_chars(info: Dict) -> int:
+    """Объём текстового слоя страницы (page.txt) без пробелов; считается один раз."""
+    if "text_chars" not in info:
+        text_path = info.get("text_path")
+        text = Path(text_path).read_text(encoding="utf-8") if text_path and Path(text_path).exists() else ""
+        info["text_chars"] = len("".join(text.split()))
+    return info["text_chars"]
+
+
+class PageDedupIndex:
+    """
+    Индекс страниц на весь прогон (все PDF каталога).
+    assign() делит страницы очередного PDF на канонические и дубликаты уже известных;
+    mark_done() отмечает канонические страницы, для которых instruction.txt получен,
+    — только из них результат копируется в дубликаты.
+    """
+
+    def __init__(self, max_distance: int = DHASH_MAX_DISTANCE, min_text_chars: int = DEDUP_MIN_TEXT_CHARS) -> None:
+        self.max_distance = max_distance
+        self.min_text_chars = min_text_chars
+        # (маршрут, text_fp) -> канонические страницы с этим текстом
+        self._buckets: Dict[Tuple[str, str], List[Dict]] = {}
+        self._done: set = set()
+        self._lock = threading.Lock()
+
+    def _match(self, info: Dict) -> Dict | None:
+        for canonical in self._buckets.get((info["route"], info["text_fp"]), []):
+            if info["route"] == "text":
+                return canonical
+            if _text_chars(info) < self.min_text_chars:
+                # Разные сканы без текста близки по dHash (белый лист, общая вёрстка)
+                if canonical["image_fp"] == info["image_fp"]:
+                    return canonical
+                continue
+            if hamming_distance(canonical["image_phash"], info["image_phash"]) <= self.max_distance:
+                return canonical
+        return None
+
+    def assign(self, page_infos: List[Dict]) -> Tuple[List[Dict], List[Tuple[Dict, Dict]]]:
+        """
+        Возвращает (канонические страницы, [(дубликат, его каноническая страница)]).
+        Каноническая страница может быть из этого же или из ранее обработанного PDF.
+        """
+        canonical_pages: List[Dict] = []
+        duplicates: List[Tuple[Dict, Dict]] = []
+        with self._lock:
+            for info in page_infos:
+                canonical = self._match(info)
+                if canonical is None:
+                    self._buckets.setdefault((info["route"], info["text_fp"]), []).append(info)
+                    canonical_pages.append(info)
+                else:
+                    duplicates.append((info, canonical))
+        return canonical_pages, duplicates
+
+    def mark_done(self, infos: List[Dict]) -> None:
+        with self._lock:
+            self._done.update(id(info) for info in infos)
+
+    def is_done(self, info: Dict) -> bool:
+        with self._lock:
+            return id(info) in self._done
@@ -0,0 +1,91 @@
+"""
+Рендеринг страниц PDF в JPEG под бюджет размера.
+
+Вместо фиксированных 150 DPI и сохранения на диск:
+  - DPI выбирается по размеру страницы (длинная сторона ~ target_long_px пикселей)
+    и плотности текста (мелкий плотный текст рендерится чётче);
+  - JPEG кодируется в памяти (Pixmap.tobytes), качество снижается ступенями,
+    а если и этого мало — снижается DPI, пока картинка не уложится в target_bytes;
+  - готовые байты можно сразу отдавать в загрузку (img_parse.ocr_instruction_from_bytes),
+    page.jpg на диске — необязательный артефакт.
+
+Так загрузки меньше, распознавание быстрее, а 413 на больших страницах не возникает.
+"""
+import hashlib
+import math
+import os
+from dataclasses import dataclass
+from typing import NamedTuple, Tuple
+
+# img_parse загружает .env, поэтому импортируется до чтения настроек ниже
+from img_parse import MAX_IMAGE_BYTES
+
+# Настройки по умолчанию
+GIGA_IMAGE_TARGET_KB = int(os.getenv("GIGA_IMAGE_TARGET_KB", "800"))
+GIGA_RENDER_MIN_DPI = int(os.getenv("GIGA_RENDER_MIN_DPI", "72"))
+GIGA_RENDER_MAX_DPI = int(os.getenv("GIGA_RENDER_MAX_DPI", "200"))
+
+# Символов текста на квадратный дюйм, начиная с которых текст считаем мелким и плотным
+DENSE_TEXT_CHARS_PER_SQIN = 25.0
+
+
+@dataclass(frozen=True)
+class RenderPolicy:
+    """
+    target_bytes   — бюджет размера JPEG;
+    target_long_px — желаемый размер длинной стороны страницы в пикселях;
+    min_dpi, max_dpi — границы DPI;
+    qualities      — ступени качества JPEG, от лучшего к худшему;
+    dense_boost    — во сколько раз поднять DPI для страниц с плотным мелким текстом.
+    """
+
+    target_bytes: int = GIGA_IMAGE_TARGET_KB * 1024
+    target_long_px: int = 1800
+    min_dpi: int = GIGA_RENDER_MIN_DPI
+    max_dpi: int = GIGA_RENDER_MAX_DPI
+    qualities: Tuple[int, ...] = (85, 75, 65, 50)
+    dense_boost: float = 1.25
+
+    def choose_dpi(self, page_rect, text_chars: int = 0) -> int:
+        """Начальный DPI по размеру страницы и плотности текста."""
+        long_in = max(page_rect.width, page_rect.height, 1.0) / 72.0
+        dpi = self.target_long_px / long_in
+        area_sqin = max(page_rect.width * page_rect.height / (72.0 * 72.0), 1e-6)
+        if text_chars / area_sqin >= DENSE_TEXT_CHARS_PER_SQIN:
+            dpi *= self.dense_boost
+        return int(min(self.max_dpi, max(self.min_dpi, round(dpi))))
+
+
+class RenderedPage(NamedTuple):
+    data: bytes
+    dpi: int
+    quality: int
+    # Хэш пикселей, а не JPEG: не зависит от версии кодировщика и качества
+    samples_sha256: str
+
+
+def encode_page_jpeg(page, dpi: int, quality: int, clip=None) -> bytes:
+    """
+    Детерминированный рендер страницы (или её области clip) с заданными DPI и качеством:
+    для вырезанных областей и для повторного получения тех же байтов без файла на диске.
+    """
+    return page.get_pixmap(dpi=dpi, clip=clip).tobytes("jpeg", jpg_quality=quality)
+
+
+def render_page_jpeg(page, policy: RenderPolicy, text_chars: int = 0) -> RenderedPage:
+    """Рендер fitz.Page в JPEG, укладывающийся в policy.target_bytes (насколько позволяет min_dpi)."""
+    budget = min(policy.target_bytes, MAX_IMAGE_BYTES)
+    dpi = policy.choose_dpi(page.rect, text_chars)
+    while True:
+        pix = page.get_pixmap(dpi=dpi)
+        for quality in policy.qualities:
+            data = pix.tobytes("jpeg", jpg_quality=quality)
+            if len(data) <= budget:
+                return RenderedPage(data, dpi, quality, hashlib.sha256(pix.samples).hexdigest())
+        if dpi <= policy.min_dpi:
+            # Меньше уже некуда: отдаём как есть, лимит MAX_IMAGE_BYTES проверит загрузчик
+            # (img_parse.upload_image_bytes)
+            return RenderedPage(data, dpi, quality, hashlib.sha256(pix.samples).hexdigest())
+        # Размер JPEG примерно пропорционален числу пикселей, то есть квадрату DPI
+        scale = math.sqrt(budget / len(data)) * 0.95
+        dpi = max(policy.min_dpi, min(dpi - 1, int(dpi * scale)))
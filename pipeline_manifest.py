@@ -0,0 +1,250 @@
+"""
+Манифест обработки одного PDF: out/<pdf>/manifest.json.
+
+Хранит, какие этапы уже выполнены и по каким входным данным (хэши),
+чтобы перезапуск после сбоя или после обновления PDF (--resume) пропускал
+готовую и актуальную работу:
+  - этап 1: хэш исходного PDF и настроек рендеринга, список страниц, отпечатки каждой
+    страницы (текстовый слой и отрендеренное изображение), параметры скриншота
+    (DPI, качество JPEG, размер, сохранён ли page.jpg), области скриншотов/рисунков
+    для вырезания и маршрут этапа 2 с причиной
+    ("text" — только текстовый слой, "vision" — нужен разбор изображения);
+  - этап 2: по каждой странице — хэш входа (отпечатки страницы + маршрут + промпты),
+    фактический маршрут и хэш получившегося instruction.txt;
+  - этап 4: по каждой странице — хэш цепочки инструкций 1..N, чтобы при
+    изменении страницы N пересчитывать накопленный контекст только с неё;
+  - этапы 3–4 по документу: хэш входа (все instruction.txt + промпты) и путь к результату.
+
+Манифест сохраняется атомарно (временный файл + os.replace), поэтому падение
+процесса в любой момент оставляет его согласованным. Записи этапов и этапа 1
+сохраняются сразу, постраничные — не чаще раза в GIGA_MANIFEST_SAVE_SECONDS
+(остальное дописывает flush() в конце этапа): при сбое теряются лишь последние
+отметки, и эти страницы при --resume просто обрабатываются заново.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# Не чаще какого интервала, секунды, сохранять постраничные записи (0 — после каждой)
+MANIFEST_SAVE_INTERVAL = float(os.getenv("GIGA_MANIFEST_SAVE_SECONDS", "2"))
+
+
+def file_hash(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def text_hash(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        # Разделитель, чтобы ("ab", "c") и ("a", "bc") давали разные хэши
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def text_fingerprint(text: str) -> str:
+    """
+    Отпечаток текстового слоя страницы: пробелы и переносы нормализуются,
+    чтобы перекомпоновка строк без изменения текста не считалась изменением.
+    """
+    return text_hash(" ".join(text.split()))
+
+
+class PipelineManifest:
+    """Манифест одного PDF. Методы потокобезопасны (этап 2 пишет из пула потоков)."""
+
+    def __init__(self, pdf_out_dir: Path, save_interval: float = MANIFEST_SAVE_INTERVAL) -> None:
+        self.dir = Path(pdf_out_dir)
+        self.path = self.dir / MANIFEST_NAME
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = 0.0
+        self.data = self._load()
+
+    def _load(self) -> dict:
+        if self.path.exists():
+            try:
+                data = json.loads(self.path.read_text(encoding="utf-8"))
+            except ValueError:
+                data = None
+            if isinstance(data, dict) and data.get("version") == MANIFEST_VERSION:
+                data.setdefault("pages", {})
+                data.setdefault("stages", {})
+                return data
+        return {"version": MANIFEST_VERSION, "pdf": {}, "pages": {}, "stages": {}}
+
+    def _save_locked(self) -> None:
+        self.dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(self.data, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def _save_throttled_locked(self) -> None:
+        """Постраничная запись: файл переписывается, только если прошёл save_interval."""
+        self._dirty = True
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self._save_locked()
+
+    def flush(self) -> None:
+        """Сохранить отложенные постраничные записи."""
+        with self._lock:
+            if self._dirty:
+                self._save_locked()
+
+    def _page(self, page_num: int) -> dict:
+        return self.data["pages"].setdefault(f"{page_num:03d}", {})
+
+    # ---------- Этап 1 ----------
+
+    def stage1_page_infos(self, pdf_hash: str, pdf_path: Path, render_key: str) -> List[Dict] | None:
+        """
+        page_infos из прошлого прогона, если PDF и настройки рендеринга не изменились
+        и файлы страниц на месте; иначе None (страницы нужно извлечь заново).
+        """
+        with self._lock:
+            pdf = self.data.get("pdf") or {}
+            if pdf.get("sha256") != pdf_hash or not pdf.get("page_count"):
+                return None
+            if pdf.get("render_key") != render_key:
+                return None
+            page_infos = []
+            for page_num in range(1, pdf["page_count"] + 1):
+                entry = self.data["pages"].get(f"{page_num:03d}", {}).get("stage1")
+                if not entry:
+                    return None
+                page_dir = self.dir / entry["dir"]
+                text_path = page_dir / "page.txt"
+                image_path = page_dir / "page.jpg" if entry.get("image_saved") else None
+                if not text_path.exists() or (image_path is not None and not image_path.exists()):
+                    return None
+                if not all(entry.get(key) for key in ("text_fp", "image_fp", "image_phash", "route")):
+                    return None
+                if "regions" not in entry:
+                    return None
+                if image_path is not None and not all(
+                    (page_dir / f"region_{idx:02d}.jpg").exists()
+                    for idx in range(1, len(entry["regions"]) + 1)
+                ):
+                    return None
+                page_infos.append(
+                    {
+                        "page_num": page_num,
+                        "dir": page_dir,
+                        "pdf_path": pdf_path,
+                        "text_path": text_path,
+                        "image_path": image_path,
+                        "dpi": entry["dpi"],
+                        "jpeg_quality": entry["jpeg_quality"],
+                        "image_bytes": entry["image_bytes"],
+                        "regions": entry["regions"],
+                        "region_bytes": entry["region_bytes"],
+                        "text_fp": entry["text_fp"],
+                        "image_fp": entry["image_fp"],
+                        "image_phash": entry["image_phash"],
+                        "route": entry["route"],
+                        "route_reason": entry.get("route_reason", ""),
+                    }
+                )
+            return page_infos
+
+    def previous_fingerprints(self, page_num: int) -> tuple[str | None, str | None]:
+        """Отпечатки страницы из прошлого прогона (до record_stage1 текущего)."""
+        with self._lock:
+            entry = self.data["pages"].get(f"{page_num:03d}", {}).get("stage1") or {}
+        return entry.get("text_fp"), entry.get("image_fp")
+
+    def record_stage1(self, pdf_path: Path, pdf_hash: str, page_infos: List[Dict], render_key: str) -> None:
+        with self._lock:
+            self.data["pdf"] = {
+                "name": pdf_path.name,
+                "sha256": pdf_hash,
+                "render_key": render_key,
+                "page_count": len(page_infos),
+                "updated_at": time.time(),
+            }
+            # Страницы, которых больше нет в PDF, из манифеста убираем
+            keep = {f"{info['page_num']:03d}" for info in page_infos}
+            for key in list(self.data["pages"]):
+                if key not in keep:
+                    del self.data["pages"][key]
+            for info in page_infos:
+                self._page(info["page_num"])["stage1"] = {
+                    "dir": info["dir"].name,
+                    "image_saved": info["image_path"] is not None,
+                    "dpi": info["dpi"],
+                    "jpeg_quality": info["jpeg_quality"],
+                    "image_bytes": info["image_bytes"],
+                    "regions": info["regions"],
+                    "region_bytes": info["region_bytes"],
+                    "text_fp": info["text_fp"],
+                    "image_fp": info["image_fp"],
+                    "image_phash": info["image_phash"],
+                    "route": info["route"],
+                    "route_reason": info["route_reason"],
+                }
+            self._save_locked()
+
+    def pdf_info(self) -> dict:
+        """Сведения об исходном PDF из этапа 1: имя, sha256, число страниц."""
+        with self._lock:
+            return dict(self.data.get("pdf") or {})
+
+    # ---------- Постраничные этапы ----------
+
+    def page_done(self, page_num: int, stage: str, input_hash: str, output_path: Path) -> bool:
+        """Этап страницы выполнен по тем же входным данным, и результат не тронут."""
+        with self._lock:
+            entry = self.data["pages"].get(f"{page_num:03d}", {}).get(stage)
+        if not entry or entry.get("input_sha256") != input_hash:
+            return False
+        if not output_path.exists():
+            return False
+        return file_hash(output_path) == entry.get("output_sha256")
+
+    def record_page(self, page_num: int, stage: str, input_hash: str, output_path: Path, **extra) -> None:
+        entry = {
+            "input_sha256": input_hash,
+            "output_sha256": file_hash(output_path),
+            "completed_at": time.time(),
+            **extra,
+        }
+        with self._lock:
+            self._page(page_num)[stage] = entry
+            self._save_throttled_locked()
+
+    # ---------- Этапы по документу ----------
+
+    def stage_done(self, stage: str, input_hash: str, output_path: Path) -> bool:
+        with self._lock:
+            entry = self.data["stages"].get(stage)
+        if not entry or entry.get("input_sha256") != input_hash:
+            return False
+        if not output_path.exists():
+            return False
+        return file_hash(output_path) == entry.get("output_sha256")
+
+    def record_stage(self, stage: str, input_hash: str, output_path: Path, **extra) -> None:
+        entry = {
+            "input_sha256": input_hash,
+            "output": output_path.name,
+            "output_sha256": file_hash(output_path),
+            "completed_at": time.time(),
+            **extra,
+        }
+        with self._lock:
+            self.data["stages"][stage] = entry
+            self._save_locked()
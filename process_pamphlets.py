@@ -1,5 +1,12 @@
 import argparse
+import asyncio
+import hashlib
 import os
+import re
+import shutil
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
 from pathlib import Path
 from typing import List, Dict
 
@@ -11,71 +18,247 @@ except ImportError as e:
         "Установите её командой: pip install pymupdf"
     ) from e
 
-from img_parse import get_creds, giga_free_answer, ocr_instruction_via_rest, get_token_stats
+import requests
 
+from batch_mode import run_chat_batches
+from chunk_export import export_and_index
+from file_registry import FileRegistry
+from giga_limits import ModelLimit, RateLimiter
+from img_parse import (
+    GIGA_POOL_SIZE,
+    MAX_IMAGES_PER_REQUEST,
+    SYS_PROMPT,
+    TEXT_MODEL,
+    VISION_MODEL,
+    AccessToken,
+    TokenManager,
+    configure_client,
+    get_client,
+    get_token_stats,
+    _cache_get,
+    _cache_put,
+    _ocr_cache_key,
+    _regions_cache_key,
+    _text_cache_key,
+    build_ocr_payload,
+    build_regions_payload,
+    build_text_payload,
+    cleanup_uploaded_files,
+    giga_free_answer,
+    giga_free_answer_stream,
+    ocr_instruction_from_bytes,
+    ocr_pages_batch,
+    ocr_instruction_via_rest,
+    ocr_regions_with_text,
+    set_file_registry,
+    set_response_cache,
+    stream_to_file,
+    sync_file_registry,
+    upload_image_bytes,
+)
+from page_analysis import ROUTE_TEXT, ROUTE_VISION, classify_page
+from page_dedup import PageDedupIndex, image_dhash
+from page_render import RenderPolicy, encode_page_jpeg, render_page_jpeg
+from pipeline_manifest import PipelineManifest, file_hash, text_fingerprint, text_hash
+from response_cache import ResponseCache
+from run_metrics import RunMetrics, in_scope, metrics_scope, set_run_metrics
+from token_budget import (
+    COMPRESS,
+    GIGA_IMAGE_PROMPT_TOKENS,
+    PROCEED,
+    SPLIT,
+    RunProjection,
+    TokenBudget,
+)
 
-def stage1_extract_pages(pdf_path: Path, out_root: Path) -> List[Dict]:
+
+def _stage1_render_range(
+    pdf_path: Path,
+    pdf_dir: Path,
+    start: int,
+    stop: int,
+    policy: RenderPolicy,
+    save_images: bool = True,
+) -> List[Dict]:
+    """
+    Рендеринг страниц [start, stop) одного PDF (нумерация с нуля).
+    Выполняется в процессе пула этапа 1, поэтому открывает свой экземпляр fitz-документа:
+    документы PyMuPDF нельзя передавать между процессами.
+    """
+    page_infos: List[Dict] = []
+    with fitz.open(pdf_path) as doc:
+        for page_index in range(start + 1, stop + 1):
+            page = doc[page_index - 1]
+            page_dir = pdf_dir / f"page_{page_index:03d}"
+            page_dir.mkdir(exist_ok=True)
+
+            # Текстовый слой
+            text = page.get_text("text")
+            text_path = page_dir / "page.txt"
+            text_path.write_text(text, encoding="utf-8")
+
+            # Нужен ли странице разбор изображения на этапе 2
+            route = classify_page(page)
+            # Перцептивный хэш для поиска почти одинаковых страниц во всём наборе PDF
+            image_phash = image_dhash(page)
+
+            # Скриншот страницы: DPI и качество JPEG подбираются под бюджет размера
+            rendered = render_page_jpeg(page, policy, text_chars=int(route.metrics["text_chars"]))
+            image_path = page_dir / "page.jpg"
+            if save_images:
+                image_path.write_bytes(rendered.data)
+            else:
+                # Старый скриншот от прошлого прогона не соответствовал бы странице
+                image_path.unlink(missing_ok=True)
+
+            # Области скриншотов и рисунков: этап 2 отправит модели только их
+            for old_region in page_dir.glob("region_*.jpg"):
+                old_region.unlink()
+            regions = [list(region) for region in route.regions]
+            region_bytes = 0
+            for region_idx, region in enumerate(regions, start=1):
+                data = encode_page_jpeg(page, rendered.dpi, rendered.quality, clip=fitz.Rect(region))
+                region_bytes += len(data)
+                if save_images:
+                    (page_dir / f"region_{region_idx:02d}.jpg").write_bytes(data)
+
+            page_infos.append(
+                {
+                    "page_num": page_index,
+                    "dir": page_dir,
+                    "pdf_path": pdf_path,
+                    "text_path": text_path,
+                    # None — скриншот не сохранён, этап 2 рендерит его в память заново
+                    "image_path": image_path if save_images else None,
+                    "dpi": rendered.dpi,
+                    "jpeg_quality": rendered.quality,
+                    "image_bytes": len(rendered.data),
+                    "regions": regions,
+                    "region_bytes": region_bytes,
+                    "text_fp": text_fingerprint(text),
+                    "image_fp": rendered.samples_sha256,
+                    "image_phash": image_phash,
+                    "route": route.route,
+                    "route_reason": route.reason,
+                }
+            )
+    return page_infos
+
+
+# Не больше стольких страниц в одной задаче пула этапа 1: мелкие задачи лучше
+# распределяются между процессами, когда параллельно рендерится несколько PDF
+STAGE1_MAX_CHUNK_PAGES = 32
+
+
+def stage1_submit_pages(
+    pdf_path: Path,
+    out_root: Path,
+    pool: Executor,
+    workers: int,
+    policy: RenderPolicy,
+    save_images: bool = True,
+) -> List[Future]:
+    """
+    Подготовка каталога PDF и отправка диапазонов его страниц в пул процессов.
+    Возвращает futures по порядку диапазонов; результат собирает stage1_collect_pages.
+    Так можно поставить в пул страницы нескольких PDF сразу и рендерить их параллельно.
+    """
+    with fitz.open(pdf_path) as doc:
+        page_count = doc.page_count
+    pdf_dir = out_root / pdf_path.stem
+    pdf_dir.mkdir(parents=True, exist_ok=True)
+    _remove_stale_page_dirs(pdf_dir, page_count)
+
+    chunk = max(1, min(STAGE1_MAX_CHUNK_PAGES, -(-page_count // (max(1, workers) * 2))))
+    return [
+        pool.submit(
+            _stage1_render_range,
+            pdf_path,
+            pdf_dir,
+            start,
+            min(start + chunk, page_count),
+            policy,
+            save_images,
+        )
+        for start in range(0, page_count, chunk)
+    ]
+
+
+def stage1_collect_pages(futures: List[Future]) -> List[Dict]:
+    page_infos: List[Dict] = []
+    for future in futures:
+        page_infos.extend(future.result())
+    return page_infos
+
+
+def stage1_extract_pages(
+    pdf_path: Path,
+    out_root: Path,
+    workers: int = 1,
+    policy: RenderPolicy | None = None,
+    save_images: bool = True,
+) -> List[Dict]:
     """
     Этап 1.
     Для каждого PDF:
       - создаём каталог <out_root>/<pdf_name_without_ext>/
       - для каждой страницы создаём подкаталог page_XXX/
       - сохраняем текстовый слой страницы в page_XXX/page.txt
-      - сохраняем скриншот страницы в page_XXX/page.jpg
+      - рендерим скриншот страницы в JPEG под бюджет размера (page_render.RenderPolicy:
+        DPI по размеру страницы и плотности текста, качество и DPI снижаются до бюджета)
+        и сохраняем его в page_XXX/page.jpg (при save_images=False не сохраняем:
+        этап 2 получит те же байты повторным рендерингом в память)
+      - для страниц со скриншотами/рисунками на фоне текста вырезаем их области
+        в page_XXX/region_NN.jpg (page_analysis.figure_regions)
+      - считаем отпечатки страницы: текстового слоя (text_fp) и отрендеренного
+        изображения (image_fp) — по ним этап 2 понимает, изменилась ли страница
+      - классифицируем страницу (page_analysis.classify_page): route = "text", если
+        достаточно текстового слоя, или "vision", если нужен разбор изображения
+    Каталоги page_XXX страниц, которых больше нет в PDF, удаляются.
     Возвращаем список словарей с путями для дальнейших этапов.
-    """
-    doc = fitz.open(pdf_path)
-    pdf_dir = out_root / pdf_path.stem
-    pdf_dir.mkdir(parents=True, exist_ok=True)
 
-    page_infos: List[Dict] = []
+    workers > 1 — диапазоны страниц рендерятся в пуле из workers процессов
+    (рендеринг упирается в CPU, потоки из-за GIL не помогают); результат тот же.
+    """
+    policy = policy or RenderPolicy()
+    if workers <= 1:
+        with fitz.open(pdf_path) as doc:
+            page_count = doc.page_count
+        pdf_dir = out_root / pdf_path.stem
+        pdf_dir.mkdir(parents=True, exist_ok=True)
+        _remove_stale_page_dirs(pdf_dir, page_count)
+        return _stage1_render_range(pdf_path, pdf_dir, 0, page_count, policy, save_images)
 
-    for page_index, page in enumerate(doc, start=1):
-        page_dir = pdf_dir / f"page_{page_index:03d}"
-        page_dir.mkdir(exist_ok=True)
-
-        # Текстовый слой
-        text = page.get_text("text")
-        text_path = page_dir / "page.txt"
-        text_path.write_text(text, encoding="utf-8")
-
-        # Скриншот страницы
-        pix = page.get_pixmap(dpi=150)
-        image_path = page_dir / "page.jpg"
-        pix.save(str(image_path))
-
-        page_infos.append(
-            {
-                "page_num": page_index,
-                "dir": page_dir,
-                "text_path": text_path,
-                "image_path": image_path,
-            }
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return stage1_collect_pages(
+            stage1_submit_pages(pdf_path, out_root, pool, workers, policy, save_images)
         )
 
-    return page_infos
 
+_PAGE_DIR_RE = re.compile(r"^page_(\d+)$")
 
-def stage2_build_instruction_for_page(
-    text_path: Path,
-    image_path: Path,
-    access_token: str,
-) -> str:
-    """
-    Этап 2.
-    1) Распознаём скриншот страницы через GigaChat (ocr_instruction_via_rest).
-    2) Объединяем текстовый слой и распознанный текст в единую инструкцию
-       вторым запросом к GigaChat (giga_free_answer).
-    Возвращаем итоговую инструкцию как строку.
-    """
-    # 2.1. Получаем описание по скриншоту (мультимодальный вызов)
-    ocr_description = ocr_instruction_via_rest(str(image_path), access_token)
 
-    # 2.2. Читаем текстовый слой страницы
-    text_layer = text_path.read_text(encoding="utf-8")
+def _remove_stale_page_dirs(pdf_dir: Path, page_count: int) -> None:
+    """Удаляем page_XXX с номерами больше числа страниц (PDF стал короче)."""
+    for page_dir in pdf_dir.iterdir():
+        m = _PAGE_DIR_RE.match(page_dir.name)
+        if m and page_dir.is_dir() and int(m.group(1)) > page_count:
+            shutil.rmtree(page_dir)
+
+
+# Системный промпт запроса на объединение текстового слоя и распознанного скриншота
+STAGE2_MERGE_SYS_PROMPT = (
+    "Ты опытный методолог и сотрудник кредитного отдела банка. "
+    "Твоя задача — строго и аккуратно объединять несколько версий одной и той же инструкции "
+    "в единый текст БЕЗ добавления новых смыслов. "
+    "Любая фраза, которой нет в исходных текстах, считается ошибкой. "
+    "Не придумывай примеры, рекомендации, служебные фразы и дополнительный функционал."
+)
+
 
-    # 2.3. Формируем запрос на объединение
-    merge_question = (
+def build_merge_question(text_layer: str, ocr_description: str) -> str:
+    """Запрос на объединение двух версий одной страницы (текстовый слой + скриншот)."""
+    return (
         "У тебя есть две версии ОДНОЙ И ТОЙ ЖЕ страницы инструкции по работе в АС.\n\n"
         "Первая версия – текстовый слой страницы (из PDF):\n"
         "----------------------------------------\n"
@@ -100,23 +283,565 @@ def stage2_build_instruction_for_page(
         "5) Если информации мало, просто перепиши её аккуратно и ничего не добавляй.\n"
     )
 
-    sys_prompt_merge = (
-        "Ты опытный методолог и сотрудник кредитного отдела банка. "
-        "Твоя задача — строго и аккуратно объединять несколько версий одной и той же инструкции "
-        "в единый текст БЕЗ добавления новых смыслов. "
-        "Любая фраза, которой нет в исходных текстах, считается ошибкой. "
-        "Не придумывай примеры, рекомендации, служебные фразы и дополнительный функционал."
-    )
 
+def stage2_build_instruction_for_page(
+    text_path: Path,
+    image_path: Path,
+    access_token: AccessToken,
+    image_bytes: bytes | None = None,
+) -> str:
+    """
+    Этап 2.
+    1) Распознаём скриншот страницы через GigaChat (ocr_instruction_via_rest).
+    2) Объединяем текстовый слой и распознанный текст в единую инструкцию
+       вторым запросом к GigaChat (giga_free_answer).
+    image_bytes — JPEG уже в памяти (тогда image_path задаёт только имя файла при загрузке).
+    Возвращаем итоговую инструкцию как строку.
+    """
+    # 2.1. Получаем описание по скриншоту (мультимодальный вызов)
+    if image_bytes is not None:
+        ocr_description = ocr_instruction_from_bytes(image_bytes, image_path.name, access_token)
+    else:
+        ocr_description = ocr_instruction_via_rest(str(image_path), access_token)
+
+    # 2.2. Читаем текстовый слой страницы
+    text_layer = text_path.read_text(encoding="utf-8")
+
+    # 2.3. Объединяем обе версии
     merged_instruction = giga_free_answer(
-        question=merge_question,
+        question=build_merge_question(text_layer, ocr_description),
         access_token=access_token,
-        sys_prompt=sys_prompt_merge,
+        sys_prompt=STAGE2_MERGE_SYS_PROMPT,
     )
 
     return merged_instruction
 
 
+# Системный промпт маршрута "text": страница без изображений, есть только текстовый слой
+STAGE2_TEXT_SYS_PROMPT = (
+    "Ты опытный методолог и сотрудник кредитного отдела банка. "
+    "Твоя задача — аккуратно привести извлечённый из PDF текст инструкции к читаемому виду "
+    "БЕЗ добавления новых смыслов. "
+    "Любая фраза, которой нет в исходном тексте, считается ошибкой. "
+    "Не придумывай примеры, рекомендации, служебные фразы и дополнительный функционал."
+)
+
+
+def build_text_only_question(text_layer: str) -> str:
+    """Вопрос маршрута "text": один запрос вместо распознавания скриншота и объединения."""
+    return (
+        "Ниже текстовый слой страницы инструкции по работе в АС, извлечённый из PDF:\n"
+        "----------------------------------------\n"
+        f"{text_layer}\n"
+        "----------------------------------------\n\n"
+        "Задача: оформи этот текст как аккуратную инструкцию по работе в АС.\n\n"
+        "Строгие правила:\n"
+        "1) Используй ТОЛЬКО информацию из текста выше.\n"
+        "2) Нельзя добавлять новые шаги, кнопки, поля, сценарии или рекомендации.\n"
+        "3) Можно:\n"
+        "   - восстанавливать разорванные переносами строки и слова;\n"
+        "   - убирать повторы и колонтитулы;\n"
+        "   - немного переформулировать фразы, НЕ меняя смысл и не расширяя его.\n"
+        "4) Если информации мало, просто перепиши её аккуратно и ничего не добавляй.\n"
+    )
+
+
+def stage2_build_instruction_from_text(text_path: Path, access_token: AccessToken) -> str:
+    """Этап 2 для страницы маршрута "text": один текстовый запрос, без загрузки изображения."""
+    return giga_free_answer(
+        question=build_text_only_question(text_path.read_text(encoding="utf-8")),
+        access_token=access_token,
+        sys_prompt=STAGE2_TEXT_SYS_PROMPT,
+    )
+
+
+def _page_image(info: Dict) -> bytes:
+    """
+    JPEG страницы для загрузки: с диска, если скриншот сохранён, иначе повторный рендеринг
+    в память с теми же DPI и качеством, что на этапе 1 (байты совпадают).
+    """
+    if info["image_path"] is not None:
+        return info["image_path"].read_bytes()
+    with fitz.open(info["pdf_path"]) as doc:
+        return encode_page_jpeg(doc[info["page_num"] - 1], info["dpi"], info["jpeg_quality"])
+
+
+def _page_region_images(info: Dict) -> List[bytes]:
+    """JPEG вырезанных областей страницы: с диска или повторным рендерингом, как _page_image."""
+    if info["image_path"] is not None:
+        return [
+            (info["dir"] / f"region_{idx:02d}.jpg").read_bytes()
+            for idx in range(1, len(info["regions"]) + 1)
+        ]
+    with fitz.open(info["pdf_path"]) as doc:
+        page = doc[info["page_num"] - 1]
+        return [
+            encode_page_jpeg(page, info["dpi"], info["jpeg_quality"], clip=fitz.Rect(region))
+            for region in info["regions"]
+        ]
+
+
+def _stage2_input_hash(info: Dict) -> str:
+    """
+    Хэш входа этапа 2 для страницы: отпечатки текстового слоя и изображения, маршрут,
+    промпты и модели. Изменение любого из них делает сохранённый instruction.txt неактуальным.
+    """
+    if info["route"] == ROUTE_TEXT:
+        return text_hash(
+            info["text_fp"],
+            ROUTE_TEXT,
+            STAGE2_TEXT_SYS_PROMPT,
+            build_text_only_question(""),
+            TEXT_MODEL,
+        )
+    if info["regions"]:
+        return text_hash(
+            info["text_fp"],
+            info["image_fp"],
+            repr(info["regions"]),
+            repr(build_regions_payload([""] * len(info["regions"]), "")),
+            VISION_MODEL,
+        )
+    return text_hash(
+        info["text_fp"],
+        info["image_fp"],
+        SYS_PROMPT,
+        STAGE2_MERGE_SYS_PROMPT,
+        build_merge_question("", ""),
+        TEXT_MODEL,
+        VISION_MODEL,
+    )
+
+
+def _stage2_plan(
+    page_infos: List[Dict],
+    manifest: PipelineManifest | None,
+    resume: bool,
+) -> tuple[List[Dict], Dict[int, Path]]:
+    """
+    Делим страницы на те, что нужно обработать, и уже готовые (только при resume).
+    Хэш входа сохраняем в info["stage2_input"], чтобы записать его в манифест после обработки.
+    """
+    todo: List[Dict] = []
+    ready: Dict[int, Path] = {}
+    for info in page_infos:
+        if manifest is not None:
+            info["stage2_input"] = _stage2_input_hash(info)
+            instr_path = info["dir"] / "instruction.txt"
+            if resume and manifest.page_done(info["page_num"], "stage2", info["stage2_input"], instr_path):
+                ready[info["page_num"]] = instr_path
+                continue
+        todo.append(info)
+    if ready:
+        print(f"Этап 2: пропущено готовых страниц (--resume): {len(ready)}")
+    return todo, ready
+
+
+def _route_label(info: Dict) -> str:
+    if info["route"] == ROUTE_VISION and info["regions"]:
+        return f"{ROUTE_VISION}, областей: {len(info['regions'])}"
+    return info["route"]
+
+
+def _stage2_record(manifest: PipelineManifest | None, info: Dict, instr_path: Path, **extra) -> None:
+    if manifest is not None:
+        manifest.record_page(
+            info["page_num"],
+            "stage2",
+            info["stage2_input"],
+            instr_path,
+            route=info["route"],
+            regions=len(info["regions"]),
+            ocr_batched=info.get("ocr_description") is not None,
+            **extra,
+        )
+
+
+def stage2_copy_duplicates(
+    duplicates: List[tuple[Dict, Dict]],
+    manifest: PipelineManifest | None = None,
+) -> Dict[int, Path]:
+    """
+    Дубликаты страниц (page_dedup) не отправляются в GigaChat: в их instruction.txt
+    копируется результат канонической страницы — из этого же или из ранее обработанного PDF.
+    """
+    results: Dict[int, Path] = {}
+    for info, canonical in duplicates:
+        instr_path = info["dir"] / "instruction.txt"
+        shutil.copyfile(canonical["dir"] / "instruction.txt", instr_path)
+        if manifest is not None:
+            manifest.record_page(
+                info["page_num"],
+                "stage2",
+                _stage2_input_hash(info),
+                instr_path,
+                route=info["route"],
+                regions=len(info["regions"]),
+                duplicate_of=f"{canonical['dir'].parent.name}/{canonical['dir'].name}",
+            )
+        results[info["page_num"]] = instr_path
+    return results
+
+
+def _stage2_worker(info: Dict, access_token: AccessToken) -> Path:
+    """
+    Обработка одной страницы в пуле потоков этапа 2.
+    Результат сразу пишется в page_XXX/instruction.txt своей страницы,
+    поэтому порядок завершения задач на файлы не влияет.
+    """
+    if info["route"] == ROUTE_TEXT:
+        instruction = stage2_build_instruction_from_text(info["text_path"], access_token)
+    elif info["regions"]:
+        # Только вырезанные скриншоты/рисунки + текстовый слой, один запрос
+        instruction = ocr_regions_with_text(
+            _page_region_images(info),
+            info["text_path"].read_text(encoding="utf-8"),
+            access_token,
+        )
+    elif info.get("ocr_description") is not None:
+        # Страница уже распознана пакетом (_stage2_ocr_batch), осталось объединение
+        text_layer = info["text_path"].read_text(encoding="utf-8")
+        instruction = giga_free_answer(
+            question=build_merge_question(text_layer, info["ocr_description"]),
+            access_token=access_token,
+            sys_prompt=STAGE2_MERGE_SYS_PROMPT,
+        )
+    else:
+        instruction = stage2_build_instruction_for_page(
+            text_path=info["text_path"],
+            image_path=info["dir"] / "page.jpg",
+            access_token=access_token,
+            image_bytes=_page_image(info),
+        )
+    instr_path = info["dir"] / "instruction.txt"
+    instr_path.write_text(instruction, encoding="utf-8")
+    return instr_path
+
+
+def _stage2_vision_batches(todo: List[Dict], batch_size: int) -> List[List[Dict]]:
+    """
+    Пакеты для совместного распознавания: страницы маршрута vision, которые отправляются
+    целиком (без вырезанных областей), по порядку страниц, до batch_size в пакете.
+    """
+    batch_size = min(int(batch_size), MAX_IMAGES_PER_REQUEST)
+    if batch_size < 2:
+        return []
+    pages = [info for info in todo if info["route"] == ROUTE_VISION and not info["regions"]]
+    batches = [pages[i:i + batch_size] for i in range(0, len(pages), batch_size)]
+    # Пакет из одной страницы ничем не лучше обычного распознавания
+    return [batch for batch in batches if len(batch) > 1]
+
+
+def _batch_label(batch: List[Dict]) -> str:
+    return ", ".join(str(info["page_num"]) for info in batch)
+
+
+def _stage2_ocr_batch(batch: List[Dict], access_token: AccessToken) -> None:
+    """
+    Распознавание пакета страниц одним запросом; тексты кладутся в info["ocr_description"].
+    При ошибке (в том числе если ответ не разделился по страницам) страницы пакета
+    остаются без ocr_description и распознаются по одной в _stage2_worker.
+    """
+    pages = ocr_pages_batch(
+        [_page_image(info) for info in batch],
+        [info["page_num"] for info in batch],
+        access_token,
+    )
+    for info in batch:
+        info["ocr_description"] = pages[info["page_num"]]
+
+
+def stage2_process_pages(
+    page_infos: List[Dict],
+    access_token: AccessToken,
+    workers: int = 4,
+    manifest: PipelineManifest | None = None,
+    resume: bool = False,
+    vision_batch_size: int = 1,
+) -> Dict[int, Path]:
+    """
+    Этап 2 для всех страниц одного PDF.
+    Страницы обрабатываются параллельно (до workers одновременных страниц):
+    узкое место — сетевые задержки GigaChat, а не CPU, поэтому хватает потоков.
+    vision_batch_size > 1 — страницы, распознаваемые целиком, сначала распознаются
+    пакетами (несколько изображений в одном запросе), затем объединяются по одной.
+    Каждая готовая страница сразу отмечается в манифесте; при resume страницы,
+    уже обработанные по тем же входным данным, пропускаются.
+    Возвращаем словарь {номер страницы: путь к instruction.txt}, упорядоченный по номеру страницы.
+    """
+    workers = max(1, int(workers))
+    todo, results = _stage2_plan(page_infos, manifest, resume)
+    total = len(todo)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stage2") as pool:
+        # Пакетное распознавание страниц (vision_batch_size > 1): меньше загрузок и запросов
+        batches = _stage2_vision_batches(todo, vision_batch_size)
+        batch_futures = {pool.submit(in_scope(_stage2_ocr_batch), batch, access_token): batch for batch in batches}
+        for future in as_completed(batch_futures):
+            batch = batch_futures[future]
+            try:
+                future.result()
+            except (ValueError, requests.RequestException) as e:
+                print(f"  Пакет страниц {_batch_label(batch)}: {e}; страницы будут распознаны по одной")
+                continue
+            print(f"Этап 2: страницы {_batch_label(batch)} распознаны одним запросом")
+
+        futures = {
+            pool.submit(in_scope(_stage2_worker, page=info["page_num"]), info, access_token): info
+            for info in todo
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            info = futures[future]
+            page_num = info["page_num"]
+            try:
+                results[page_num] = future.result()
+            except (ValueError, requests.RequestException) as e:
+                # Ошибки размера/загрузки/валидации и исчерпанные повторы обрабатываем мягко:
+                # instruction.txt страницы не пишется, остальные страницы продолжают работу
+                print(f"  Ошибка при обработке страницы {page_num}: {e}")
+                continue
+            _stage2_record(manifest, info, results[page_num])
+            print(f"Этап 2: страница {page_num} готова ({done}/{total}, {_route_label(info)}, {info['dir']})")
+
+    return dict(sorted(results.items()))
+
+
+async def _stage2_worker_async(client, info: Dict, access_token: AccessToken) -> Path:
+    """Асинхронный аналог _stage2_worker: те же маршруты и промпты, тот же instruction.txt."""
+    text_layer = info["text_path"].read_text(encoding="utf-8")
+    if info["route"] == ROUTE_TEXT:
+        instruction = await client.giga_free_answer(
+            question=build_text_only_question(text_layer),
+            access_token=access_token,
+            sys_prompt=STAGE2_TEXT_SYS_PROMPT,
+        )
+    elif info["regions"]:
+        images = await asyncio.to_thread(_page_region_images, info)
+        instruction = await client.ocr_regions_with_text(images, text_layer, access_token)
+    elif info.get("ocr_description") is not None:
+        instruction = await client.giga_free_answer(
+            question=build_merge_question(text_layer, info["ocr_description"]),
+            access_token=access_token,
+            sys_prompt=STAGE2_MERGE_SYS_PROMPT,
+        )
+    else:
+        # Рендеринг (если скриншот не сохранён) упирается в CPU — не блокируем event loop
+        image_bytes = await asyncio.to_thread(_page_image, info)
+        ocr_description = await client.ocr_instruction_from_bytes(image_bytes, "page.jpg", access_token)
+        instruction = await client.giga_free_answer(
+            question=build_merge_question(text_layer, ocr_description),
+            access_token=access_token,
+            sys_prompt=STAGE2_MERGE_SYS_PROMPT,
+        )
+    instr_path = info["dir"] / "instruction.txt"
+    instr_path.write_text(instruction, encoding="utf-8")
+    return instr_path
+
+
+async def _stage2_process_pages_async(
+    page_infos: List[Dict],
+    access_token: AccessToken,
+    workers: int,
+    manifest: PipelineManifest | None,
+    resume: bool,
+    vision_batch_size: int,
+) -> Dict[int, Path]:
+    # aiohttp нужен только в этом режиме, поэтому импортируем по месту
+    import aiohttp
+    from img_parse_async import AsyncGigaChatClient
+
+    todo, results = _stage2_plan(page_infos, manifest, resume)
+    total = len(todo)
+    done = 0
+
+    # Общие с синхронным клиентом повторы и лимитер: одна квота на весь процесс
+    shared = get_client()
+    async with AsyncGigaChatClient(
+        pool_size=workers,
+        concurrency=workers,
+        retry_policy=shared.retry_policy,
+        rate_limiter=shared.rate_limiter,
+    ) as client:
+
+        async def run_batch(batch: List[Dict]) -> None:
+            try:
+                images = await asyncio.to_thread(lambda: [_page_image(info) for info in batch])
+                pages = await client.ocr_pages_batch(
+                    images, [info["page_num"] for info in batch], access_token
+                )
+            except (ValueError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"  Пакет страниц {_batch_label(batch)}: {e}; страницы будут распознаны по одной")
+                return
+            for info in batch:
+                info["ocr_description"] = pages[info["page_num"]]
+            print(f"Этап 2: страницы {_batch_label(batch)} распознаны одним запросом")
+
+        await asyncio.gather(*(run_batch(batch) for batch in _stage2_vision_batches(todo, vision_batch_size)))
+
+        async def run_one(info: Dict) -> None:
+            nonlocal done
+            page_num = info["page_num"]
+            try:
+                with metrics_scope(page=page_num):
+                    results[page_num] = await _stage2_worker_async(client, info, access_token)
+            except (ValueError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"  Ошибка при обработке страницы {page_num}: {e}")
+                return
+            _stage2_record(manifest, info, results[page_num])
+            done += 1
+            print(f"Этап 2: страница {page_num} готова ({done}/{total}, {_route_label(info)}, {info['dir']})")
+
+        await asyncio.gather(*(run_one(info) for info in todo))
+
+    return dict(sorted(results.items()))
+
+
+def stage2_process_pages_async(
+    page_infos: List[Dict],
+    access_token: AccessToken,
+    workers: int = 4,
+    manifest: PipelineManifest | None = None,
+    resume: bool = False,
+    vision_batch_size: int = 1,
+) -> Dict[int, Path]:
+    """
+    Этап 2 на asyncio (AsyncGigaChatClient) вместо пула потоков.
+    workers здесь — лимит одновременных HTTP-запросов, а не потоков,
+    поэтому его можно поднимать до сотен без накладных расходов на потоки.
+    """
+    return asyncio.run(
+        _stage2_process_pages_async(
+            page_infos, access_token, max(1, int(workers)), manifest, resume, vision_batch_size
+        )
+    )
+
+
+def _batch_request_id(info: Dict, kind: str) -> str:
+    """id запроса в JSONL пакета: уникален в пределах каталога PDF (<pdf>/page_XXX/<вид>)."""
+    return f"{info['dir'].parent.name}/{info['dir'].name}/{kind}"
+
+
+def _stage2_batch_request(info: Dict, access_token: AccessToken) -> tuple[str, dict | None, str | None, str | None]:
+    """
+    Первый запрос страницы в пакетном режиме: (вид, тело запроса, ключ кэша, ответ из кэша).
+    Промпты и ключи кэша те же, что у постраничных вызовов этапа 2. Если ответ уже в кэше,
+    тело запроса не строится и изображения не загружаются.
+    """
+    text_layer = info["text_path"].read_text(encoding="utf-8")
+    if info["route"] == ROUTE_TEXT:
+        payload = build_text_payload(build_text_only_question(text_layer), STAGE2_TEXT_SYS_PROMPT)
+        key = _text_cache_key(payload)
+        cached = _cache_get(key)
+        return "text", None if cached is not None else payload, key, cached
+    if info["regions"]:
+        images = _page_region_images(info)
+        key = _regions_cache_key(images, text_layer)
+        cached = _cache_get(key)
+        if cached is not None:
+            return "regions", None, key, cached
+        file_ids = [
+            upload_image_bytes(image, f"region_{idx:02d}.jpg", access_token)
+            for idx, image in enumerate(images, start=1)
+        ]
+        return "regions", build_regions_payload(file_ids, text_layer), key, None
+    image = _page_image(info)
+    key = _ocr_cache_key(image)
+    cached = _cache_get(key)
+    if cached is not None:
+        return "ocr", None, key, cached
+    return "ocr", build_ocr_payload(upload_image_bytes(image, "page.jpg", access_token)), key, None
+
+
+def _stage2_batch_save(info: Dict, manifest: PipelineManifest | None, instruction: str) -> None:
+    instr_path = info["dir"] / "instruction.txt"
+    instr_path.write_text(instruction, encoding="utf-8")
+    _stage2_record(manifest, info, instr_path, batch=True)
+
+
+def stage2_process_pages_batch(
+    jobs: List[tuple[Dict, PipelineManifest | None]],
+    access_token: AccessToken,
+    state_path: Path,
+    workers: int = 4,
+) -> List[Dict]:
+    """
+    Этап 2 для страниц всех PDF каталога через пакетные задачи GigaChat (batch_mode).
+    jobs — (страница, манифест её PDF). Две фазы:
+      1) текстовые страницы, страницы с вырезанными областями и распознавание скриншотов
+         страниц, отправляемых целиком, — одним набором пакетных задач;
+      2) объединение распознанного текста с текстовым слоем для страниц целиком.
+    Изображения загружаются заранее (до workers параллельно), ответы попадают в тот же кэш,
+    что и при постраничной обработке. Возвращаем обработанные страницы.
+    """
+    first: Dict[str, tuple[Dict, PipelineManifest | None, str | None]] = {}
+    requests_by_id: Dict[str, dict] = {}
+    answers: Dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="stage2-batch") as pool:
+        futures = {
+            pool.submit(
+                in_scope(_stage2_batch_request, pdf=info["dir"].parent.name, page=info["page_num"]),
+                info,
+                access_token,
+            ): (info, manifest)
+            for info, manifest in jobs
+        }
+        for future in as_completed(futures):
+            info, manifest = futures[future]
+            try:
+                kind, payload, key, cached = future.result()
+            except (ValueError, requests.RequestException) as e:
+                print(f"  Ошибка при подготовке страницы {info['dir']}: {e}")
+                continue
+            request_id = _batch_request_id(info, kind)
+            first[request_id] = (info, manifest, key)
+            if cached is not None:
+                answers[request_id] = cached
+            else:
+                requests_by_id[request_id] = payload
+
+    print(f"Этап 2 (--batch): запросов в пакете: {len(requests_by_id)}, ответов из кэша: {len(answers)}")
+    batch_answers = run_chat_batches(requests_by_id, access_token, state_path, label=" этапа 2")
+    for request_id, answer in batch_answers.items():
+        _cache_put(first[request_id][2], answer)
+    answers.update(batch_answers)
+
+    done: List[Dict] = []
+    merge: Dict[str, tuple[Dict, PipelineManifest | None, str | None]] = {}
+    merge_requests: Dict[str, dict] = {}
+    merge_answers: Dict[str, str] = {}
+    for request_id, (info, manifest, _) in first.items():
+        if request_id not in answers:
+            continue
+        if not request_id.endswith("/ocr"):
+            _stage2_batch_save(info, manifest, answers[request_id])
+            done.append(info)
+            continue
+        text_layer = info["text_path"].read_text(encoding="utf-8")
+        payload = build_text_payload(build_merge_question(text_layer, answers[request_id]), STAGE2_MERGE_SYS_PROMPT)
+        key = _text_cache_key(payload)
+        merge_id = _batch_request_id(info, "merge")
+        merge[merge_id] = (info, manifest, key)
+        cached = _cache_get(key)
+        if cached is not None:
+            merge_answers[merge_id] = cached
+        else:
+            merge_requests[merge_id] = payload
+
+    if merge:
+        print(f"Этап 2 (--batch): запросов на объединение: {len(merge_requests)}, из кэша: {len(merge_answers)}")
+        batch_answers = run_chat_batches(merge_requests, access_token, state_path, label=" объединения")
+        for merge_id, answer in batch_answers.items():
+            _cache_put(merge[merge_id][2], answer)
+        merge_answers.update(batch_answers)
+        for merge_id, answer in merge_answers.items():
+            info, manifest, _ = merge[merge_id]
+            _stage2_batch_save(info, manifest, answer)
+            done.append(info)
+
+    print(f"Этап 2 (--batch): обработано страниц: {len(done)} из {len(jobs)}")
+    return done
+
+
 def stage3_merge_pdf_instructions(pdf_dir: Path) -> Path:
     """
     Этап 3.
@@ -145,7 +870,302 @@ def stage3_merge_pdf_instructions(pdf_dir: Path) -> Path:
     return merged_path
 
 
-def stage4_build_incremental_context(pdf_dir: Path, access_token: str) -> Path:
+def _instructions_hash(pdf_dir: Path, *extra: str) -> str:
+    """Хэш всех instruction.txt документа по порядку страниц (вход этапов 3 и 4)."""
+    parts = []
+    for page_dir in sorted(p for p in pdf_dir.iterdir() if p.is_dir() and p.name.startswith("page_")):
+        instr_path = page_dir / "instruction.txt"
+        if instr_path.exists():
+            parts.append(page_dir.name)
+            parts.append(instr_path.read_text(encoding="utf-8"))
+    return text_hash(*parts, *extra)
+
+
+# Теги источников в тексте этапа 4
+_SOURCE_TAG_RE = re.compile(r"\[SOURCE:\s*page\s*(\d+)\]", re.IGNORECASE)
+
+
+def _source_pages(text: str) -> set:
+    return {int(num) for num in _SOURCE_TAG_RE.findall(text)}
+
+
+# Системный промпт этапа 4 (накопление инструкции с тегами источников)
+STAGE4_SYS_PROMPT = (
+    "Ты опытный методолог и сотрудник кредитного отдела банка. "
+    "Ты собираешь единую подробную инструкцию по работе в АС из нескольких страниц.\n"
+    "- Ты НИКОГДА не придумываешь новых шагов, сценариев, кнопок или рекомендаций,\n"
+    "  которых нет в текстах страниц.\n"
+    "- Твоя особенность — ты всегда помечаешь каждый смысловой элемент тегом источника "
+    "вида [SOURCE: page XXX], где XXX — номер страницы, на которой этот элемент появился.\n"
+    "- Ты можешь только:\n"
+    "  * объединять и упорядочивать уже имеющиеся шаги;\n"
+    "  * убирать повторы;\n"
+    "  * НЕ менять смысл уже существующих элементов.\n"
+    "- Любая новая идея, не подтверждённая текстом страниц, считается ошибкой."
+)
+
+
+def build_stage4_page_question(page_num: int, page_text: str) -> str:
+    """Вопрос «разложи страницу на смысловые элементы с тегом [SOURCE: page XXX]»."""
+    return (
+        f"Перед тобой текст страницы №{page_num} инструкции по работе в АС:\n"
+        "----------------------------------------\n"
+        f"{page_text}\n"
+        "----------------------------------------\n\n"
+        "Сформируй список смысловых элементов (шаги, правила, предупреждения, заголовки разделов) "
+        "только по этому тексту.\n\n"
+        "Требования к формату:\n"
+        f"- каждый элемент пиши с новой строки;\n"
+        f"- в КОНЦЕ каждого смыслового блока добавь тег вида [SOURCE: page {page_num:03d}];\n"
+        "- не добавляй информацию, которой нет в тексте страницы.\n"
+        "- не добавляй никакие пояснения, комментарии или примеры от себя."
+    )
+
+
+def build_stage4_incremental_question(idx: int, combined_text: str, page_text: str) -> str:
+    """Вопрос режима incremental: обновить весь документ с учётом страницы idx."""
+    return (
+        f"У тебя уже есть собранная инструкция по страницам 1–{idx-1} "
+        "с тегами источников [SOURCE: page XXX]:\n"
+        "----------------------------------------\n"
+        f"{combined_text}\n"
+        "----------------------------------------\n\n"
+        f"И есть текст новой страницы №{idx}:\n"
+        "----------------------------------------\n"
+        f"{page_text}\n"
+        "----------------------------------------\n\n"
+        "Обнови общую инструкцию так, чтобы она отражала страницы 1–"
+        f"{idx} включительно.\n\n"
+        "Строгие правила:\n"
+        "1) НЕ удаляй и НЕ изменяй существующие строки и их теги [SOURCE: page ...], "
+        "можно только добавлять новые строки.\n"
+        "2) Для новых смысловых элементов, которые появляются только на странице "
+        f"№{idx}, добавляй строки с тегом [SOURCE: page {idx:03d}].\n"
+        "3) НЕЛЬЗЯ придумывать новые функции, кнопки, шаги или рекомендации, "
+        "если их нет ни в одной из страниц.\n"
+        "4) Если новая страница почти ничего не добавляет, можешь вернуть текст почти "
+        "без изменений.\n"
+        "5) Верни только итоговый текст инструкции с тегами, без пояснений и комментариев."
+    )
+
+
+def build_stage4_delta_question(idx: int, combined_text: str, page_text: str) -> str:
+    """Вопрос режима delta: вернуть только новые строки страницы idx, без повтора документа."""
+    return (
+        f"У тебя уже есть собранная инструкция по страницам 1–{idx-1} "
+        "с тегами источников [SOURCE: page XXX]:\n"
+        "----------------------------------------\n"
+        f"{combined_text}\n"
+        "----------------------------------------\n\n"
+        f"И есть текст новой страницы №{idx}:\n"
+        "----------------------------------------\n"
+        f"{page_text}\n"
+        "----------------------------------------\n\n"
+        f"Выпиши ТОЛЬКО новые смысловые элементы страницы №{idx}, которых ещё нет в собранной "
+        "инструкции. Они будут добавлены в конец инструкции без изменений.\n\n"
+        "Строгие правила:\n"
+        "1) НЕ повторяй строки собранной инструкции.\n"
+        f"2) Каждый элемент пиши с новой строки и в КОНЦЕ строки ставь тег [SOURCE: page {idx:03d}].\n"
+        "3) НЕЛЬЗЯ придумывать новые функции, кнопки, шаги или рекомендации, "
+        "если их нет на странице.\n"
+        "4) Если новая страница ничего не добавляет, верни пустой ответ.\n"
+        "5) Верни только новые строки с тегами, без пояснений и комментариев."
+    )
+
+
+def _stage4_delta_lines(answer: str, idx: int, combined_text: str) -> List[str]:
+    """
+    Проверка ответа режима delta перед дописыванием в документ:
+      - строки с тегом другой страницы (модель повторила старое) отбрасываются;
+      - строке без тега дописывается [SOURCE: page idx];
+      - повторы уже имеющихся строк отбрасываются, даже если у них другой тег
+        (модель переписала старую строку с номером текущей страницы).
+    """
+    existing = {_strip_source_tags(line) for line in combined_text.splitlines() if line.strip()}
+    tag = f"[SOURCE: page {idx:03d}]"
+    lines = []
+    for line in answer.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        pages = _source_pages(line)
+        if pages and pages != {idx}:
+            continue
+        text = _strip_source_tags(line)
+        if not text or text in existing:
+            continue
+        if not pages:
+            line = f"{line} {tag}"
+        existing.add(text)
+        lines.append(line)
+    return lines
+
+
+def _strip_source_tags(line: str) -> str:
+    """Текст строки без тегов источника: для сравнения строк документа."""
+    return " ".join(_SOURCE_TAG_RE.sub(" ", line).split())
+
+
+def _partial_path(path: Path) -> Path:
+    """Файл, куда потоковый ответ пишется по мере генерации (<имя>.partial рядом с итоговым)."""
+    return path.with_name(path.name + ".partial")
+
+
+def _stage4_answer(
+    question: str,
+    access_token: AccessToken,
+    partial_path: Path | None = None,
+    label: str = "",
+    max_tokens: int | None = None,
+) -> tuple[str, float | None]:
+    """
+    Запрос этапа 4. С partial_path (режим --stream) ответ приходит потоком (SSE) и по мере
+    генерации пишется в partial_path: прогресс длинного ответа виден на диске, а при обрыве
+    остаётся полученная часть. После успешного ответа файл удаляется — итог пишет вызывающий код.
+    Возвращаем (ответ, время до первого токена в секундах или None без потока).
+    max_tokens — потолок ответа, выбранный планировщиком бюджета токенов (--token-budget).
+    """
+    if partial_path is None:
+        answer = giga_free_answer(
+            question=question,
+            access_token=access_token,
+            sys_prompt=STAGE4_SYS_PROMPT,
+            max_tokens=max_tokens,
+        )
+        return answer, None
+    result = stream_to_file(
+        giga_free_answer_stream(question, access_token, sys_prompt=STAGE4_SYS_PROMPT, max_tokens=max_tokens),
+        partial_path,
+    )
+    partial_path.unlink(missing_ok=True)
+    if result.first_token_s is not None:
+        print(f"  Этап 4: {label}: первый токен через {result.first_token_s:.1f} с, ответ за {result.total_s:.1f} с")
+    return result.text, result.first_token_s
+
+
+def _stream_extra(first_token_s: float | None) -> dict:
+    """Время до первого токена для записи в манифест (только в режиме --stream)."""
+    return {} if first_token_s is None else {"first_token_s": round(first_token_s, 3)}
+
+
+# Ответ этапа 4 длиннее входного текста: к каждому элементу добавляется тег [SOURCE: page XXX]
+STAGE4_COMPLETION_RATIO = 1.5
+
+
+def _stage4_completion_tokens(input_tokens: int) -> int:
+    return int(input_tokens * STAGE4_COMPLETION_RATIO)
+
+
+def _stage4_page_parts(budget: TokenBudget, idx: int, page_text: str, label: str) -> List[str]:
+    """
+    Текст страницы целиком или по частям, если он не помещается в окно модели.
+    На часть — не больше половины окна с учётом ответа: вторая половина остаётся
+    под собранный документ в вопросе режима delta.
+    """
+    base = budget.prompt_tokens(STAGE4_SYS_PROMPT, build_stage4_delta_question(idx, "", ""))
+    part_limit = max(1, int((budget.context_tokens - base) / 2 / (1 + STAGE4_COMPLETION_RATIO)))
+    parts = budget.split_text(page_text, part_limit)
+    if len(parts) > 1:
+        budget.note(SPLIT)
+        print(
+            f"  Этап 4: {label}: страница ({budget.count(page_text)} токенов) не помещается в окно модели, "
+            f"частей: {len(parts)}"
+        )
+    return parts
+
+
+def _stage4_split_part(budget: TokenBudget, part: str, part_tokens: int, label: str) -> List[str]:
+    """
+    Часть страницы, запрос с которой всё ещё не помещается в окно (split), делится пополам;
+    неделимую часть в модель не отправляем.
+    """
+    halves = budget.split_text(part, part_tokens // 2)
+    if len(halves) < 2:
+        raise ValueError(f"{label}: часть страницы ({part_tokens} токенов) не помещается в окно модели")
+    budget.note(SPLIT)
+    return halves
+
+
+def _stage4_budgeted_step(
+    budget: TokenBudget,
+    idx: int,
+    combined_text: str | None,
+    page_text: str,
+    delta: bool,
+    access_token: AccessToken,
+    partial_path: Path | None,
+    label: str,
+) -> tuple[str, float | None]:
+    """
+    Шаг incremental/delta с проверкой размера запроса до отправки (--token-budget):
+      - proceed: запрос как обычно, max_tokens — по ожидаемой длине ответа;
+      - документ целиком не помещается в incremental — страница добавляется вопросом delta
+        (модель возвращает только новые строки, а не весь документ заново);
+      - compress: в вопрос delta попадает столько конца документа, сколько помещается
+        (повторы всё равно отсекаются по полному документу в _stage4_delta_lines);
+      - split: страница сама не помещается — её части добавляются по очереди
+        (часть, не поместившаяся и с сокращённым документом, делится ещё раз).
+    Возвращает (документ после страницы, время до первого токена).
+    """
+    if combined_text is not None and not delta:
+        doc_tokens, page_tokens = budget.count_many([combined_text, page_text])
+        question = build_stage4_incremental_question(idx, combined_text, page_text)
+        plan = budget.plan(
+            STAGE4_SYS_PROMPT,
+            question,
+            _stage4_completion_tokens(doc_tokens + page_tokens),
+            required_tokens=page_tokens,
+        )
+        if plan.action == PROCEED:
+            return _stage4_answer(question, access_token, partial_path, label, max_tokens=plan.max_tokens)
+        if plan.action == COMPRESS:
+            print(
+                f"  Этап 4: {label}: документ ({doc_tokens} токенов) не помещается в окно модели целиком, "
+                "страница добавляется только новыми строками (delta)"
+            )
+
+    first_token_s = None
+    parts = _stage4_page_parts(budget, idx, page_text, label)
+    while parts:
+        part = parts.pop(0)
+        part_tokens = budget.count(part)
+        completion = _stage4_completion_tokens(part_tokens)
+        if combined_text is None:
+            question = build_stage4_page_question(idx, part)
+        else:
+            question = build_stage4_delta_question(idx, combined_text, part)
+        plan = budget.plan(STAGE4_SYS_PROMPT, question, completion, required_tokens=part_tokens)
+        if plan.action != PROCEED and combined_text is not None:
+            room = budget.room_for(STAGE4_SYS_PROMPT, build_stage4_delta_question(idx, "", part), completion)
+            question = build_stage4_delta_question(idx, budget.fit_text(combined_text, room, keep="tail"), part)
+            plan = budget.plan(STAGE4_SYS_PROMPT, question, completion, required_tokens=part_tokens)
+        if plan.action != PROCEED:
+            parts[:0] = _stage4_split_part(budget, part, part_tokens, label)
+            continue
+
+        answer, part_first_token_s = _stage4_answer(
+            question, access_token, partial_path, label, max_tokens=plan.max_tokens
+        )
+        if first_token_s is None:
+            first_token_s = part_first_token_s
+        if combined_text is None:
+            combined_text = answer
+        else:
+            new_lines = _stage4_delta_lines(answer, idx, combined_text)
+            if new_lines:
+                combined_text = combined_text.rstrip("\n") + "\n" + "\n".join(new_lines)
+    return combined_text, first_token_s
+
+
+def stage4_build_incremental_context(
+    pdf_dir: Path,
+    access_token: AccessToken,
+    manifest: PipelineManifest | None = None,
+    resume: bool = False,
+    delta: bool = False,
+    stream: bool = False,
+    budget: TokenBudget | None = None,
+) -> Path:
     """
     Этап 4.
     Инкрементально наращиваем «смысл» инструкции по мере чтения страниц:
@@ -156,6 +1176,20 @@ def stage4_build_incremental_context(pdf_dir: Path, access_token: str) -> Path:
     На выходе:
       - по каждой странице: instruction_with_context.txt (контекст до этой страницы включительно);
       - общий файл: instructions_incremental.md с полной инструкцией по документу.
+
+    С manifest для каждой страницы запоминается хэш цепочки инструкций 1..N.
+    При resume накопленный контекст переиспользуется для самого длинного неизменного
+    префикса страниц, а запросы к модели идут только начиная с первой изменённой страницы.
+
+    delta=True (режим --stage4-mode delta): модель возвращает только новые строки страницы N,
+    а не весь документ заново; строки проверяются (_stage4_delta_lines) и дописываются
+    в конец локально. Число completion-токенов на страницу не растёт с длиной документа.
+
+    stream=True (--stream): ответы приходят потоком и по мере генерации пишутся
+    в instruction_with_context.txt.partial; время до первого токена — в манифесте.
+
+    budget (--token-budget): размер каждого запроса проверяется до отправки
+    (см. _stage4_budgeted_step), max_tokens выбирается по оставшемуся окну модели.
     """
     page_dirs = sorted(
         [p for p in pdf_dir.iterdir() if p.is_dir() and p.name.startswith("page_")]
@@ -164,21 +1198,12 @@ def stage4_build_incremental_context(pdf_dir: Path, access_token: str) -> Path:
     if not page_dirs:
         return pdf_dir / "instructions_incremental.md"
 
-    sys_prompt_incremental = (
-        "Ты опытный методолог и сотрудник кредитного отдела банка. "
-        "Ты собираешь единую подробную инструкцию по работе в АС из нескольких страниц.\n"
-        "- Ты НИКОГДА не придумываешь новых шагов, сценариев, кнопок или рекомендаций,\n"
-        "  которых нет в текстах страниц.\n"
-        "- Твоя особенность — ты всегда помечаешь каждый смысловой элемент тегом источника "
-        "вида [SOURCE: page XXX], где XXX — номер страницы, на которой этот элемент появился.\n"
-        "- Ты можешь только:\n"
-        "  * объединять и упорядочивать уже имеющиеся шаги;\n"
-        "  * убирать повторы;\n"
-        "  * НЕ менять смысл уже существующих элементов.\n"
-        "- Любая новая идея, не подтверждённая текстом страниц, считается ошибкой."
-    )
-
     combined_text: str | None = None
+    chain_hash = text_hash(STAGE4_SYS_PROMPT, TEXT_MODEL)
+    if delta:
+        chain_hash = text_hash(chain_hash, "delta")
+    reuse_prefix = resume and manifest is not None
+    reused = 0
 
     for idx, page_dir in enumerate(page_dirs, start=1):
         instr_path = page_dir / "instruction.txt"
@@ -188,62 +1213,52 @@ def stage4_build_incremental_context(pdf_dir: Path, access_token: str) -> Path:
         if not page_text:
             continue
 
-        if combined_text is None:
-            # Первая страница — формируем элементы сразу с тегами источника
-            question = (
-                f"Перед тобой текст страницы №{idx} инструкции по работе в АС:\n"
-                "----------------------------------------\n"
-                f"{page_text}\n"
-                "----------------------------------------\n\n"
-                "Сформируй список смысловых элементов (шаги, правила, предупреждения, заголовки разделов) "
-                "только по этому тексту.\n\n"
-                "Требования к формату:\n"
-                f"- каждый элемент пиши с новой строки;\n"
-                f"- в КОНЦЕ каждого смыслового блока добавь тег вида [SOURCE: page {idx:03d}];\n"
-                "- не добавляй информацию, которой нет в тексте страницы.\n"
-                "- не добавляй никакие пояснения, комментарии или примеры от себя."
-            )
+        page_num = int(page_dir.name.split("_", 1)[-1])
+        ctx_path = page_dir / "instruction_with_context.txt"
+        chain_hash = text_hash(chain_hash, str(idx), page_dir.name, page_text)
+        if reuse_prefix and manifest.page_done(page_num, "stage4", chain_hash, ctx_path):
+            combined_text = ctx_path.read_text(encoding="utf-8")
+            reused += 1
+            continue
+        # После первой изменённой страницы весь дальнейший контекст строится заново
+        reuse_prefix = False
 
-            combined_text = giga_free_answer(
-                question=question,
-                access_token=access_token,
-                sys_prompt=sys_prompt_incremental,
-            )
-        else:
-            # Инкрементальное уточнение/расширение с учётом новой страницы
-            question = (
-                f"У тебя уже есть собранная инструкция по страницам 1–{idx-1} "
-                "с тегами источников [SOURCE: page XXX]:\n"
-                "----------------------------------------\n"
-                f"{combined_text}\n"
-                "----------------------------------------\n\n"
-                f"И есть текст новой страницы №{idx}:\n"
-                "----------------------------------------\n"
-                f"{page_text}\n"
-                "----------------------------------------\n\n"
-                "Обнови общую инструкцию так, чтобы она отражала страницы 1–"
-                f"{idx} включительно.\n\n"
-                "Строгие правила:\n"
-                "1) НЕ удаляй и НЕ изменяй существующие строки и их теги [SOURCE: page ...], "
-                "можно только добавлять новые строки.\n"
-                "2) Для новых смысловых элементов, которые появляются только на странице "
-                f"№{idx}, добавляй строки с тегом [SOURCE: page {idx:03d}].\n"
-                "3) НЕЛЬЗЯ придумывать новые функции, кнопки, шаги или рекомендации, "
-                "если их нет ни в одной из страниц.\n"
-                "4) Если новая страница почти ничего не добавляет, можешь вернуть текст почти "
-                "без изменений.\n"
-                "5) Верни только итоговый текст инструкции с тегами, без пояснений и комментариев."
-            )
+        with metrics_scope(page=page_num):
+            partial_path = _partial_path(ctx_path) if stream else None
+            label = f"страница {page_num}"
+            if budget is not None:
+                combined_text, first_token_s = _stage4_budgeted_step(
+                    budget, idx, combined_text, page_text, delta, access_token, partial_path, label
+                )
+            elif combined_text is None:
+                # Первая страница — формируем элементы сразу с тегами источника
+                question = build_stage4_page_question(idx, page_text)
 
-            combined_text = giga_free_answer(
-                question=question,
-                access_token=access_token,
-                sys_prompt=sys_prompt_incremental,
-            )
+                combined_text, first_token_s = _stage4_answer(question, access_token, partial_path, label)
+            elif delta:
+                # Только новые строки страницы, документ дописывается локально
+                answer, first_token_s = _stage4_answer(
+                    build_stage4_delta_question(idx, combined_text, page_text),
+                    access_token,
+                    partial_path,
+                    label,
+                )
+                new_lines = _stage4_delta_lines(answer, idx, combined_text)
+                if new_lines:
+                    combined_text = combined_text.rstrip("\n") + "\n" + "\n".join(new_lines)
+            else:
+                # Инкрементальное уточнение/расширение с учётом новой страницы
+                question = build_stage4_incremental_question(idx, combined_text, page_text)
+
+                combined_text, first_token_s = _stage4_answer(question, access_token, partial_path, label)
 
         # Сохраняем контекст до текущей страницы включительно
-        ctx_path = page_dir / "instruction_with_context.txt"
         ctx_path.write_text(combined_text, encoding="utf-8")
+        if manifest is not None:
+            manifest.record_page(page_num, "stage4", chain_hash, ctx_path, **_stream_extra(first_token_s))
+
+    if reused:
+        print(f"Этап 4: переиспользован накопленный контекст первых {reused} страниц (--resume)")
 
     # Итоговый файл по всему документу
     incremental_path = pdf_dir / "instructions_incremental.md"
@@ -255,64 +1270,681 @@ def stage4_build_incremental_context(pdf_dir: Path, access_token: str) -> Path:
     return incremental_path
 
 
-def run_pipeline(pdf_dir: Path, out_root: Path) -> None:
+# Режимы этапа 4
+STAGE4_MODES = ("incremental", "delta", "tree")
+
+
+def build_stage4_merge_question(fragments: List[tuple]) -> str:
+    """
+    Вопрос на слияние нескольких фрагментов инструкции соседних диапазонов страниц.
+    fragments — список (первая страница, последняя страница, текст фрагмента) по порядку.
+    """
+    parts = []
+    for first, last, text in fragments:
+        pages = f"страница {first}" if first == last else f"страницы {first}–{last}"
+        parts.append(
+            f"Фрагмент ({pages}):\n"
+            "----------------------------------------\n"
+            f"{text}\n"
+            "----------------------------------------"
+        )
+    first_page, last_page = fragments[0][0], fragments[-1][1]
+    return (
+        f"Перед тобой {len(fragments)} фрагмента(ов) инструкции по работе в АС, собранных по "
+        f"соседним страницам {first_page}–{last_page}, по порядку страниц. "
+        "Каждая строка помечена тегом источника [SOURCE: page XXX]:\n\n"
+        + "\n\n".join(parts)
+        + "\n\n"
+        f"Объедини фрагменты в одну инструкцию по страницам {first_page}–{last_page}.\n\n"
+        "Строгие правила:\n"
+        "1) Сохраняй порядок страниц: элементы более ранних страниц идут раньше.\n"
+        "2) НЕ изменяй смысл строк и НЕ удаляй и НЕ меняй их теги [SOURCE: page ...].\n"
+        "3) Если один и тот же элемент повторяется в нескольких фрагментах, оставь одну строку "
+        "с тегом страницы, где он появился впервые.\n"
+        "4) НЕЛЬЗЯ придумывать новые функции, кнопки, шаги или рекомендации.\n"
+        "5) Верни только итоговый текст инструкции с тегами, без пояснений и комментариев."
+    )
+
+
+def _stage4_tree_leaf(
+    page_num: int,
+    page_text: str,
+    access_token: AccessToken,
+    partial_path: Path | None = None,
+    budget: TokenBudget | None = None,
+) -> tuple[str, float | None]:
+    label = f"страница {page_num}"
+    if budget is None:
+        return _stage4_answer(build_stage4_page_question(page_num, page_text), access_token, partial_path, label)
+
+    # Страница, не помещающаяся в окно модели, раскладывается по частям
+    answers = []
+    first_token_s = None
+    parts = _stage4_page_parts(budget, page_num, page_text, label)
+    while parts:
+        part = parts.pop(0)
+        part_tokens = budget.count(part)
+        question = build_stage4_page_question(page_num, part)
+        plan = budget.plan(STAGE4_SYS_PROMPT, question, _stage4_completion_tokens(part_tokens))
+        if plan.action != PROCEED:
+            parts[:0] = _stage4_split_part(budget, part, part_tokens, label)
+            continue
+        answer, part_first_token_s = _stage4_answer(
+            question, access_token, partial_path, label, max_tokens=plan.max_tokens
+        )
+        answers.append(answer.strip())
+        if first_token_s is None:
+            first_token_s = part_first_token_s
+    return "\n".join(answers), first_token_s
+
+
+def _stage4_tree_merge(
+    group: List[tuple],
+    access_token: AccessToken,
+    stream_dir: Path | None = None,
+    budget: TokenBudget | None = None,
+) -> tuple:
+    """
+    Слияние группы соседних узлов дерева в один узел (первая, последняя страница, текст).
+    Если модель потеряла теги каких-то страниц группы, узел собирается простой склейкой
+    фрагментов: теги источников важнее, чем удаление повторов. Так же собирается узел,
+    если запрос на слияние не помещается в окно модели (budget, --token-budget).
+    stream_dir — каталог PDF для потоковой записи ответа (--stream), иначе None.
+    """
+    first, last = group[0][0], group[-1][1]
+    question = build_stage4_merge_question(group)
+    max_tokens = None
+    if budget is not None:
+        fragments_tokens = sum(budget.count_many([text for _, _, text in group]))
+        plan = budget.plan(STAGE4_SYS_PROMPT, question, fragments_tokens)
+        if plan.action != PROCEED:
+            print(f"  Этап 4: слияние страниц {first}–{last} не помещается в окно модели, склеиваем фрагменты")
+            return first, last, "\n".join(text for _, _, text in group)
+        max_tokens = plan.max_tokens
+    partial_path = stream_dir / f"stage4_merge_{first:03d}-{last:03d}.partial" if stream_dir else None
+    merged, _ = _stage4_answer(
+        question,
+        access_token,
+        partial_path,
+        f"слияние страниц {first}–{last}",
+        max_tokens=max_tokens,
+    )
+    merged = merged.strip()
+    expected = set().union(*(_source_pages(text) for _, _, text in group))
+    lost = expected - _source_pages(merged)
+    if not merged or lost:
+        lost_str = ", ".join(f"{num:03d}" for num in sorted(lost)) or "все"
+        print(f"  Этап 4: слияние страниц {first}–{last} потеряло теги страниц ({lost_str}), склеиваем фрагменты")
+        merged = "\n".join(text for _, _, text in group)
+    return first, last, merged
+
+
+def stage4_build_tree_context(
+    pdf_dir: Path,
+    access_token: AccessToken,
+    workers: int = 4,
+    fan_in: int = 4,
+    manifest: PipelineManifest | None = None,
+    resume: bool = False,
+    stream: bool = False,
+    budget: TokenBudget | None = None,
+) -> Path:
+    """
+    Этап 4, режим tree: иерархическое слияние вместо последовательного накопления.
+      - листья: каждая страница независимо раскладывается на элементы с тегами
+        [SOURCE: page XXX] (тот же промпт, что для первой страницы в incremental);
+        результат — page_XXX/instruction_tagged.txt;
+      - уровни дерева: соседние узлы объединяются группами по fan_in, пока не останется один.
+
+    Запросы внутри уровня независимы и идут параллельно (до workers одновременно),
+    а каждый фрагмент попадает в промпт O(log n) раз вместо n, поэтому для длинных
+    документов токенов и времени нужно намного меньше, чем в incremental.
+    Итог пишется в тот же instructions_incremental.md. Файлы instruction_with_context.txt
+    (контекст «до страницы N») в этом режиме не строятся.
+
+    Листья отмечаются в манифесте; при resume неизменные страницы не отправляются заново.
+    stream=True (--stream): ответы пишутся по мере генерации в файлы *.partial.
+    budget (--token-budget): слишком длинные страницы раскладываются по частям,
+    а не помещающиеся в окно слияния заменяются склейкой фрагментов.
+    """
+    workers = max(1, int(workers))
+    fan_in = max(2, int(fan_in))
+    incremental_path = pdf_dir / "instructions_incremental.md"
+
+    pages = []
+    for page_dir in sorted(p for p in pdf_dir.iterdir() if p.is_dir() and p.name.startswith("page_")):
+        instr_path = page_dir / "instruction.txt"
+        if not instr_path.exists():
+            continue
+        page_text = instr_path.read_text(encoding="utf-8").strip()
+        if page_text:
+            pages.append((int(page_dir.name.split("_", 1)[-1]), page_dir, page_text))
+
+    if not pages:
+        incremental_path.write_text("", encoding="utf-8")
+        return incremental_path
+
+    # Листья
+    leaves: Dict[int, str] = {}
+    todo = []
+    for page_num, page_dir, page_text in pages:
+        leaf_path = page_dir / "instruction_tagged.txt"
+        leaf_input = text_hash(STAGE4_SYS_PROMPT, TEXT_MODEL, str(page_num), page_text)
+        if resume and manifest is not None and manifest.page_done(page_num, "stage4_leaf", leaf_input, leaf_path):
+            leaves[page_num] = leaf_path.read_text(encoding="utf-8").strip()
+        else:
+            todo.append((page_num, page_text, leaf_path, leaf_input))
+    if resume and leaves:
+        print(f"Этап 4: пропущено готовых страниц (--resume): {len(leaves)}")
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stage4") as pool:
+        futures = {
+            pool.submit(
+                in_scope(_stage4_tree_leaf, page=page_num),
+                page_num,
+                page_text,
+                access_token,
+                _partial_path(leaf_path) if stream else None,
+                budget,
+            ): (page_num, leaf_path, leaf_input)
+            for page_num, page_text, leaf_path, leaf_input in todo
+        }
+        texts = {page_num: page_text for page_num, _, page_text in pages}
+        for future in as_completed(futures):
+            page_num, leaf_path, leaf_input = futures[future]
+            try:
+                leaf, first_token_s = future.result()
+            except (ValueError, requests.RequestException) as e:
+                # Как на этапе 2: ошибка одной страницы не роняет документ. Лист собирается из
+                # текста страницы с тегом источника и не записывается, чтобы --resume повторил запрос
+                print(f"  Ошибка этапа 4 на странице {page_num}: {e}; в документ идёт текст страницы")
+                leaves[page_num] = "\n".join(_stage4_delta_lines(texts[page_num], page_num, ""))
+                continue
+            leaf = leaf.strip()
+            leaf_path.write_text(leaf, encoding="utf-8")
+            if manifest is not None:
+                manifest.record_page(page_num, "stage4_leaf", leaf_input, leaf_path, **_stream_extra(first_token_s))
+            leaves[page_num] = leaf
+
+        # Уровни дерева: соседние группы сливаются параллельно, порядок страниц сохраняется
+        nodes = [(page_num, page_num, leaves[page_num]) for page_num, _, _ in pages]
+        level = 0
+        while len(nodes) > 1:
+            level += 1
+            groups = [nodes[i:i + fan_in] for i in range(0, len(nodes), fan_in)]
+            merge = in_scope(_stage4_tree_merge)
+            merged = list(pool.map(
+                lambda group: group[0] if len(group) == 1 else merge(
+                    group, access_token, pdf_dir if stream else None, budget
+                ),
+                groups,
+            ))
+            print(f"Этап 4: уровень {level} дерева: {len(nodes)} -> {len(merged)} фрагментов")
+            nodes = merged
+
+    incremental_path.write_text(nodes[0][2], encoding="utf-8")
+    return incremental_path
+
+
+def _stage1_pages_per_pdf(
+    pdf_files: List[Path],
+    out_root: Path,
+    resume: bool,
+    render_workers: int,
+    policy: RenderPolicy,
+    save_images: bool,
+):
+    """
+    Этап 1 для всех PDF: по очереди отдаёт (pdf_path, manifest, page_infos).
+    С render_workers > 1 страницы всех PDF сразу ставятся в общий пул процессов,
+    поэтому пока вызывающий код ведёт этапы 2–4 одного PDF, остальные уже рендерятся.
+    """
+    plans = []
+    with ExitStack() as stack:
+        pool = None
+        if render_workers > 1:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=render_workers))
+
+        # Смена настроек рендеринга меняет скриншоты, поэтому входит в ключ этапа 1
+        render_key = text_hash(repr(policy), str(save_images))
+        for pdf_path in pdf_files:
+            manifest = PipelineManifest(out_root / pdf_path.stem)
+            pdf_hash = file_hash(pdf_path)
+            # При resume — если PDF и настройки рендеринга не менялись, страницы берём из манифеста
+            page_infos = manifest.stage1_page_infos(pdf_hash, pdf_path, render_key) if resume else None
+            futures = None
+            if page_infos is None and pool is not None:
+                futures = stage1_submit_pages(pdf_path, out_root, pool, render_workers, policy, save_images)
+            plans.append((pdf_path, manifest, pdf_hash, page_infos, futures))
+
+        for pdf_path, manifest, pdf_hash, page_infos, futures in plans:
+            print(f"\n=== Обработка PDF: {pdf_path.name} ===")
+            if page_infos is not None:
+                print(f"Этап 1: пропущен (--resume), страниц: {len(page_infos)}")
+            else:
+                # С пулом процессов это время ожидания уже идущего рендеринга
+                with metrics_scope(stage="stage1", pdf=manifest.dir.name):
+                    if futures is not None:
+                        page_infos = stage1_collect_pages(futures)
+                    else:
+                        page_infos = stage1_extract_pages(pdf_path, out_root, policy=policy, save_images=save_images)
+                changed = sum(
+                    1
+                    for info in page_infos
+                    if manifest.previous_fingerprints(info["page_num"]) != (info["text_fp"], info["image_fp"])
+                )
+                manifest.record_stage1(pdf_path, pdf_hash, page_infos, render_key)
+                total_kb = sum(info["image_bytes"] for info in page_infos) / 1024
+                print(
+                    f"Этап 1: извлечено страниц: {len(page_infos)}, новых или изменённых: {changed}, "
+                    f"скриншоты: {total_kb:.0f} Кб"
+                )
+            yield pdf_path, manifest, page_infos
+
+
+def _stage2_prepare(
+    page_infos: List[Dict],
+    route_mode: str,
+    vision_input: str,
+    dedup_index: PageDedupIndex | None,
+) -> tuple[List[Dict], List[tuple[Dict, Dict]]]:
+    """
+    Маршруты этапа 2 с учётом --route/--vision-input и поиск повторяющихся страниц.
+    Возвращаем (страницы для GigaChat, [(дубликат, каноническая страница)]).
+    """
+    # Маршрут этапа 2: по классификатору страниц или всё через разбор изображения;
+    # для vision — только вырезанные области или вся страница
+    for info in page_infos:
+        if route_mode == ROUTE_VISION:
+            info["route"] = ROUTE_VISION
+        if vision_input == "page":
+            info["regions"] = []
+    text_pages = sum(1 for info in page_infos if info["route"] == ROUTE_TEXT)
+    region_pages = sum(1 for info in page_infos if info["route"] == ROUTE_VISION and info["regions"])
+    print(
+        f"Этап 2: маршруты страниц: {ROUTE_TEXT} — {text_pages}, "
+        f"{ROUTE_VISION} — {len(page_infos) - text_pages} (из них по вырезанным областям — {region_pages})"
+    )
+
+    # Повторяющиеся страницы: в GigaChat уходят только канонические
+    if dedup_index is None:
+        return page_infos, []
+    stage2_pages, duplicates = dedup_index.assign(page_infos)
+    if duplicates:
+        print(f"Этап 2: страниц-дубликатов: {len(duplicates)}, результат берётся с канонической страницы")
+    return stage2_pages, duplicates
+
+
+def _stage2_resolve_duplicates(
+    instructions: Dict[int, Path],
+    stage2_pages: List[Dict],
+    duplicates: List[tuple[Dict, Dict]],
+    dedup_index: PageDedupIndex | None,
+    process_pages,
+    manifest: PipelineManifest,
+) -> None:
+    """
+    Дубликатам копируется результат канонической страницы; если её обработать не удалось,
+    дубликаты обрабатываются сами (process_pages; None — остаются необработанными).
+    instructions дополняется на месте.
     """
-    Запускает все три этапа пайплайна для всех PDF в указанном каталоге.
+    if dedup_index is None:
+        return
+    dedup_index.mark_done([info for info in stage2_pages if info["page_num"] in instructions])
+    ready = [(info, canonical) for info, canonical in duplicates if dedup_index.is_done(canonical)]
+    instructions.update(stage2_copy_duplicates(ready, manifest))
+    orphans = [info for info, canonical in duplicates if not dedup_index.is_done(canonical)]
+    if orphans and process_pages is not None:
+        instructions.update(process_pages(orphans))
+
+
+def _run_stages_3_4(
+    manifest: PipelineManifest,
+    access_token: AccessToken,
+    workers: int,
+    resume: bool,
+    stage4_mode: str,
+    stage4_fan_in: int,
+    stream: bool = False,
+    budget: TokenBudget | None = None,
+) -> None:
+    """Этапы 3–4 для одного PDF по готовым page_XXX/instruction.txt."""
+    pdf_out_dir = manifest.dir
+
+    # Этап 3: склейка по PDF (страницы как независимые инструкции); локальная и быстрая,
+    # поэтому выполняется всегда
+    with metrics_scope(stage="stage3", pdf=pdf_out_dir.name):
+        merged_path = stage3_merge_pdf_instructions(pdf_out_dir)
+        manifest.record_stage("stage3", _instructions_hash(pdf_out_dir), merged_path)
+    print(f"Этап 3: итоговый документ (страницы по отдельности): {merged_path}")
+
+    # Этап 4: накопление смысла по страницам (последовательно или деревом)
+    stage4_input = _instructions_hash(
+        pdf_out_dir, STAGE4_SYS_PROMPT, TEXT_MODEL, stage4_mode, str(stage4_fan_in)
+    )
+    with metrics_scope(stage="stage4", pdf=pdf_out_dir.name):
+        incremental_path = pdf_out_dir / "instructions_incremental.md"
+        if resume and manifest.stage_done("stage4", stage4_input, incremental_path):
+            print(f"Этап 4: пропущен (--resume), документ актуален: {incremental_path}")
+        else:
+            try:
+                if stage4_mode == "tree":
+                    incremental_path = stage4_build_tree_context(
+                        pdf_out_dir,
+                        access_token,
+                        workers=workers,
+                        fan_in=stage4_fan_in,
+                        manifest=manifest,
+                        resume=resume,
+                        stream=stream,
+                        budget=budget,
+                    )
+                else:
+                    incremental_path = stage4_build_incremental_context(
+                        pdf_out_dir,
+                        access_token,
+                        manifest=manifest,
+                        resume=resume,
+                        delta=stage4_mode == "delta",
+                        stream=stream,
+                        budget=budget,
+                    )
+            finally:
+                manifest.flush()
+            manifest.record_stage("stage4", stage4_input, incremental_path, mode=stage4_mode)
+            print(f"Этап 4: итоговый документ с накопленным контекстом: {incremental_path}")
+
+
+def _export_chunks(manifest: PipelineManifest, out_root: Path) -> None:
+    """Хранилище фрагментов PDF и его запись в общем индексе фрагментов."""
+    with metrics_scope(stage="export", pdf=manifest.dir.name):
+        entry = export_and_index(manifest.dir, out_root, manifest.pdf_info())
+    files = entry["jsonl"] if entry["parquet"] is None else f"{entry['jsonl']}, {entry['parquet']}"
+    print(f"Хранилище фрагментов: {files} (строк: {entry['rows']})")
+
+
+def project_run_tokens(
+    pdf_files: List[Path],
+    budget: TokenBudget,
+    route_mode: str = "auto",
+    stage4_mode: str = "incremental",
+    stage4_fan_in: int = 4,
+) -> RunProjection:
     """
-    creds = get_creds()
-    access_token = creds.get("access_token")
-    if not access_token:
-        raise RuntimeError(
-            f"Токен не получен от NGW. Ответ: {creds}. "
-            "Проверьте переменную окружения GIGA_ACCESS_KEY и доступ к NGW."
+    Прогноз запросов и токенов прогона до первого запроса к модели — по текстовому слою
+    страниц (в настоящих токенах, /tokens/count) и маршрутам этапа 2.
+    Инструкция страницы оценивается длиной её текстового слоя, изображение —
+    GIGA_IMAGE_PROMPT_TOKENS; кэш ответов и --resume не учитываются, поэтому это оценка сверху.
+    """
+    projection = RunProjection()
+    window = budget.context_tokens
+    ocr_messages = build_ocr_payload("")["messages"]
+    ocr_prompt = budget.prompt_tokens(ocr_messages[0]["content"], ocr_messages[1]["content"]) + GIGA_IMAGE_PROMPT_TOKENS
+    leaf_base = budget.prompt_tokens(STAGE4_SYS_PROMPT, build_stage4_page_question(1, ""))
+    step_base = budget.prompt_tokens(
+        STAGE4_SYS_PROMPT,
+        build_stage4_delta_question(2, "", "") if stage4_mode == "delta"
+        else build_stage4_incremental_question(2, "", ""),
+    )
+    merge_base = budget.prompt_tokens(STAGE4_SYS_PROMPT, build_stage4_merge_question([(1, 1, ""), (2, 2, "")]))
+    stage4_label = f"этап 4 ({stage4_mode})"
+
+    for pdf_path in pdf_files:
+        with fitz.open(pdf_path) as doc:
+            pages = [
+                (page.get_text("text"), classify_page(page).route if route_mode == "auto" else ROUTE_VISION)
+                for page in doc
+            ]
+        questions = [
+            (STAGE2_TEXT_SYS_PROMPT, build_text_only_question(text)) if route == ROUTE_TEXT
+            else (STAGE2_MERGE_SYS_PROMPT, build_merge_question(text, ""))
+            for text, route in pages
+        ]
+        # Все строки PDF считаются пачкой, дальше prompt_tokens берёт их из кэша
+        text_tokens = budget.count_many([text for text, _ in pages])
+        budget.count_many([question for _, question in questions])
+
+        instructions = []
+        for (text, route), (sys_prompt, question), tokens in zip(pages, questions, text_tokens):
+            prompt = budget.prompt_tokens(sys_prompt, question)
+            if route == ROUTE_TEXT:
+                projection.add("этап 2: текст", TEXT_MODEL, prompt, tokens)
+            else:
+                projection.add("этап 2: распознавание", VISION_MODEL, ocr_prompt, tokens)
+                projection.add("этап 2: объединение", TEXT_MODEL, prompt + tokens, tokens)
+            if tokens:
+                instructions.append(tokens)
+
+        # Этап 4: ответ длиннее входа на теги источников
+        if stage4_mode == "tree":
+            nodes = []
+            for tokens in instructions:
+                completion = _stage4_completion_tokens(tokens)
+                projection.add(stage4_label, TEXT_MODEL, leaf_base + tokens, completion)
+                nodes.append(completion)
+            while len(nodes) > 1:
+                groups = [nodes[i:i + stage4_fan_in] for i in range(0, len(nodes), stage4_fan_in)]
+                for group in groups:
+                    if len(group) > 1:
+                        content = sum(group)
+                        projection.add(stage4_label, TEXT_MODEL, merge_base + content, content)
+                        projection.overflows += merge_base + 2 * content > window
+                nodes = [sum(group) for group in groups]
+        else:
+            doc_tokens = 0
+            for tokens in instructions:
+                completion = _stage4_completion_tokens(tokens)
+                if not doc_tokens:
+                    prompt = leaf_base + tokens
+                else:
+                    prompt = step_base + doc_tokens + tokens
+                    if stage4_mode != "delta":
+                        # incremental возвращает весь документ заново
+                        completion += doc_tokens
+                projection.add(stage4_label, TEXT_MODEL, prompt, completion)
+                projection.overflows += prompt + completion > window
+                doc_tokens += _stage4_completion_tokens(tokens)
+    return projection
+
+
+def run_pipeline(
+    pdf_dir: Path,
+    out_root: Path,
+    workers: int = 4,
+    async_io: bool = False,
+    rps: float | None = None,
+    tpm: float | None = None,
+    cache_path: Path | None = None,
+    resume: bool = False,
+    stage4_mode: str = "incremental",
+    stage4_fan_in: int = 4,
+    render_workers: int = 1,
+    route_mode: str = "auto",
+    image_budget_kb: float | None = None,
+    save_images: bool = True,
+    vision_input: str = "auto",
+    vision_batch_size: int = 1,
+    dedup: bool = True,
+    file_registry_path: Path | None = None,
+    cleanup_files: bool = False,
+    batch: bool = False,
+    stream: bool = False,
+    token_budget: bool = False,
+    plan_only: bool = False,
+    vector_index: bool = False,
+    chunk_export: bool = True,
+) -> None:
+    """
+    Запускает все этапы пайплайна для всех PDF в указанном каталоге.
+    workers  — сколько страниц одновременно обрабатывается на этапе 2;
+    async_io — этап 2 на asyncio/aiohttp вместо пула потоков;
+    rps, tpm — лимиты запросов/сек и токенов/мин на модель (None — из окружения);
+    cache_path — файл кэша ответов GigaChat (None — без кэша);
+    resume   — пропускать этапы и страницы, уже выполненные по тем же входным данным
+               (по манифесту out/<pdf>/manifest.json): после сбоя или обновления PDF
+               через GigaChat проходят только оставшиеся и изменённые страницы;
+    stage4_mode — "incremental" (последовательное накопление контекста),
+               "delta" (то же, но модель возвращает только новые строки страницы) или
+               "tree" (параллельное иерархическое слияние по stage4_fan_in узлов);
+    render_workers — сколько процессов рендерят страницы на этапе 1 (страницы всех PDF
+               ставятся в общий пул, поэтому несколько PDF рендерятся параллельно);
+    route_mode — "auto": страницы без изображений и графики обрабатываются одним текстовым
+               запросом; "vision": все страницы через разбор изображения;
+    image_budget_kb — бюджет размера JPEG страницы (None — GIGA_IMAGE_TARGET_KB);
+    save_images — сохранять page.jpg на диск; без этого этап 2 рендерит скриншот в память;
+    vision_input — "auto": если на странице отдельные скриншоты/рисунки, модели отправляются
+               только они вместе с текстовым слоем; "page": всегда страница целиком;
+    vision_batch_size — сколько страниц распознавать одним запросом (1 — по одной);
+    dedup    — одинаковые и почти одинаковые страницы (по всем PDF каталога) обрабатывать
+               один раз и копировать результат в дубликаты;
+    file_registry_path — реестр загруженных изображений (хэш -> file_id): одинаковые
+               изображения не загружаются повторно между запусками (None — без реестра);
+    cleanup_files — в конце прогона удалить из хранилища GigaChat все файлы реестра;
+    batch    — этап 2 для всех PDF через пакетные задачи GigaChat (POST /batches) вместо
+               постраничных запросов: дольше, но дешевле и без лимитов частоты; состояние
+               отправленных задач — в <out_root>/batch_state.json;
+    stream   — ответы этапа 4 получать потоком (SSE) и писать на диск по мере генерации;
+    token_budget — до запуска вывести прогноз токенов и стоимости прогона, а запросы этапа 4
+               проверять по размеру в токенах до отправки (сократить контекст, разделить
+               страницу) и выбирать max_tokens по оставшемуся окну модели;
+    plan_only — только вывести прогноз и выйти, без этапов пайплайна;
+    vector_index — этап 5: эмбеддинги итоговых инструкций всех PDF в <out_root>/vector_index
+               (заново считаются только изменённые фрагменты);
+    chunk_export — по завершении этапов 3–4 каждого PDF писать хранилище фрагментов
+               out/<pdf>/chunks.jsonl (и .parquet при установленном pyarrow) и индекс
+               <out_root>/chunks_index.json.
+    """
+    rate_limiter = RateLimiter.from_env()
+    if rps is not None or tpm is not None:
+        rate_limiter.default = ModelLimit(
+            rps=rps if rps is not None else rate_limiter.default.rps,
+            tpm=tpm if tpm is not None else rate_limiter.default.tpm,
         )
 
+    # Пул соединений не меньше числа воркеров, иначе параллельные запросы
+    # будут открывать лишние соединения сверх пула
+    configure_client(pool_size=max(GIGA_POOL_SIZE, workers), rate_limiter=rate_limiter)
+    # Телеметрия прогона: время этапов и страниц, каждый запрос к GigaChat -> run_report.json
+    metrics = RunMetrics()
+    set_run_metrics(metrics)
+
+    # Токен обновляется автоматически (заранее по expires_at и после 401),
+    # поэтому длинные прогоны не обрываются посередине. Первый запрос к NGW
+    # делаем сразу, чтобы упасть до рендеринга страниц, если доступа нет.
+    access_token = TokenManager()
+    access_token.get_token()
+
     pdf_dir = pdf_dir.resolve()
     out_root = out_root.resolve()
     out_root.mkdir(parents=True, exist_ok=True)
 
+    # Кэш ответов: повторный прогон по тем же страницам не платит за те же запросы
+    cache = ResponseCache(cache_path) if cache_path is not None else None
+    set_response_cache(cache)
+
     pdf_files = sorted(pdf_dir.glob("*.pdf"))
     if not pdf_files:
         print(f"В каталоге {pdf_dir} не найдено PDF-файлов.")
         return
 
-    for pdf_path in pdf_files:
-        print(f"\n=== Обработка PDF: {pdf_path.name} ===")
+    # Бюджет токенов: прогноз расхода до первого запроса к модели
+    budget = TokenBudget(access_token) if token_budget or plan_only else None
+    if budget is not None:
+        print(project_run_tokens(pdf_files, budget, route_mode, stage4_mode, stage4_fan_in).format())
+    if plan_only:
+        if cache is not None:
+            set_response_cache(None)
+            cache.close()
+        set_run_metrics(None)
+        return
 
-        # Этап 1: извлечение страниц
-        page_infos = stage1_extract_pages(pdf_path, out_root)
-        print(f"Этап 1: извлечено страниц: {len(page_infos)}")
+    # Реестр загрузок: перед прогоном сверяется со списком файлов хранилища (GET /files)
+    registry = FileRegistry(file_registry_path) if file_registry_path is not None else None
+    if registry is not None:
+        try:
+            stale = sync_file_registry(registry, access_token)
+        except requests.RequestException as e:
+            # Без сверки переиспользуются только файлы, загруженные в этом прогоне
+            print(f"Не удалось получить список файлов GigaChat ({e}), загруженные ранее файлы не переиспользуются.")
+            registry.trust_since(time.time())
+        else:
+            if stale:
+                print(f"Реестр загрузок: файлов, которых больше нет в хранилище: {stale}")
+        set_file_registry(registry)
 
-        # Этап 2: GigaChat для каждой страницы
-        for info in page_infos:
-            page_num = info["page_num"]
-            page_dir = info["dir"]
-            text_path = info["text_path"]
-            image_path = info["image_path"]
+    policy = RenderPolicy(target_bytes=int(image_budget_kb * 1024)) if image_budget_kb else RenderPolicy()
+    stage1_pages = _stage1_pages_per_pdf(pdf_files, out_root, resume, render_workers, policy, save_images)
+    # Индекс повторяющихся страниц общий для всех PDF каталога
+    dedup_index = PageDedupIndex() if dedup else None
+    batch_state_path = out_root / "batch_state.json"
+    stage2 = stage2_process_pages_async if async_io else stage2_process_pages
+    stage2_kwargs = dict(workers=workers, resume=resume, vision_batch_size=vision_batch_size)
+    stage34_kwargs = dict(
+        workers=workers, resume=resume, stage4_mode=stage4_mode, stage4_fan_in=stage4_fan_in, stream=stream,
+        budget=budget,
+    )
 
-            print(f"Этап 2: страница {page_num} ({page_dir})")
+    if batch:
+        # Пакетный режим: сначала этап 1 и планирование этапа 2 для всех PDF,
+        # затем все запросы этапа 2 одним набором пакетных задач, затем этапы 3–4
+        prepared = []
+        for pdf_path, manifest, page_infos in stage1_pages:
+            stage2_pages, duplicates = _stage2_prepare(page_infos, route_mode, vision_input, dedup_index)
+            todo, ready = _stage2_plan(stage2_pages, manifest, resume)
+            prepared.append((pdf_path, manifest, page_infos, stage2_pages, duplicates, todo, ready))
+        jobs = [(info, manifest) for _, manifest, _, _, _, todo, _ in prepared for info in todo]
+        print(f"\n=== Этап 2 (--batch): страниц по всем PDF: {len(jobs)} ===")
+        with metrics_scope(stage="stage2"):
             try:
-                instruction = stage2_build_instruction_for_page(
-                    text_path=text_path,
-                    image_path=image_path,
-                    access_token=access_token,
-                )
-            except ValueError as e:
-                # Ошибки размера/загрузки/валидации обрабатываем мягко, но логируем
-                print(f"  Ошибка при обработке страницы {page_num}: {e}")
-                continue
+                done = {id(info) for info in stage2_process_pages_batch(jobs, access_token, batch_state_path, workers)}
+            finally:
+                for _, manifest, *_ in prepared:
+                    manifest.flush()
 
-            instr_path = page_dir / "instruction.txt"
-            instr_path.write_text(instruction, encoding="utf-8")
+        for pdf_path, manifest, page_infos, stage2_pages, duplicates, todo, ready in prepared:
+            print(f"\n=== Этапы 3–4: {pdf_path.name} ===")
+            instructions = dict(ready)
+            for info in todo:
+                if id(info) in done:
+                    instructions[info["page_num"]] = info["dir"] / "instruction.txt"
+            # Дубликаты страниц, не полученных из пакета, ждут следующего запуска
+            _stage2_resolve_duplicates(instructions, stage2_pages, duplicates, dedup_index, None, manifest)
+            print(f"Этап 2: обработано страниц: {len(instructions)} из {len(page_infos)}")
+            _run_stages_3_4(manifest, access_token, **stage34_kwargs)
+            if chunk_export:
+                _export_chunks(manifest, out_root)
+    else:
+        for pdf_path, manifest, page_infos in stage1_pages:
+            stage2_pages, duplicates = _stage2_prepare(page_infos, route_mode, vision_input, dedup_index)
 
-        # Этап 3: склейка по PDF (страницы как независимые инструкции)
-        pdf_out_dir = out_root / pdf_path.stem
-        merged_path = stage3_merge_pdf_instructions(pdf_out_dir)
-        print(f"Этап 3: итоговый документ (страницы по отдельности): {merged_path}")
+            # Этап 2: GigaChat для каждой страницы (параллельно, до workers страниц)
+            with metrics_scope(stage="stage2", pdf=manifest.dir.name):
+                try:
+                    instructions = stage2(stage2_pages, access_token, manifest=manifest, **stage2_kwargs)
+                    _stage2_resolve_duplicates(
+                        instructions, stage2_pages, duplicates, dedup_index,
+                        lambda pages: stage2(pages, access_token, manifest=manifest, **stage2_kwargs),
+                        manifest,
+                    )
+                finally:
+                    # Отложенные постраничные записи манифеста — на диск, даже если этап упал
+                    manifest.flush()
+            print(f"Этап 2: обработано страниц: {len(instructions)} из {len(page_infos)}")
+            _run_stages_3_4(manifest, access_token, **stage34_kwargs)
+            if chunk_export:
+                _export_chunks(manifest, out_root)
 
-        # Этап 4: инкрементальное накопление смысла по страницам
-        incremental_path = stage4_build_incremental_context(pdf_out_dir, access_token)
-        print(f"Этап 4: итоговый документ с накопленным контекстом: {incremental_path}")
+    if vector_index:
+        # numpy нужен только для этапа 5, поэтому импортируем по месту
+        from vector_index import update_index
+
+        print("\n=== Этап 5: векторный индекс ===")
+        with metrics_scope(stage="stage5"):
+            index_stats = update_index(out_root, out_root / "vector_index", access_token)
+        print(
+            f"Векторный индекс: фрагментов {index_stats['chunks']}, "
+            f"эмбеддингов посчитано {index_stats['embedded']}, взято из индекса {index_stats['reused']}"
+        )
 
     # После обработки всех PDF выводим суммарное потребление токенов
     stats = get_token_stats()
@@ -320,8 +1952,33 @@ def run_pipeline(pdf_dir: Path, out_root: Path) -> None:
         "\nИТОГО по всем запросам GigaChat в этом запуске скрипта:\n"
         f"- prompt_tokens     = {stats.get('prompt_tokens', 0)}\n"
         f"- completion_tokens = {stats.get('completion_tokens', 0)}\n"
-        f"- total_tokens      = {stats.get('total_tokens', 0)}"
+        f"- total_tokens      = {stats.get('total_tokens', 0)}\n"
+        f"- precached_prompt_tokens = {stats.get('precached_prompt_tokens', 0)} (из кэша GigaChat)"
     )
+    if budget is not None:
+        print(f"Бюджет токенов, решения по запросам этапа 4: {budget.summary()}")
+    if cache is not None:
+        cache_stats = cache.stats()
+        print(
+            f"Кэш ответов ({cache.path}): попаданий {cache_stats['hits']}, "
+            f"промахов {cache_stats['misses']}, записей {cache_stats['entries']}"
+        )
+        set_response_cache(None)
+        cache.close()
+    if registry is not None:
+        registry_stats = registry.stats()
+        print(
+            f"Реестр загрузок ({registry.path}): переиспользовано файлов {registry_stats['reused']}, "
+            f"загружено {registry_stats['uploaded']}, в хранилище {registry_stats['entries']}"
+        )
+        if cleanup_files:
+            print(f"Удалено файлов из хранилища GigaChat: {cleanup_uploaded_files(registry, access_token)}")
+        set_file_registry(None)
+        registry.close()
+
+    report_path = metrics.write_report(out_root / "run_report.json")
+    set_run_metrics(None)
+    print(f"\nТелеметрия прогона ({report_path}):\n{metrics.format_summary()}")
 
 
 def main() -> None:
@@ -347,9 +2004,261 @@ def main() -> None:
         help="Каталог, куда складывать результаты пайплайна.",
 		default="out",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Сколько страниц одновременно обрабатывать на этапе 2 (запросы к GigaChat). По умолчанию 4.",
+    )
+
+    parser.add_argument(
+        "--render-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help=(
+            "Сколько процессов рендерят страницы на этапе 1 (1 — в основном процессе). "
+            "По умолчанию — число ядер CPU."
+        ),
+    )
+
+    parser.add_argument(
+        "--route",
+        choices=("auto", ROUTE_VISION),
+        default="auto",
+        help=(
+            "Маршрут этапа 2: auto — страницы без изображений и векторной графики обрабатываются "
+            "одним текстовым запросом без распознавания скриншота; vision — все страницы через "
+            "распознавание скриншота. По умолчанию auto."
+        ),
+    )
+
+    parser.add_argument(
+        "--vision-input",
+        choices=("auto", "page"),
+        default="auto",
+        help=(
+            "Что отправлять на распознавание для страниц со скриншотами: auto — только вырезанные "
+            "области скриншотов и рисунков вместе с текстовым слоем (если их удалось выделить); "
+            "page — страницу целиком. По умолчанию auto."
+        ),
+    )
+
+    parser.add_argument(
+        "--vision-batch-size",
+        type=int,
+        default=1,
+        help=(
+            f"Сколько страниц распознавать одним запросом (до {MAX_IMAGES_PER_REQUEST}, по одному "
+            "изображению на сообщение). Ответ делится по разделителям страниц; если разделить "
+            "не удалось, страницы пакета распознаются по одной. По умолчанию 1 — без пакетов."
+        ),
+    )
+
+    parser.add_argument(
+        "--no-dedup",
+        action="store_true",
+        help=(
+            "Не искать повторяющиеся страницы. По умолчанию страницы с тем же текстовым слоем "
+            "и почти тем же изображением (по всем PDF каталога) обрабатываются один раз, "
+            "результат копируется в дубликаты."
+        ),
+    )
+
+    parser.add_argument(
+        "--image-budget-kb",
+        type=float,
+        default=None,
+        help=(
+            "Бюджет размера JPEG страницы в Кб: DPI и качество подбираются, чтобы уложиться в него. "
+            "По умолчанию из GIGA_IMAGE_TARGET_KB (800)."
+        ),
+    )
+    parser.add_argument(
+        "--no-save-images",
+        action="store_true",
+        help="Не сохранять page.jpg: скриншоты для распознавания рендерятся в память на этапе 2.",
+    )
+
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help=(
+            "Пакетный режим для ночной переиндексации: запросы этапа 2 по всем PDF собираются в JSONL "
+            "и отправляются пакетными задачами GigaChat (POST /batches), результат ожидается опросом, "
+            "затем выполняются этапы 3–4. Дольше, но дешевле и без лимитов частоты на каждый запрос. "
+            "Прерванное ожидание продолжается повторным запуском (<out-dir>/batch_state.json)."
+        ),
+    )
+
+    parser.add_argument(
+        "--async-io",
+        action="store_true",
+        help="Этап 2 на asyncio/aiohttp (один поток, --workers одновременных запросов).",
+    )
+
+    parser.add_argument(
+        "--rps",
+        type=float,
+        default=None,
+        help="Лимит запросов в секунду на модель (0 — без лимита). По умолчанию из GIGA_RATE_LIMIT_RPS.",
+    )
+    parser.add_argument(
+        "--tpm",
+        type=float,
+        default=None,
+        help="Лимит токенов в минуту на модель (0 — без лимита). По умолчанию из GIGA_RATE_LIMIT_TPM.",
+    )
+
+    parser.add_argument(
+        "--cache-path",
+        type=str,
+        default="",
+        help="Файл кэша ответов GigaChat (SQLite). По умолчанию <out-dir>/.giga_cache.sqlite.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Не использовать кэш ответов: все запросы идут в GigaChat.",
+    )
+
+    parser.add_argument(
+        "--file-registry-path",
+        type=str,
+        default="",
+        help=(
+            "Реестр загруженных изображений (SQLite, хэш содержимого -> file_id GigaChat): "
+            "одинаковые изображения не загружаются повторно. По умолчанию <out-dir>/.giga_files.sqlite."
+        ),
+    )
+    parser.add_argument(
+        "--no-file-registry",
+        action="store_true",
+        help="Не использовать реестр загрузок: каждое изображение загружается заново.",
+    )
+    parser.add_argument(
+        "--cleanup-files",
+        action="store_true",
+        help="В конце прогона удалить из хранилища GigaChat все файлы из реестра загрузок.",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help=(
+            "Продолжить прерванный прогон или дообработать обновлённые PDF: через GigaChat проходят "
+            "только новые и изменённые страницы (по отпечаткам текста и изображения), "
+            "остальное берётся из прошлого прогона (см. out/<pdf>/manifest.json)."
+        ),
+    )
+
+    parser.add_argument(
+        "--stage4-mode",
+        choices=STAGE4_MODES,
+        default="incremental",
+        help=(
+            "Как строить instructions_incremental.md: incremental — последовательно, страница за "
+            "страницей с полным накопленным контекстом; delta — так же, но модель возвращает только "
+            "новые строки страницы, документ дописывается локально; tree — параллельное иерархическое слияние "
+            "(намного меньше токенов и времени на длинных документах). По умолчанию incremental."
+        ),
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help=(
+            "Получать ответы этапа 4 потоком (SSE): текст пишется в *.partial по мере генерации, "
+            "время до первого токена печатается и сохраняется в manifest.json."
+        ),
+    )
+    parser.add_argument(
+        "--token-budget",
+        action="store_true",
+        help=(
+            "Считать размер запросов в токенах (/tokens/count): до запуска вывести прогноз токенов "
+            "и стоимости прогона, а запросы этапа 4, не помещающиеся в окно модели, сокращать или делить."
+        ),
+    )
+    parser.add_argument(
+        "--plan-only",
+        action="store_true",
+        help="Только вывести прогноз токенов и стоимости прогона (как --token-budget) и выйти.",
+    )
+    parser.add_argument(
+        "--no-chunk-export",
+        action="store_true",
+        help=(
+            "Не писать хранилище фрагментов. По умолчанию после этапов 3–4 каждого PDF пишется "
+            "out/<pdf>/chunks.jsonl (и chunks.parquet, если установлен pyarrow) — по строке на фрагмент "
+            "с PDF, страницей, этапом и хэшами — и индекс <out-dir>/chunks_index.json для поиска по PDF и странице."
+        ),
+    )
+    parser.add_argument(
+        "--vector-index",
+        action="store_true",
+        help=(
+            "Этап 5: эмбеддинги итоговых инструкций (POST /embeddings) и локальный векторный индекс "
+            "в <out-dir>/vector_index; заново считаются только изменённые фрагменты. "
+            "Поиск: python vector_index.py --out-dir <out-dir> --query \"...\"."
+        ),
+    )
+    parser.add_argument(
+        "--stage4-fan-in",
+        type=int,
+        default=4,
+        help="Сколько соседних фрагментов сливать за один запрос в режиме tree. По умолчанию 4.",
+    )
 
     args = parser.parse_args()
-    run_pipeline(pdf_dir=Path(args.pdf_dir), out_root=Path(args.out_dir))
+    if args.workers < 1:
+        parser.error("--workers должен быть не меньше 1")
+    if not 1 <= args.vision_batch_size <= MAX_IMAGES_PER_REQUEST:
+        parser.error(f"--vision-batch-size должен быть от 1 до {MAX_IMAGES_PER_REQUEST}")
+    if args.render_workers < 1:
+        parser.error("--render-workers должен быть не меньше 1")
+    if args.stage4_fan_in < 2:
+        parser.error("--stage4-fan-in должен быть не меньше 2")
+    if args.no_cache:
+        cache_path = None
+    elif args.cache_path:
+        cache_path = Path(args.cache_path)
+    else:
+        cache_path = Path(args.out_dir) / ".giga_cache.sqlite"
+    if args.no_file_registry:
+        if args.cleanup_files:
+            parser.error("--cleanup-files удаляет файлы по реестру загрузок и несовместим с --no-file-registry")
+        file_registry_path = None
+    elif args.file_registry_path:
+        file_registry_path = Path(args.file_registry_path)
+    else:
+        file_registry_path = Path(args.out_dir) / ".giga_files.sqlite"
+
+    run_pipeline(
+        pdf_dir=Path(args.pdf_dir),
+        out_root=Path(args.out_dir),
+        workers=args.workers,
+        async_io=args.async_io,
+        rps=args.rps,
+        tpm=args.tpm,
+        cache_path=cache_path,
+        resume=args.resume,
+        stage4_mode=args.stage4_mode,
+        stage4_fan_in=args.stage4_fan_in,
+        render_workers=args.render_workers,
+        route_mode=args.route,
+        image_budget_kb=args.image_budget_kb,
+        save_images=not args.no_save_images,
+        vision_input=args.vision_input,
+        vision_batch_size=args.vision_batch_size,
+        dedup=not args.no_dedup,
+        file_registry_path=file_registry_path,
+        cleanup_files=args.cleanup_files,
+        batch=args.batch,
+        stream=args.stream,
+        token_budget=args.token_budget,
+        plan_only=args.plan_only,
+        vector_index=args.vector_index,
+        chunk_export=not args.no_chunk_export,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,155 @@
+"""
+Постоянный кэш ответов GigaChat на диске (SQLite).
+
+Ключ — SHA-256 от модели, сообщений, хэшей содержимого вложений и параметров
+генерации. Идентификаторы файлов (file_id) в ключ не входят: одно и то же
+изображение при каждой загрузке получает новый file_id, поэтому вместо него
+используется хэш байтов изображения.
+
+Вытеснение: записи старше max_age_days удаляются, а при превышении max_bytes
+удаляются давно не использованные (LRU по last_access).
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterable
+
+# Лимиты кэша по умолчанию
+GIGA_CACHE_MAX_MB = float(os.getenv("GIGA_CACHE_MAX_MB", "512"))
+GIGA_CACHE_MAX_AGE_DAYS = float(os.getenv("GIGA_CACHE_MAX_AGE_DAYS", "30"))
+
+# Вытеснение проверяем не на каждой записи, а раз в столько записей
+_EVICT_EVERY = 100
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(payload: dict, attachment_hashes: Iterable[str] = ()) -> str:
+    """
+    Ключ кэша для тела запроса chat/completions.
+    attachments в сообщениях отбрасываются и заменяются хэшами содержимого файлов;
+    поле stream на результат не влияет и тоже не учитывается.
+    """
+    messages = []
+    for message in payload.get("messages") or []:
+        messages.append({k: v for k, v in message.items() if k != "attachments"})
+    params = {
+        k: v for k, v in payload.items() if k not in ("model", "messages", "stream")
+    }
+    canonical = json.dumps(
+        {
+            "model": payload.get("model"),
+            "messages": messages,
+            "attachments": list(attachment_hashes),
+            "params": params,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return content_hash(canonical.encode("utf-8"))
+
+
+class ResponseCache:
+    """
+    Кэш «ключ -> текст ответа модели».
+    Одно соединение SQLite на процесс, доступ из потоков под блокировкой.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_bytes: int = int(GIGA_CACHE_MAX_MB * 1024 * 1024),
+        max_age_days: float = GIGA_CACHE_MAX_AGE_DAYS,
+    ) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self.evict()
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.max_age > 0 and now - row[1] > self.max_age):
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now, now),
+            )
+            self._conn.commit()
+            self._puts += 1
+            need_evict = self._puts % _EVICT_EVERY == 0
+        if need_evict:
+            self.evict()
+
+    def evict(self) -> int:
+        """Удалить устаревшие записи и LRU-хвост сверх max_bytes. Возвращает число удалённых."""
+        removed = 0
+        with self._lock:
+            if self.max_age > 0:
+                cur = self._conn.execute(
+                    "DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,)
+                )
+                removed += cur.rowcount
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if self.max_bytes > 0 and total > self.max_bytes:
+                excess = total - self.max_bytes
+                victims = []
+                for key, size in self._conn.execute(
+                    "SELECT key, size FROM responses ORDER BY last_access ASC"
+                ):
+                    victims.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+                removed += len(victims)
+            self._conn.commit()
+        return removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,321 @@
+"""
+Телеметрия прогона: время этапов и страниц, каждый запрос к GigaChat и расход токенов.
+
+- metrics_scope(stage=..., pdf=..., page=...) — область, к которой относятся запросы
+  внутри неё; при выходе её время (wall) добавляется в отчёт. Области вкладываются:
+  не заданные поля берутся из внешней. Хранится в contextvars, поэтому задачи asyncio
+  наследуют её сами, а в пул потоков функцию передают через in_scope(fn);
+- CallTimer — замеры одного вызова send(): ожидание лимитера/семафора (queue), время
+  HTTP, ожидание между повторами, число повторов, объём отправленных данных;
+- токены (usage из ответов, включая precached_prompt_tokens) приписываются последнему
+  запросу текущего потока/задачи и его области.
+
+Сбор включается set_run_metrics(RunMetrics()); без этого вызовы ничего не стоят.
+RunMetrics.report() — словарь для run_report.json: итоги, по этапам, по PDF (с этапами
+и страницами), по эндпоинтам и список всех запросов; format_summary() — таблица для лога.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, NamedTuple
+from urllib.parse import urlparse
+
+USAGE_KEYS = ("prompt_tokens", "completion_tokens", "total_tokens", "precached_prompt_tokens")
+_TIME_KEYS = ("wall_s", "queue_wait_s", "http_s", "retry_wait_s")
+_COUNT_KEYS = ("calls", "errors", "retries", "bytes_up") + USAGE_KEYS
+
+# Сколько самых долгих страниц показывать в сводке
+SUMMARY_SLOWEST_PAGES = 5
+
+NO_STAGE = "-"
+
+
+class Scope(NamedTuple):
+    stage: str | None = None
+    pdf: str | None = None
+    page: int | None = None
+
+
+_SCOPE: ContextVar[Scope] = ContextVar("run_metrics_scope", default=Scope())
+# Последний запрос текущего потока/задачи: к нему относится следующий usage
+_LAST_CALL: ContextVar[dict | None] = ContextVar("run_metrics_last_call", default=None)
+
+
+def _empty() -> dict:
+    return {key: 0.0 for key in _TIME_KEYS} | {key: 0 for key in _COUNT_KEYS}
+
+
+def _add(target: dict, values: dict) -> None:
+    for key, value in values.items():
+        if key in target:
+            target[key] += value
+
+
+def _rounded(node: dict) -> dict:
+    return {key: round(value, 3) if isinstance(value, float) else value for key, value in node.items()}
+
+
+def _body_bytes(value) -> int:
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    return 0
+
+
+def request_bytes(kwargs: dict) -> int:
+    """Объём тела запроса requests/aiohttp: data, json и files (multipart без служебных заголовков)."""
+    data = kwargs.get("data")
+    if isinstance(data, dict):
+        total = sum(len(str(key)) + _body_bytes(str(value)) for key, value in data.items())
+    else:
+        total = _body_bytes(data)
+    if kwargs.get("json") is not None:
+        total += len(json.dumps(kwargs["json"], ensure_ascii=False).encode("utf-8"))
+    for value in (kwargs.get("files") or {}).values():
+        total += _body_bytes(value[1] if isinstance(value, tuple) else value)
+    return total
+
+
+def endpoint_name(url: str) -> str:
+    """'https://.../api/v1/chat/completions' -> 'chat/completions', '.../files/<id>/content' -> 'files/{id}/content'."""
+    path = urlparse(url).path.strip("/")
+    for prefix in ("api/v1/", "api/v2/"):
+        if path.startswith(prefix):
+            path = path[len(prefix):]
+            break
+    # Идентификаторы файлов в пути (files/<id>/content) не плодят отдельные эндпоинты
+    segments = ["{id}" if len(part) >= 16 and any(c.isdigit() for c in part) else part for part in path.split("/")]
+    return "/".join(segments) or url
+
+
+class RunMetrics:
+    """Потокобезопасный сборщик телеметрии одного прогона."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.totals = _empty()
+        self.stages: Dict[str, dict] = {}
+        self.pdfs: Dict[str, dict] = {}
+        self.endpoints: Dict[str, dict] = {}
+        self.calls: List[dict] = []
+
+    def _pdf(self, pdf: str) -> dict:
+        return self.pdfs.setdefault(pdf, {**_empty(), "stages": {}, "pages": {}})
+
+    def _nodes(self, scope: Scope, endpoint: str | None) -> Iterator[dict]:
+        """Все узлы отчёта, в которые идёт событие области scope."""
+        yield self.totals
+        stage = scope.stage or NO_STAGE
+        yield self.stages.setdefault(stage, _empty())
+        if scope.pdf is not None:
+            pdf = self._pdf(scope.pdf)
+            yield pdf
+            yield pdf["stages"].setdefault(stage, _empty())
+            if scope.page is not None:
+                yield pdf["pages"].setdefault(f"{scope.page:03d}", _empty())
+        if endpoint is not None:
+            yield self.endpoints.setdefault(endpoint, _empty())
+
+    def record_call(self, call: dict) -> None:
+        scope = Scope(call["stage"], call["pdf"], call["page"])
+        values = {key: call[key] for key in ("queue_wait_s", "http_s", "retry_wait_s", "retries", "bytes_up")}
+        values["calls"] = 1
+        values["errors"] = 0 if call["status"] is not None and call["status"] < 400 else 1
+        with self._lock:
+            call["started_s"] = round(call.pop("_started") - self._started, 3)
+            self.calls.append(call)
+            for node in self._nodes(scope, call["endpoint"]):
+                _add(node, values)
+
+    def record_usage(self, usage: dict) -> None:
+        values = {key: usage[key] for key in USAGE_KEYS if isinstance(usage.get(key), int)}
+        call = _LAST_CALL.get()
+        with self._lock:
+            if call is not None:
+                for key, value in values.items():
+                    call[key] = call.get(key, 0) + value
+                scope = Scope(call["stage"], call["pdf"], call["page"])
+                endpoint = call["endpoint"]
+            else:
+                scope, endpoint = _SCOPE.get(), None
+            for node in self._nodes(scope, endpoint):
+                _add(node, values)
+
+    def record_wall(self, scope: Scope, seconds: float) -> None:
+        """Время области: страницы — в странице PDF, этапа PDF — в этапе PDF и этапе, этапа — в этапе."""
+        stage = scope.stage or NO_STAGE
+        with self._lock:
+            if scope.pdf is not None and scope.page is not None:
+                self._pdf(scope.pdf)["pages"].setdefault(f"{scope.page:03d}", _empty())["wall_s"] += seconds
+            elif scope.pdf is not None:
+                pdf = self._pdf(scope.pdf)
+                pdf["wall_s"] += seconds
+                pdf["stages"].setdefault(stage, _empty())["wall_s"] += seconds
+                self.stages.setdefault(stage, _empty())["wall_s"] += seconds
+            else:
+                self.stages.setdefault(stage, _empty())["wall_s"] += seconds
+
+    def report(self) -> dict:
+        with self._lock:
+            totals = dict(self.totals, wall_s=time.monotonic() - self._started)
+            return {
+                "started_at": self.started_at,
+                "finished_at": time.time(),
+                "totals": _rounded(totals),
+                "stages": {stage: _rounded(node) for stage, node in self.stages.items()},
+                "pdfs": {
+                    name: {
+                        **_rounded({k: v for k, v in pdf.items() if k not in ("stages", "pages")}),
+                        "stages": {stage: _rounded(node) for stage, node in pdf["stages"].items()},
+                        "pages": {page: _rounded(node) for page, node in sorted(pdf["pages"].items())},
+                    }
+                    for name, pdf in self.pdfs.items()
+                },
+                "endpoints": {name: _rounded(node) for name, node in self.endpoints.items()},
+                "calls": [_rounded(call) for call in self.calls],
+            }
+
+    def write_report(self, path: Path) -> Path:
+        """run_report.json (атомарно, как манифест)."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(self.report(), ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp_path, path)
+        return path
+
+    def format_summary(self) -> str:
+        """Таблица по этапам, итог и самые долгие страницы."""
+        report = self.report()
+        header = (
+            f"{'Этап':<10}{'Время, с':>10}{'Запросы':>9}{'Повторы':>9}{'Ошибки':>8}"
+            f"{'HTTP, с':>10}{'Очередь, с':>12}{'Отправлено, МБ':>16}"
+            f"{'prompt':>10}{'completion':>12}{'precached':>11}"
+        )
+
+        def row(name: str, node: dict) -> str:
+            return (
+                f"{name:<10}{node['wall_s']:>10.1f}{node['calls']:>9}{node['retries']:>9}{node['errors']:>8}"
+                f"{node['http_s']:>10.1f}{node['queue_wait_s']:>12.1f}{node['bytes_up'] / 1024 / 1024:>16.2f}"
+                f"{node['prompt_tokens']:>10}{node['completion_tokens']:>12}{node['precached_prompt_tokens']:>11}"
+            )
+
+        lines = [header, "-" * len(header)]
+        lines += [row(stage, node) for stage, node in sorted(report["stages"].items())]
+        lines += ["-" * len(header), row("ИТОГО", report["totals"])]
+        pages = [
+            (node["wall_s"], pdf, page)
+            for pdf, pdf_node in report["pdfs"].items()
+            for page, node in pdf_node["pages"].items()
+        ]
+        slowest = sorted(pages, reverse=True)[:SUMMARY_SLOWEST_PAGES]
+        if slowest:
+            lines.append("Самые долгие страницы: " + ", ".join(f"{pdf}/{page} {wall:.1f} с" for wall, pdf, page in slowest))
+        return "\n".join(lines)
+
+
+_METRICS: RunMetrics | None = None
+
+
+def set_run_metrics(metrics: RunMetrics | None) -> None:
+    """Включить (RunMetrics) или выключить (None) сбор телеметрии для процесса."""
+    global _METRICS
+    _METRICS = metrics
+
+
+def get_run_metrics() -> RunMetrics | None:
+    return _METRICS
+
+
+@contextmanager
+def metrics_scope(stage: str | None = None, pdf: str | None = None, page: int | None = None) -> Iterator[Scope]:
+    """Область телеметрии; время выполнения блока записывается в отчёт при выходе."""
+    outer = _SCOPE.get()
+    scope = Scope(
+        stage if stage is not None else outer.stage,
+        pdf if pdf is not None else outer.pdf,
+        page if page is not None else outer.page,
+    )
+    token = _SCOPE.set(scope)
+    started = time.monotonic()
+    try:
+        yield scope
+    finally:
+        _SCOPE.reset(token)
+        metrics = _METRICS
+        if metrics is not None:
+            metrics.record_wall(scope, time.monotonic() - started)
+
+
+def in_scope(fn: Callable, stage: str | None = None, pdf: str | None = None, page: int | None = None) -> Callable:
+    """
+    fn, выполняемая в текущей области телеметрии (для ThreadPoolExecutor.submit):
+    потоки пула не наследуют contextvars. Заданные stage/pdf/page открывают вложенную
+    область, и её время тоже попадает в отчёт.
+    """
+    scope = _SCOPE.get()
+    nested = stage is not None or pdf is not None or page is not None
+
+    def run(*args, **kwargs):
+        token = _SCOPE.set(scope)
+        try:
+            if not nested:
+                return fn(*args, **kwargs)
+            with metrics_scope(stage, pdf, page):
+                return fn(*args, **kwargs)
+        finally:
+            _SCOPE.reset(token)
+
+    return run
+
+
+def record_usage(usage: dict) -> None:
+    metrics = _METRICS
+    if metrics is not None:
+        metrics.record_usage(usage)
+
+
+class CallTimer:
+    """
+    Замеры одного вызова send() с повторами; finish() записывает их в отчёт.
+    У потоковых ответов (SSE) http_s — время до заголовков ответа, чтение потока не входит.
+    """
+
+    def __init__(self, url: str, model: str | None = None) -> None:
+        self.url = url
+        self.model = model
+        self.queue_wait_s = 0.0
+        self.http_s = 0.0
+        self.retry_wait_s = 0.0
+        self.retries = 0
+        self._started = time.monotonic()
+
+    def finish(self, status: int | None, request_kwargs: dict, upload_bytes: int | None = None) -> None:
+        """status None — запрос завершился исключением (сеть, таймаут) после всех повторов."""
+        metrics = _METRICS
+        if metrics is None:
+            return
+        scope = _SCOPE.get()
+        call = {
+            "endpoint": endpoint_name(self.url),
+            "model": self.model,
+            "stage": scope.stage,
+            "pdf": scope.pdf,
+            "page": scope.page,
+            "status": status,
+            "retries": self.retries,
+            "queue_wait_s": self.queue_wait_s,
+            "http_s": self.http_s,
+            "retry_wait_s": self.retry_wait_s,
+            "bytes_up": upload_bytes if upload_bytes is not None else request_bytes(request_kwargs),
+            "_started": self._started,
+        }
+        metrics.record_call(call)
+        _LAST_CALL.set(call)
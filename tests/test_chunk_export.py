@@ -0,0 +1,91 @@
+import json
+
+from chunk_export import (
+    CHUNK_INDEX_NAME,
+    CHUNKS_JSONL,
+    NO_PAGE_KEY,
+    STAGE_DOCUMENT,
+    STAGE_PAGE,
+    export_and_index,
+    read_page_rows,
+)
+
+INCREMENTAL = """# Кредитная памятка
+Общие положения без тега
+Откройте карточку клиента [SOURCE: page 001]
+Сверьте паспорт с анкетой [SOURCE: page 002]
+Проверьте статус заявки [SOURCE: page 003]
+"""
+
+
+def _build_pdf(out_root, pages):
+    pdf_dir = out_root / "памятка"
+    pdf_dir.mkdir(parents=True, exist_ok=True)
+    for page_num in range(1, pages + 1):
+        page_dir = pdf_dir / f"page_{page_num:03d}"
+        page_dir.mkdir(exist_ok=True)
+        (page_dir / "instruction.txt").write_text(
+            f"# Раздел {page_num}\nШаг страницы {page_num}\n# Примечание\nТекст примечания {page_num}\n",
+            encoding="utf-8",
+        )
+    (pdf_dir / "instructions_incremental.md").write_text(INCREMENTAL, encoding="utf-8")
+    return pdf_dir
+
+
+def _pdf_info(page_count):
+    return {"name": "памятка.pdf", "sha256": "abc", "page_count": page_count}
+
+
+def test_read_page_rows_round_trip(tmp_path):
+    pdf_dir = _build_pdf(tmp_path, 3)
+    entry = export_and_index(pdf_dir, tmp_path, _pdf_info(3), parquet=False)
+    assert entry["rows"] == sum(block[2] for block in entry["pages"].values())
+
+    rows = read_page_rows(tmp_path, "памятка", 2)
+    assert [(row["stage"], row["seq"], row["section"]) for row in rows] == [
+        (STAGE_PAGE, 0, "Раздел 2"),
+        (STAGE_PAGE, 1, "Примечание"),
+        (STAGE_DOCUMENT, 0, "Кредитная памятка"),
+    ]
+    assert all(row["page"] == 2 and row["pdf_file"] == "памятка.pdf" for row in rows)
+    # Тег источника из текста строки stage4 убран
+    assert rows[-1]["text"] == "Сверьте паспорт с анкетой"
+
+    # Смещения из индекса указывают ровно на строки страницы в chunks.jsonl
+    offset, length, count = entry["pages"]["002"]
+    data = (pdf_dir / CHUNKS_JSONL).read_bytes()[offset:offset + length]
+    assert [json.loads(line) for line in data.decode("utf-8").splitlines()] == rows
+    assert count == len(rows)
+    assert read_page_rows(tmp_path, "памятка", 9) == []
+    assert read_page_rows(tmp_path, "другой", 1) == []
+
+
+def test_rows_without_page(tmp_path):
+    pdf_dir = _build_pdf(tmp_path, 3)
+    entry = export_and_index(pdf_dir, tmp_path, _pdf_info(3), parquet=False)
+    assert NO_PAGE_KEY in entry["pages"]
+    rows = read_page_rows(tmp_path, "памятка", None)
+    assert [(row["page"], row["stage"], row["text"]) for row in rows] == [
+        (None, STAGE_DOCUMENT, "Общие положения без тега"),
+    ]
+    # Блок без страницы идёт первым
+    assert entry["pages"][NO_PAGE_KEY][0] == 0
+
+
+def test_reexport_after_pdf_got_shorter(tmp_path):
+    pdf_dir = _build_pdf(tmp_path, 3)
+    export_and_index(pdf_dir, tmp_path, _pdf_info(3), parquet=False)
+    assert read_page_rows(tmp_path, "памятка", 3)
+
+    # Новая версия PDF — две страницы; каталог page_003 остался от прежнего прогона
+    (pdf_dir / "instructions_incremental.md").write_text(
+        INCREMENTAL.replace("Проверьте статус заявки [SOURCE: page 003]\n", ""), encoding="utf-8"
+    )
+    entry = export_and_index(pdf_dir, tmp_path, _pdf_info(2), parquet=False)
+
+    assert sorted(entry["pages"]) == [NO_PAGE_KEY, "001", "002"]
+    index = json.loads((tmp_path / CHUNK_INDEX_NAME).read_text(encoding="utf-8"))
+    assert sorted(index["pdfs"]["памятка"]["pages"]) == [NO_PAGE_KEY, "001", "002"]
+    rows = [json.loads(line) for line in (pdf_dir / CHUNKS_JSONL).read_text(encoding="utf-8").splitlines()]
+    assert {row["page"] for row in rows} == {None, 1, 2}
+    assert read_page_rows(tmp_path, "памятка", 3) == []
@@ -0,0 +1,151 @@
+import email.utils
+import time
+
+import pytest
+import requests
+
+from giga_limits import RateLimiter, ModelLimit, RetryPolicy, TokenBucket, estimate_tokens, parse_model_limits, parse_retry_after
+from img_parse import GigaChatClient
+
+
+# ---------- RetryPolicy ----------
+
+def test_should_retry_statuses_and_attempts():
+    policy = RetryPolicy(max_attempts=3)
+    assert policy.should_retry(429, 0)
+    assert policy.should_retry(503, 1)
+    assert not policy.should_retry(503, 2)
+    assert not policy.should_retry(400, 0)
+    assert not policy.should_retry(401, 0)
+    assert policy.can_retry(1)
+    assert not policy.can_retry(2)
+
+
+def test_single_attempt_never_retries():
+    policy = RetryPolicy(max_attempts=1)
+    assert not policy.should_retry(429, 0)
+    assert not policy.can_retry(0)
+
+
+def test_delay_full_jitter_is_capped():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+    for attempt in range(6):
+        delay = policy.delay(attempt)
+        assert 0.0 <= delay <= min(5.0, 2 ** attempt)
+
+
+def test_delay_uses_retry_after_only_for_429_503():
+    policy = RetryPolicy(base_delay=0.0, max_delay=10.0)
+    assert policy.delay(0, 429, "3") == 3.0
+    assert policy.delay(0, 503, "30") == 10.0
+    # Для 500 Retry-After не учитывается: джиттер от base_delay=0
+    assert policy.delay(0, 500, "3") == 0.0
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("") is None
+    assert parse_retry_after("2.5") == 2.5
+    assert parse_retry_after("-1") == 0.0
+    assert parse_retry_after("не дата") is None
+    future = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 <= parse_retry_after(future) <= 31
+
+
+# ---------- RateLimiter ----------
+
+def test_token_bucket_waits_after_capacity():
+    bucket = TokenBucket(rate=2.0, capacity=2.0)
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == pytest.approx(0.5, abs=0.05)
+
+
+def test_rate_limiter_disabled_by_default():
+    limiter = RateLimiter()
+    assert not limiter.enabled
+    assert limiter.reserve("GigaChat-2-Pro", 10_000) == 0.0
+
+
+def test_rate_limiter_tpm_reserve_and_settle():
+    limiter = RateLimiter(default=ModelLimit(tpm=600))
+    assert limiter.reserve("m", 600) == 0.0
+    # Бюджет минуты исчерпан: следующий запрос ждёт пополнения (10 токенов в секунду)
+    assert limiter.reserve("m", 10) == pytest.approx(1.0, abs=0.05)
+    # Фактически потрачено меньше оценки — разница возвращается
+    limiter.settle("m", 610, 10)
+    assert limiter.reserve("m", 100) == 0.0
+
+
+def test_rate_limiter_settle_without_usage_keeps_reserve():
+    limiter = RateLimiter(default=ModelLimit(tpm=600))
+    limiter.reserve("m", 600)
+    limiter.settle("m", 600, None)
+    assert limiter.reserve("m", 60) > 0
+
+
+def test_parse_model_limits():
+    limits = parse_model_limits("GigaChat-2-Pro=5:100000, GigaChat-2-Max=2")
+    assert limits["GigaChat-2-Pro"] == ModelLimit(rps=5, tpm=100000)
+    assert limits["GigaChat-2-Max"] == ModelLimit(rps=2, tpm=0)
+    with pytest.raises(ValueError):
+        parse_model_limits("m=x:1")
+
+
+def test_estimate_tokens():
+    assert estimate_tokens(None) == (None, 0)
+    assert estimate_tokens({"messages": []}) == (None, 0)
+    payload = {"model": "m", "messages": [{"role": "user", "content": "а" * 30}], "max_tokens": 100}
+    assert estimate_tokens(payload) == ("m", 110)
+
+
+# ---------- GigaChatClient.send ----------
+
+class _RecordingLimiter(RateLimiter):
+    def __init__(self):
+        super().__init__()
+        self.reserved = []
+        self.settled = []
+
+    def reserve(self, model, estimated_tokens=0):
+        self.reserved.append(estimated_tokens)
+        return 0.0
+
+    def settle(self, model, estimated_tokens, actual_tokens):
+        self.settled.append((estimated_tokens, actual_tokens))
+
+
+def _response(status, body=b"{}"):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = body
+    resp._content_consumed = True
+    return resp
+
+
+def _client(responses):
+    limiter = _RecordingLimiter()
+    client = GigaChatClient(retry_policy=RetryPolicy(max_attempts=3, base_delay=0.0), rate_limiter=limiter)
+    queue = list(responses)
+    client.request = lambda method, url, **kwargs: queue.pop(0)
+    return client, limiter
+
+
+PAYLOAD = {"model": "m", "messages": [{"role": "user", "content": "а" * 30}], "max_tokens": 100}
+
+
+def test_send_reserves_tokens_once_across_retries():
+    client, limiter = _client([_response(429), _response(503), _response(200, b'{"usage": {"total_tokens": 42}}')])
+    resp = client.send("POST", "http://giga/chat/completions", json=PAYLOAD)
+    assert resp.status_code == 200
+    # Повторы занимают только слот запроса, токены списаны один раз
+    assert limiter.reserved == [110, 0, 0]
+    assert limiter.settled == [(110, 42)]
+
+
+def test_send_releases_reserve_on_final_error():
+    client, limiter = _client([_response(429), _response(429), _response(429)])
+    resp = client.send("POST", "http://giga/chat/completions", json=PAYLOAD)
+    assert resp.status_code == 429
+    assert limiter.reserved == [110, 0, 0]
+    assert limiter.settled == [(110, 0)]
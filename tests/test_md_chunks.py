@@ -0,0 +1,84 @@
+from md_chunks import GAP_MARK, ContextSelector, approx_tokens, split_markdown_chunks
+
+MERGED = """# Памятка по кредитам
+
+## Страница 001
+# Оформление заявки
+Откройте карточку клиента.
+Нажмите «Создать заявку».
+
+## Страница 002
+# Проверка документов
+Сверьте паспорт с анкетой.
+"""
+
+INCREMENTAL = """# Инструкция
+Откройте карточку клиента [SOURCE: page 001]
+Нажмите «Создать заявку» [SOURCE: page 001]
+## Проверка
+Сверьте паспорт с анкетой [SOURCE: page 002]
+Проверьте статус заявки [SOURCE: page 003]
+"""
+
+
+def test_split_by_page_headers_and_sections():
+    chunks = split_markdown_chunks(MERGED)
+    assert [(c.page, c.section) for c in chunks] == [
+        (None, "Памятка по кредитам"),
+        (1, "Оформление заявки"),
+        (2, "Проверка документов"),
+    ]
+    assert chunks[1].text == "# Оформление заявки\nОткройте карточку клиента.\nНажмите «Создать заявку»."
+    assert [c.index for c in chunks] == [0, 1, 2]
+    # Заголовки «## Страница NNN» во фрагменты не попадают
+    assert all("## Страница" not in c.text for c in chunks)
+
+
+def test_split_by_source_tags():
+    chunks = split_markdown_chunks(INCREMENTAL)
+    assert [(c.page, c.section) for c in chunks] == [
+        (None, "Инструкция"),
+        (1, "Инструкция"),
+        (None, "Проверка"),
+        (2, "Проверка"),
+        (3, "Проверка"),
+    ]
+    assert chunks[1].text.count("[SOURCE: page 001]") == 2
+
+
+def test_split_respects_max_chars():
+    md = "## Страница 001\n" + "\n".join(f"строка номер {i:03d}" for i in range(100))
+    chunks = split_markdown_chunks(md, max_chars=200)
+    assert len(chunks) > 1
+    assert all(len(c.text) <= 200 for c in chunks)
+    assert all(c.page == 1 for c in chunks)
+    assert "\n".join(c.text for c in chunks) == md.split("\n", 1)[1]
+
+
+def test_split_empty_document():
+    assert split_markdown_chunks("") == []
+    assert split_markdown_chunks("\n\n   \n") == []
+
+
+def test_select_skips_own_page_and_respects_budget():
+    chunks = split_markdown_chunks(INCREMENTAL)
+    selector = ContextSelector(chunks, chunk_tokens=[10] * len(chunks))
+    context = selector.select(2, "Сверьте паспорт с анкетой", max_tokens=20)
+    assert "[SOURCE: page 002]" not in context
+    # Соседние страницы 1 и 3 важнее заголовков без страницы
+    assert "[SOURCE: page 001]" in context and "[SOURCE: page 003]" in context
+    assert GAP_MARK in context
+
+
+def test_head_is_excluded_from_select():
+    chunks = split_markdown_chunks(MERGED)
+    selector = ContextSelector(chunks, chunk_tokens=[10, 10, 10], head_tokens=20)
+    assert selector.head_size == 2
+    assert selector.head() == "# Памятка по кредитам\n## Страница 001\n" + chunks[1].text
+    assert selector.select(2, "паспорт", max_tokens=100) == ""
+    assert "Проверка документов" in selector.select(1, "карточка", max_tokens=100)
+
+
+def test_approx_tokens():
+    assert approx_tokens("") == 1
+    assert approx_tokens("а" * 30) == 11
@@ -0,0 +1,83 @@
+import fitz
+
+from page_dedup import PageDedupIndex, hamming_distance, image_dhash
+from pipeline_manifest import text_fingerprint
+
+
+def _page(tmp_path, name, text, image_fp, image_phash, route="vision"):
+    page_dir = tmp_path / name
+    page_dir.mkdir()
+    text_path = page_dir / "page.txt"
+    text_path.write_text(text, encoding="utf-8")
+    return {
+        "dir": page_dir,
+        "text_path": text_path,
+        "text_fp": text_fingerprint(text),
+        "image_fp": image_fp,
+        "image_phash": image_phash,
+        "route": route,
+    }
+
+
+LONG_TEXT = "Порядок оформления кредитной заявки в АС: откройте карточку клиента и нажмите «Создать»."
+
+
+def test_different_scans_are_not_duplicates(tmp_path):
+    # Два разных скана без текстового слоя: text_fp одинаковый, dHash почти совпадает
+    first = _page(tmp_path, "a", "", "fp-a", "0f0f0f0f0f0f0f0f")
+    second = _page(tmp_path, "b", " \n", "fp-b", "0f0f0f0f0f0f0f0e")
+    canonical, duplicates = PageDedupIndex().assign([first, second])
+    assert canonical == [first, second]
+    assert duplicates == []
+
+
+def test_identical_scans_are_duplicates(tmp_path):
+    first = _page(tmp_path, "a", "", "fp-same", "0f0f0f0f0f0f0f0f")
+    second = _page(tmp_path, "b", "", "fp-same", "0f0f0f0f0f0f0f0f")
+    canonical, duplicates = PageDedupIndex().assign([first, second])
+    assert canonical == [first]
+    assert duplicates == [(second, first)]
+
+
+def test_text_pages_with_similar_images_are_duplicates(tmp_path):
+    first = _page(tmp_path, "a", LONG_TEXT, "fp-a", "0f0f0f0f0f0f0f0f")
+    second = _page(tmp_path, "b", LONG_TEXT, "fp-b", "0f0f0f0f0f0f0f0e")
+    third = _page(tmp_path, "c", LONG_TEXT, "fp-c", "f0f0f0f0f0f0f0f0")
+    canonical, duplicates = PageDedupIndex().assign([first, second, third])
+    assert canonical == [first, third]
+    assert duplicates == [(second, first)]
+
+
+def test_text_route_ignores_images(tmp_path):
+    first = _page(tmp_path, "a", LONG_TEXT, "fp-a", "0000000000000000", route="text")
+    second = _page(tmp_path, "b", LONG_TEXT, "fp-b", "ffffffffffffffff", route="text")
+    other_route = _page(tmp_path, "c", LONG_TEXT, "fp-a", "0000000000000000", route="vision")
+    canonical, duplicates = PageDedupIndex().assign([first, second, other_route])
+    assert canonical == [first, other_route]
+    assert duplicates == [(second, first)]
+
+
+def test_duplicates_across_assign_calls(tmp_path):
+    index = PageDedupIndex()
+    first = _page(tmp_path, "a", LONG_TEXT, "fp-a", "0f0f0f0f0f0f0f0f")
+    index.assign([first])
+    second = _page(tmp_path, "b", LONG_TEXT, "fp-b", "0f0f0f0f0f0f0f0f")
+    _, duplicates = index.assign([second])
+    assert duplicates == [(second, first)]
+    assert not index.is_done(first)
+    index.mark_done([first])
+    assert index.is_done(first)
+
+
+def test_image_dhash_stable_and_distinguishes_pages():
+    doc = fitz.open()
+    doc.new_page()
+    doc.new_page()
+    striped = doc[1]
+    for x in range(0, int(striped.rect.width), 60):
+        striped.draw_rect(fitz.Rect(x, 0, x + 30, striped.rect.height), fill=(0, 0, 0))
+    blank_hash, striped_hash = image_dhash(doc[0]), image_dhash(doc[1])
+    assert image_dhash(doc[1]) == striped_hash
+    assert len(striped_hash) == 16
+    assert hamming_distance(blank_hash, striped_hash) > 4
+    doc.close()
@@ -0,0 +1,111 @@
+import json
+
+from pipeline_manifest import MANIFEST_NAME, PipelineManifest, text_fingerprint, text_hash
+
+
+def _page_infos(pdf_out, count):
+    infos = []
+    for page_num in range(1, count + 1):
+        page_dir = pdf_out / f"page_{page_num:03d}"
+        page_dir.mkdir(parents=True, exist_ok=True)
+        (page_dir / "page.txt").write_text(f"текст {page_num}", encoding="utf-8")
+        (page_dir / "page.jpg").write_bytes(b"jpeg")
+        infos.append(
+            {
+                "page_num": page_num,
+                "dir": page_dir,
+                "image_path": page_dir / "page.jpg",
+                "dpi": 150,
+                "jpeg_quality": 85,
+                "image_bytes": 4,
+                "regions": [],
+                "region_bytes": [],
+                "text_fp": text_fingerprint(f"текст {page_num}"),
+                "image_fp": f"img{page_num}",
+                "image_phash": "0" * 16,
+                "route": "text",
+                "route_reason": "только текст",
+            }
+        )
+    return infos
+
+
+def _output(pdf_out, page_num, text):
+    path = pdf_out / f"page_{page_num:03d}" / "instruction.txt"
+    path.write_text(text, encoding="utf-8")
+    return path
+
+
+def test_save_and_reload_round_trip(tmp_path):
+    pdf_out = tmp_path / "doc"
+    pdf_path = tmp_path / "doc.pdf"
+    manifest = PipelineManifest(pdf_out, save_interval=0)
+    manifest.record_stage1(pdf_path, "pdfhash", _page_infos(pdf_out, 2), "render")
+    out1 = _output(pdf_out, 1, "инструкция 1")
+    manifest.record_page(1, "stage2", "in1", out1, route="text")
+    merged = pdf_out / "instructions_merged.md"
+    merged.write_text("документ", encoding="utf-8")
+    manifest.record_stage("stage3", "in3", merged)
+
+    reloaded = PipelineManifest(pdf_out)
+    assert reloaded.pdf_info()["page_count"] == 2
+    assert reloaded.page_done(1, "stage2", "in1", out1)
+    assert reloaded.stage_done("stage3", "in3", merged)
+    infos = reloaded.stage1_page_infos("pdfhash", pdf_path, "render")
+    assert [info["page_num"] for info in infos] == [1, 2]
+    assert infos[0]["text_path"] == pdf_out / "page_001" / "page.txt"
+    assert reloaded.previous_fingerprints(2) == (text_fingerprint("текст 2"), "img2")
+
+
+def test_stage1_page_infos_invalidated(tmp_path):
+    pdf_out = tmp_path / "doc"
+    pdf_path = tmp_path / "doc.pdf"
+    manifest = PipelineManifest(pdf_out)
+    manifest.record_stage1(pdf_path, "pdfhash", _page_infos(pdf_out, 2), "render")
+    assert manifest.stage1_page_infos("другой", pdf_path, "render") is None
+    assert manifest.stage1_page_infos("pdfhash", pdf_path, "другие настройки") is None
+    (pdf_out / "page_002" / "page.jpg").unlink()
+    assert manifest.stage1_page_infos("pdfhash", pdf_path, "render") is None
+
+
+def test_flush_persists_throttled_page_records(tmp_path):
+    pdf_out = tmp_path / "doc"
+    manifest = PipelineManifest(pdf_out, save_interval=3600)
+    manifest.record_stage1(tmp_path / "doc.pdf", "pdfhash", _page_infos(pdf_out, 3), "render")
+    # record_stage1 только что сохранил файл: постраничные записи ждут интервала
+    outputs = {n: _output(pdf_out, n, f"и{n}") for n in (1, 2, 3)}
+    for page_num, out in outputs.items():
+        manifest.record_page(page_num, "stage2", f"in{page_num}", out)
+    on_disk = json.loads((pdf_out / MANIFEST_NAME).read_text(encoding="utf-8"))
+    assert all("stage2" not in entry for entry in on_disk["pages"].values())
+
+    manifest.flush()
+    reloaded = PipelineManifest(pdf_out)
+    for page_num, out in outputs.items():
+        assert reloaded.page_done(page_num, "stage2", f"in{page_num}", out)
+
+
+def test_page_done_checks_input_and_output(tmp_path):
+    pdf_out = tmp_path / "doc"
+    manifest = PipelineManifest(pdf_out, save_interval=0)
+    manifest.record_stage1(tmp_path / "doc.pdf", "pdfhash", _page_infos(pdf_out, 1), "render")
+    input_hash = text_hash("промпт", "текст 1")
+    out = _output(pdf_out, 1, "инструкция")
+    manifest.record_page(1, "stage2", input_hash, out)
+    assert manifest.page_done(1, "stage2", input_hash, out)
+    # Другой вход (изменилась страница или промпт) — страницу нужно обработать заново
+    assert not manifest.page_done(1, "stage2", text_hash("промпт", "текст 1 изменён"), out)
+    assert not manifest.page_done(1, "stage4", input_hash, out)
+    # Результат правили руками или он пропал
+    out.write_text("правка", encoding="utf-8")
+    assert not manifest.page_done(1, "stage2", input_hash, out)
+    out.unlink()
+    assert not manifest.page_done(1, "stage2", input_hash, out)
+
+
+def test_record_stage1_drops_removed_pages(tmp_path):
+    pdf_out = tmp_path / "doc"
+    manifest = PipelineManifest(pdf_out, save_interval=0)
+    manifest.record_stage1(tmp_path / "doc.pdf", "v1", _page_infos(pdf_out, 3), "render")
+    manifest.record_stage1(tmp_path / "doc.pdf", "v2", _page_infos(pdf_out, 2), "render")
+    assert sorted(PipelineManifest(pdf_out).data["pages"]) == ["001", "002"]
@@ -0,0 +1,112 @@
+"""Дообработка обновлённого PDF (--resume): два прогона пайплайна с подменённым GigaChat."""
+import json
+import re
+
+import fitz
+import pytest
+
+import process_pamphlets as pp
+
+MARKER_RE = re.compile(r"PAGE_(\d+)_v(\d+)")
+
+
+class _FakeTokenManager:
+    def get_token(self):
+        return "token"
+
+
+class _FakeGiga:
+    """giga_free_answer: этап 2 возвращает маркер страницы, этап 4 — документ из маркеров вопроса."""
+
+    def __init__(self):
+        self.stage2 = []
+        self.stage4 = []
+
+    def __call__(self, question, access_token, sys_prompt="", **kwargs):
+        markers = list(dict.fromkeys(MARKER_RE.findall(question)))
+        page = int(markers[-1][0])
+        if sys_prompt == pp.STAGE4_SYS_PROMPT:
+            self.stage4.append(page)
+            return "\n".join(f"Шаг PAGE_{num}_v{version} [SOURCE: page {int(num):03d}]" for num, version in markers)
+        self.stage2.append(page)
+        return f"Инструкция PAGE_{page}_v{markers[-1][1]}"
+
+
+def _write_pdf(path, versions):
+    """PDF из текстовых страниц; versions — номер версии текста каждой страницы."""
+    doc = fitz.open()
+    for page_num, version in enumerate(versions, start=1):
+        page = doc.new_page()
+        text = f"PAGE_{page_num}_v{version} " + " ".join(f"step{page_num}x{i}" for i in range(60))
+        page.insert_textbox(fitz.Rect(50, 50, 550, 800), text, fontsize=11)
+    doc.save(path)
+    doc.close()
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    fake = _FakeGiga()
+    monkeypatch.setattr(pp, "TokenManager", _FakeTokenManager)
+    monkeypatch.setattr(pp, "giga_free_answer", fake)
+    pdf_dir = tmp_path / "pdfs"
+    pdf_dir.mkdir()
+    out_root = tmp_path / "out"
+
+    def run(versions):
+        fake.stage2.clear()
+        fake.stage4.clear()
+        _write_pdf(pdf_dir / "doc.pdf", versions)
+        pp.run_pipeline(pdf_dir, out_root, workers=1, resume=True, chunk_export=False)
+        return fake
+
+    return run, out_root / "doc"
+
+
+def _manifest(pdf_out):
+    return json.loads((pdf_out / "manifest.json").read_text(encoding="utf-8"))
+
+
+def test_resume_reprocesses_only_changed_pages(pipeline):
+    run, pdf_out = pipeline
+    fake = run([1, 1, 1, 1, 1, 1])
+    assert sorted(fake.stage2) == [1, 2, 3, 4, 5, 6]
+    assert fake.stage4 == [1, 2, 3, 4, 5, 6]
+    assert all(entry["stage1"]["route"] == pp.ROUTE_TEXT for entry in _manifest(pdf_out)["pages"].values())
+    before = {
+        n: (pdf_out / f"page_{n:03d}" / "instruction_with_context.txt").read_text(encoding="utf-8")
+        for n in (1, 2, 3)
+    }
+    stage4_before = {key: entry["stage4"] for key, entry in _manifest(pdf_out)["pages"].items()}
+
+    # Правка страницы 4: этап 2 только для неё, этап 4 — с неё до конца документа
+    fake = run([1, 1, 1, 2, 1, 1])
+    assert fake.stage2 == [4]
+    assert fake.stage4 == [4, 5, 6]
+    manifest = _manifest(pdf_out)
+    for key in ("001", "002", "003"):
+        assert manifest["pages"][key]["stage4"] == stage4_before[key]
+    for n, text in before.items():
+        assert (pdf_out / f"page_{n:03d}" / "instruction_with_context.txt").read_text(encoding="utf-8") == text
+    document = (pdf_out / "instructions_incremental.md").read_text(encoding="utf-8")
+    assert "PAGE_4_v2" in document and "PAGE_4_v1" not in document
+
+    # Повтор без изменений: в модель ничего не уходит
+    fake = run([1, 1, 1, 2, 1, 1])
+    assert fake.stage2 == [] and fake.stage4 == []
+
+
+def test_resume_after_pdf_got_shorter(pipeline):
+    run, pdf_out = pipeline
+    run([1, 1, 1, 1, 1, 1])
+
+    fake = run([1, 1, 1, 1])
+    # Первые четыре страницы не менялись: ни этапа 2, ни этапа 4 заново
+    assert fake.stage2 == [] and fake.stage4 == []
+    assert sorted(p.name for p in pdf_out.iterdir() if p.name.startswith("page_")) == [
+        f"page_{n:03d}" for n in range(1, 5)
+    ]
+    manifest = _manifest(pdf_out)
+    assert sorted(manifest["pages"]) == ["001", "002", "003", "004"]
+    assert manifest["pdf"]["page_count"] == 4
+    document = (pdf_out / "instructions_incremental.md").read_text(encoding="utf-8")
+    assert "PAGE_5_" not in document and "PAGE_6_" not in document
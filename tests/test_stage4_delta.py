@@ -0,0 +1,51 @@
+from process_pamphlets import _stage4_delta_lines
+
+DOCUMENT = """# Инструкция
+Откройте карточку клиента [SOURCE: page 001]
+Нажмите «Создать заявку» [SOURCE: page 002]
+"""
+
+
+def test_new_lines_are_tagged_with_current_page():
+    answer = "Сверьте паспорт с анкетой [SOURCE: page 003]\nПроверьте статус заявки\n"
+    assert _stage4_delta_lines(answer, 3, DOCUMENT) == [
+        "Сверьте паспорт с анкетой [SOURCE: page 003]",
+        "Проверьте статус заявки [SOURCE: page 003]",
+    ]
+
+
+def test_repeated_lines_are_dropped():
+    answer = (
+        "Откройте карточку клиента [SOURCE: page 001]\n"
+        "Сверьте паспорт с анкетой [SOURCE: page 003]\n"
+        "Сверьте паспорт с анкетой [SOURCE: page 003]\n"
+        "  Сверьте   паспорт с анкетой\n"
+    )
+    assert _stage4_delta_lines(answer, 3, DOCUMENT) == ["Сверьте паспорт с анкетой [SOURCE: page 003]"]
+
+
+def test_lines_differing_only_by_source_tag():
+    answer = (
+        # Старая строка, перемеченная текущей страницей
+        "Откройте карточку клиента [SOURCE: page 003]\n"
+        # Старая строка без тега
+        "Нажмите «Создать заявку»\n"
+        # Строка с тегом другой страницы — модель повторила старое
+        "Новый шаг [SOURCE: page 002]\n"
+        # Несколько тегов, среди которых чужая страница
+        "Ещё шаг [SOURCE: page 003] [SOURCE: page 001]\n"
+    )
+    assert _stage4_delta_lines(answer, 3, DOCUMENT) == []
+
+
+def test_empty_answer():
+    assert _stage4_delta_lines("", 3, DOCUMENT) == []
+    assert _stage4_delta_lines("\n  \n[SOURCE: page 003]\n", 3, DOCUMENT) == []
+
+
+def test_empty_document():
+    # Так же собирается лист дерева из текста страницы, если запрос не удался (этап 4, tree)
+    assert _stage4_delta_lines("Шаг 1\nШаг 1\nШаг 2", 5, "") == [
+        "Шаг 1 [SOURCE: page 005]",
+        "Шаг 2 [SOURCE: page 005]",
+    ]
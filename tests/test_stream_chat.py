@@ -0,0 +1,131 @@
+import io
+import json
+
+import pytest
+import requests
+
+import img_parse
+from img_parse import get_token_stats, stream_chat_completion
+
+PAYLOAD = {"model": "GigaChat-2-Pro", "messages": [{"role": "user", "content": "а" * 30}], "max_tokens": 100}
+
+
+class _FailingStream(io.BytesIO):
+    """Тело ответа, которое обрывается после первых fail_after байт."""
+
+    def __init__(self, data, fail_after):
+        super().__init__(data)
+        self.fail_after = fail_after
+
+    def read(self, size=-1):
+        if self.tell() >= self.fail_after:
+            raise requests.exceptions.ChunkedEncodingError("соединение разорвано")
+        return super().read(min(size, self.fail_after - self.tell()) if size and size > 0 else self.fail_after)
+
+
+class _FakeClient:
+    def __init__(self, resp):
+        self.resp = resp
+        self.sent = []
+        self.settled = []
+        self.rate_limiter = self
+
+    def send(self, method, url, access_token=None, content_type=None, headers=None, **kwargs):
+        self.sent.append({"headers": headers or {}, **kwargs})
+        return self.resp
+
+    def settle(self, model, estimated_tokens, actual_tokens):
+        self.settled.append((model, estimated_tokens, actual_tokens))
+
+
+def _sse(*events, done=True):
+    lines = [f"data: {json.dumps(event, ensure_ascii=False)}\n\n" for event in events]
+    if done:
+        lines.append("data: [DONE]\n\n")
+    return "".join(lines).encode("utf-8")
+
+
+def _response(body, status=200, raw=None):
+    resp = requests.Response()
+    resp.status_code = status
+    resp.raw = raw if raw is not None else io.BytesIO(body)
+    resp.url = img_parse.GIGA_API_URL
+    return resp
+
+
+def _delta(text):
+    return {"choices": [{"index": 0, "delta": {"role": "assistant", "content": text}}]}
+
+
+USAGE = {"prompt_tokens": 20, "completion_tokens": 5, "total_tokens": 25, "precached_prompt_tokens": 4}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    def install(resp):
+        fake = _FakeClient(resp)
+        monkeypatch.setattr(img_parse, "get_client", lambda: fake)
+        return fake
+
+    return install
+
+
+def test_stream_joins_delta_chunks_and_settles_usage(client):
+    body = _sse(
+        _delta("Откройте "),
+        _delta("карточку"),
+        {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]},
+        # Последнее событие — только usage, без текста
+        {"choices": [], "usage": USAGE},
+    )
+    fake = client(_response(body))
+    before = get_token_stats()
+
+    chunks = list(stream_chat_completion(PAYLOAD, "token", session_id="s1"))
+
+    assert chunks == ["Откройте ", "карточку"]
+    assert fake.sent[0]["json"]["stream"] is True and fake.sent[0]["stream"] is True
+    assert fake.sent[0]["headers"]["X-Session-ID"] == "s1"
+    after = get_token_stats()
+    assert after["total_tokens"] - before["total_tokens"] == 25
+    assert after["precached_prompt_tokens"] - before["precached_prompt_tokens"] == 4
+    # Резерв лимитера уточняется по usage последнего события
+    assert fake.settled == [("GigaChat-2-Pro", 110, 25)]
+
+
+def test_stream_stops_at_done(client):
+    body = _sse(_delta("до"), done=True) + b"data: " + json.dumps(_delta("после")).encode() + b"\n\n"
+    fake = client(_response(body))
+    assert list(stream_chat_completion(PAYLOAD, "token")) == ["до"]
+    # usage не пришло — резерв остаётся как есть
+    assert fake.settled == [("GigaChat-2-Pro", 110, None)]
+
+
+def test_stream_ignores_comments_and_blank_lines(client):
+    body = b": keep-alive\n\n" + _sse(_delta("текст"), {"choices": [], "usage": USAGE})
+    client(_response(body))
+    assert list(stream_chat_completion(PAYLOAD, "token")) == ["текст"]
+
+
+def test_stream_error_mid_way(client):
+    body = _sse(_delta("начало "), _delta("конец"), {"choices": [], "usage": USAGE})
+    first_event = len(_sse(_delta("начало "), done=False))
+    resp = _response(body, raw=_FailingStream(body, first_event))
+    fake = client(resp)
+
+    received = []
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        for chunk in stream_chat_completion(PAYLOAD, "token"):
+            received.append(chunk)
+
+    assert received == ["начало "]
+    assert resp.raw.closed
+    assert fake.settled == [("GigaChat-2-Pro", 110, None)]
+
+
+def test_stream_http_error(client):
+    fake = client(_response(b'{"message": "too many"}', status=429))
+    with pytest.raises(requests.HTTPError):
+        list(stream_chat_completion(PAYLOAD, "token"))
+    # Ошибочный ответ уже рассчитан в send, stream_chat_completion его не трогает
+    assert fake.settled == []
@@ -0,0 +1,81 @@
+import pytest
+
+import token_budget
+from token_budget import COMPRESS, PROCEED, SPLIT, TokenBudget
+
+
+class _LocalBudget(TokenBudget):
+    """Бюджет без /tokens/count: один токен на символ."""
+
+    def __init__(self, **kwargs):
+        super().__init__(access_token="token", **kwargs)
+
+    def count(self, text):
+        return len(text)
+
+    def count_many(self, texts):
+        return [len(text) for text in texts]
+
+
+OVERHEAD = token_budget._MESSAGE_OVERHEAD_TOKENS
+
+
+def test_prompt_tokens_counts_messages_and_overhead():
+    budget = _LocalBudget()
+    assert budget.prompt_tokens("sys", "вопрос") == 3 + 6 + 2 * OVERHEAD
+    assert budget.prompt_tokens("", "вопрос") == 6 + OVERHEAD
+
+
+def test_proceed_defaults_max_tokens_to_expected_completion():
+    budget = _LocalBudget(context_tokens=10_000, min_completion_tokens=100)
+    plan = budget.plan("s", "q" * 100, completion_tokens=500)
+    assert plan.action == PROCEED
+    assert plan.prompt_tokens == 1 + 100 + 2 * OVERHEAD
+    # Не всё оставшееся окно, а ожидаемая длина ответа
+    assert plan.max_tokens == 500
+
+
+def test_proceed_respects_min_completion_and_explicit_cap():
+    budget = _LocalBudget(context_tokens=10_000, min_completion_tokens=300)
+    assert budget.plan("s", "q", completion_tokens=10).max_tokens == 300
+    assert budget.plan("s", "q", completion_tokens=500, max_tokens=2000).max_tokens == 2000
+    # Потолок вызывающего кода не выходит за окно модели
+    plan = budget.plan("s", "q" * 9000, completion_tokens=300, max_tokens=5000)
+    assert plan.action == PROCEED
+    assert plan.max_tokens == 10_000 - plan.prompt_tokens
+
+
+def test_compress_when_required_part_fits():
+    budget = _LocalBudget(context_tokens=1000, min_completion_tokens=100)
+    plan = budget.plan("s", "q" * 950, completion_tokens=100, required_tokens=200)
+    assert plan.action == COMPRESS
+    assert plan.max_tokens is None
+
+
+def test_split_when_required_part_does_not_fit():
+    budget = _LocalBudget(context_tokens=1000, min_completion_tokens=100)
+    plan = budget.plan("s", "q" * 950, completion_tokens=100, required_tokens=900)
+    assert plan.action == SPLIT
+    # Без required_tokens весь вопрос считается обязательным
+    assert budget.plan("s", "q" * 950, completion_tokens=100).action == SPLIT
+    assert budget.decisions == {SPLIT: 2}
+
+
+def test_fit_text_keeps_head_or_tail():
+    budget = _LocalBudget()
+    text = "\n".join(f"строка {i:02d}" for i in range(20))
+    assert budget.fit_text(text, 10_000) == text
+    head = budget.fit_text(text, 60)
+    assert len(head) <= 60 and head.startswith("строка 00") and head.endswith(token_budget.TRUNCATED_TAIL)
+    tail = budget.fit_text(text, 60, keep="tail")
+    assert len(tail) <= 60 and tail.endswith("строка 19") and tail.startswith(token_budget.TRUNCATED_HEAD)
+    assert budget.fit_text(text, 0) == ""
+
+
+@pytest.mark.parametrize("limit", [256, 400, 1000])
+def test_split_text_parts_fit_and_keep_text(limit):
+    budget = _LocalBudget()
+    text = "\n".join(f"пункт {i:03d} инструкции" for i in range(200))
+    parts = budget.split_text(text, limit)
+    assert all(len(part) <= limit for part in parts)
+    assert "\n".join(parts) == text
@@ -0,0 +1,61 @@
+import numpy as np
+
+import vector_index
+from response_cache import content_hash
+from vector_index import VectorIndex, update_index
+
+MERGED = """## Страница 001
+# Оформление заявки
+Откройте карточку клиента.
+
+## Страница 002
+# Оформление заявки
+Откройте карточку клиента.
+
+## Страница 003
+# Проверка документов
+Сверьте паспорт с анкетой.
+"""
+
+
+def _fake_embed(calls):
+    def embed(texts, access_token, model=vector_index.GIGA_EMBEDDINGS_MODEL, batch_size=32):
+        calls.append(list(texts))
+        vectors = np.array([[len(text), sum(map(ord, text)) % 97, 1.0] for text in texts], dtype=np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    return embed
+
+
+def _write(out_root, text):
+    pdf_dir = out_root / "a"
+    pdf_dir.mkdir(parents=True, exist_ok=True)
+    (pdf_dir / "instructions_merged.md").write_text(text, encoding="utf-8")
+
+
+def test_fresh_index_reuses_nothing(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(vector_index, "embed_texts", _fake_embed(calls))
+    _write(tmp_path, MERGED)
+    stats = update_index(tmp_path, tmp_path / "vector_index", "token")
+    # Одинаковый текст страниц 1 и 2 считается один раз, но из индекса ничего не взято
+    assert stats == {"chunks": 3, "embedded": 2, "reused": 0}
+    assert len(calls) == 1 and len(calls[0]) == 2
+    assert len(VectorIndex(tmp_path / "vector_index")) == 3
+
+
+def test_second_run_embeds_only_changed_chunk(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(vector_index, "embed_texts", _fake_embed(calls))
+    _write(tmp_path, MERGED)
+    update_index(tmp_path, tmp_path / "vector_index", "token")
+
+    edited = MERGED.replace("Сверьте паспорт с анкетой.", "Сверьте паспорт и СНИЛС с анкетой.")
+    _write(tmp_path, edited)
+    calls.clear()
+    stats = update_index(tmp_path, tmp_path / "vector_index", "token")
+    assert stats == {"chunks": 3, "embedded": 1, "reused": 2}
+    new_text = "# Проверка документов\nСверьте паспорт и СНИЛС с анкетой."
+    assert calls == [[new_text]]
+    index = VectorIndex(tmp_path / "vector_index")
+    assert content_hash(new_text.encode("utf-8")) in {chunk.hash for chunk in index.chunks}
@@ -0,0 +1,308 @@
+"""
+Бюджет токенов до отправки запроса: размер промпта считается в настоящих токенах
+модели через POST /tokens/count, а не в символах.
+
+- count_tokens: подсчёт пачкой строк за один запрос; результаты кэшируются в памяти
+  и в кэше ответов (response_cache), поэтому повторный прогон в сеть почти не ходит;
+- TokenBudget.plan: решение по запросу — proceed (помещается в окно контекста модели,
+  max_tokens — ожидаемая длина ответа, не больше оставшегося места), compress (сократить сжимаемый контекст)
+  или split (не помещается даже обязательная часть — делить на части);
+- TokenBudget.fit_text / split_text: сокращение и деление текста по строкам в токенах;
+- RunProjection: прогноз токенов и стоимости прогона целиком, до первого запроса к модели.
+"""
+import json
+import os
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List, NamedTuple
+
+from img_parse import TEXT_MODEL, AccessToken, _cache_get, _cache_put, get_client
+from response_cache import content_hash
+
+# эндпоинт GigaChat API для подсчёта токенов
+GIGA_TOKENS_COUNT_URL = os.getenv(
+    "GIGA_CHAT_TOKENS_COUNT_URL",
+    "https://gigachat.devices.sberbank.ru/api/v1/tokens/count",
+)
+
+# Окно контекста модели (промпт + ответ), токены
+GIGA_CONTEXT_TOKENS = int(os.getenv("GIGA_CONTEXT_TOKENS", "131072"))
+# Меньше стольких токенов на ответ запрос не отправляется — сначала сокращается промпт
+GIGA_MIN_COMPLETION_TOKENS = int(os.getenv("GIGA_MIN_COMPLETION_TOKENS", "1024"))
+# Оценка токенов одного изображения для прогноза расхода (точно их не посчитать до запроса)
+GIGA_IMAGE_PROMPT_TOKENS = int(os.getenv("GIGA_IMAGE_PROMPT_TOKENS", "1000"))
+# Цена за 1000 токенов по моделям: "модель=цена,модель=цена" (пусто — стоимость не считается)
+GIGA_TOKEN_PRICES = os.getenv("GIGA_TOKEN_PRICES", "")
+
+# Служебные токены на каждое сообщение (роль, разметка диалога) — с запасом
+_MESSAGE_OVERHEAD_TOKENS = 16
+# Сколько строк отправлять в одном запросе /tokens/count
+_COUNT_BATCH = 100
+# Части при делении текста не короче стольких токенов: если шаблон вопроса занимает
+# почти всё окно, мельче делить бессмысленно
+MIN_SPLIT_TOKENS = 256
+# Попыток подогнать длину текста в fit_text
+_FIT_ATTEMPTS = 8
+
+TRUNCATED_TAIL = "\n\n[...ОБРЕЗАНО...]\n"
+TRUNCATED_HEAD = "[...НАЧАЛО ОБРЕЗАНО...]\n\n"
+
+# Решения планировщика
+PROCEED = "proceed"
+COMPRESS = "compress"
+SPLIT = "split"
+
+
+def parse_token_prices(spec: str) -> Dict[str, float]:
+    """'GigaChat-2-Pro=0.5,GigaChat-2-Max=0.65' -> {модель: цена за 1000 токенов}."""
+    prices: Dict[str, float] = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        model, _, price = item.partition("=")
+        try:
+            prices[model.strip()] = float(price)
+        except ValueError as e:
+            raise ValueError(f"Некорректная цена в GIGA_TOKEN_PRICES: {item!r}") from e
+    return prices
+
+
+# ---------- Подсчёт токенов ----------
+
+_COUNT_MEMO: Dict[str, int] = {}
+_COUNT_MEMO_LOCK = threading.Lock()
+
+
+def _count_key(model: str, text: str) -> str:
+    return content_hash(json.dumps({"tokens_count": model, "input": text}, ensure_ascii=False).encode("utf-8"))
+
+
+def count_tokens(texts: List[str], access_token: AccessToken, model: str = TEXT_MODEL) -> List[int]:
+    """Число токенов каждой строки (POST /tokens/count); уже посчитанные строки берутся из кэша."""
+    keys = [_count_key(model, text) for text in texts]
+    counts: Dict[str, int] = {}
+    missing: Dict[str, str] = {}
+    for key, text in zip(keys, texts):
+        with _COUNT_MEMO_LOCK:
+            value = _COUNT_MEMO.get(key)
+        if value is None:
+            cached = _cache_get(key)
+            value = int(cached) if cached is not None else None
+        if value is None:
+            missing[key] = text
+        else:
+            counts[key] = value
+
+    pending = list(missing.items())
+    for start in range(0, len(pending), _COUNT_BATCH):
+        chunk = pending[start:start + _COUNT_BATCH]
+        resp = get_client().send(
+            "POST",
+            GIGA_TOKENS_COUNT_URL,
+            access_token,
+            content_type="application/json",
+            json={"model": model, "input": [text for _, text in chunk]},
+        )
+        resp.raise_for_status()
+        result = resp.json()
+        if len(result) != len(chunk):
+            raise RuntimeError(f"/tokens/count вернул {len(result)} значений вместо {len(chunk)}")
+        for (key, _), item in zip(chunk, result):
+            counts[key] = int(item["tokens"])
+            _cache_put(key, str(counts[key]))
+
+    with _COUNT_MEMO_LOCK:
+        _COUNT_MEMO.update(counts)
+    return [counts[key] for key in keys]
+
+
+# ---------- Планировщик ----------
+
+class BudgetPlan(NamedTuple):
+    action: str
+    prompt_tokens: int
+    # max_tokens для запроса (только для proceed)
+    max_tokens: int | None
+
+
+class TokenBudget:
+    """
+    Планировщик запросов к одной модели. Потокобезопасен: этап 4 в режиме tree
+    планирует запросы из нескольких потоков.
+    """
+
+    def __init__(
+        self,
+        access_token: AccessToken,
+        model: str = TEXT_MODEL,
+        context_tokens: int = GIGA_CONTEXT_TOKENS,
+        min_completion_tokens: int = GIGA_MIN_COMPLETION_TOKENS,
+    ) -> None:
+        self.access_token = access_token
+        self.model = model
+        self.context_tokens = context_tokens
+        self.min_completion_tokens = min_completion_tokens
+        self.decisions: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def count(self, text: str) -> int:
+        return count_tokens([text], self.access_token, self.model)[0] if text else 0
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        return count_tokens(texts, self.access_token, self.model)
+
+    def prompt_tokens(self, sys_prompt: str, question: str) -> int:
+        """Токены промпта chat/completions: системное сообщение и вопрос пользователя."""
+        messages = [text for text in (sys_prompt, question) if text]
+        return sum(self.count_many(messages)) + _MESSAGE_OVERHEAD_TOKENS * len(messages)
+
+    def plan(
+        self,
+        sys_prompt: str,
+        question: str,
+        completion_tokens: int,
+        required_tokens: int | None = None,
+        max_tokens: int | None = None,
+    ) -> BudgetPlan:
+        """
+        completion_tokens — ожидаемая длина ответа (не меньше min_completion_tokens);
+        required_tokens   — несжимаемая часть вопроса (например, текст страницы); None — весь вопрос;
+        max_tokens        — потолок ответа (по умолчанию completion_tokens): оставшееся окно
+                            целиком не резервируется, иначе лимитер частоты списывает его как ответ.
+
+        proceed  — промпт и ожидаемый ответ помещаются в окно;
+        compress — не помещаются, но хватит места, если сократить сжимаемую часть вопроса;
+        split    — не помещается даже обязательная часть с ответом.
+        """
+        completion_tokens = max(completion_tokens, self.min_completion_tokens)
+        prompt = self.prompt_tokens(sys_prompt, question)
+        room = self.context_tokens - prompt
+        if room >= completion_tokens:
+            cap = completion_tokens if max_tokens is None else max_tokens
+            result = BudgetPlan(PROCEED, prompt, min(cap, room))
+        else:
+            fixed = prompt if required_tokens is None else self.prompt_tokens(sys_prompt, "") + required_tokens
+            action = SPLIT if fixed + completion_tokens > self.context_tokens else COMPRESS
+            result = BudgetPlan(action, prompt, None)
+        self.note(result.action)
+        return result
+
+    def note(self, action: str) -> None:
+        """Учесть решение в статистике (в том числе принятое вызывающим кодом без plan)."""
+        with self._lock:
+            self.decisions[action] += 1
+
+    def room_for(self, sys_prompt: str, question_without_context: str, completion_tokens: int) -> int:
+        """Сколько токенов остаётся на сжимаемый контекст при данном вопросе без него."""
+        completion_tokens = max(completion_tokens, self.min_completion_tokens)
+        return self.context_tokens - self.prompt_tokens(sys_prompt, question_without_context) - completion_tokens
+
+    def fit_text(self, text: str, max_tokens: int, keep: str = "head") -> str:
+        """
+        Сократить текст до max_tokens по границам строк.
+        keep="head" — оставить начало (с пометкой об обрезке в конце), "tail" — конец.
+        """
+        total = self.count(text)
+        if total <= max_tokens:
+            return text
+        if max_tokens <= 0:
+            return ""
+        lines = text.splitlines()
+        target_chars = int(len(text) * max_tokens / total)
+        for _ in range(_FIT_ATTEMPTS):
+            cut = _cut_lines(lines, target_chars, keep)
+            fitted = cut + TRUNCATED_TAIL if keep == "head" else TRUNCATED_HEAD + cut
+            tokens = self.count(fitted)
+            if tokens <= max_tokens:
+                return fitted
+            target_chars = int(target_chars * max_tokens / tokens * 0.95)
+        return ""
+
+    def split_text(self, text: str, max_tokens: int) -> List[str]:
+        """
+        Разделить текст на части не больше max_tokens (но не меньше MIN_SPLIT_TOKENS):
+        пополам по строкам, пока части не поместятся.
+        """
+        max_tokens = max(max_tokens, MIN_SPLIT_TOKENS)
+        if self.count(text) <= max_tokens or len(text) < 2:
+            return [text]
+        lines = text.splitlines()
+        if len(lines) > 1:
+            middle, size = 0, 0
+            for middle, line in enumerate(lines[:-1], start=1):
+                size += len(line) + 1
+                if size >= len(text) // 2:
+                    break
+            head, tail = "\n".join(lines[:middle]), "\n".join(lines[middle:])
+        else:
+            head, tail = text[:len(text) // 2], text[len(text) // 2:]
+        return self.split_text(head, max_tokens) + self.split_text(tail, max_tokens)
+
+    def summary(self) -> str:
+        with self._lock:
+            decisions = dict(self.decisions)
+        return ", ".join(f"{action}: {decisions.get(action, 0)}" for action in (PROCEED, COMPRESS, SPLIT))
+
+
+def _cut_lines(lines: List[str], max_chars: int, keep: str) -> str:
+    """Целые строки с начала (keep="head") или с конца, пока их длина не больше max_chars."""
+    ordered = lines if keep == "head" else list(reversed(lines))
+    kept: List[str] = []
+    size = 0
+    for line in ordered:
+        if size + len(line) + 1 > max_chars:
+            if not kept and max_chars > 0:
+                # Даже первая строка не помещается — режем её по символам
+                kept.append(line[:max_chars] if keep == "head" else line[-max_chars:])
+            break
+        kept.append(line)
+        size += len(line) + 1
+    return "\n".join(kept if keep == "head" else reversed(kept))
+
+
+# ---------- Прогноз на весь прогон ----------
+
+@dataclass
+class RunProjection:
+    """Ожидаемые запросы и токены по этапам и моделям; overflows — запросы, не помещающиеся в окно."""
+
+    stages: Dict[tuple, Dict[str, int]] = field(default_factory=dict)
+    overflows: int = 0
+
+    def add(self, stage: str, model: str, prompt_tokens: int, completion_tokens: int, requests: int = 1) -> None:
+        entry = self.stages.setdefault(
+            (stage, model), {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        )
+        entry["requests"] += requests
+        entry["prompt_tokens"] += prompt_tokens
+        entry["completion_tokens"] += completion_tokens
+
+    def total_tokens(self) -> int:
+        return sum(entry["prompt_tokens"] + entry["completion_tokens"] for entry in self.stages.values())
+
+    def cost(self, prices: Dict[str, float]) -> float | None:
+        """Стоимость по ценам за 1000 токенов; None, если цена известна не для всех моделей."""
+        total = 0.0
+        for (_, model), entry in self.stages.items():
+            if model not in prices:
+                return None
+            total += (entry["prompt_tokens"] + entry["completion_tokens"]) / 1000 * prices[model]
+        return total
+
+    def format(self, prices: Dict[str, float] | None = None) -> str:
+        prices = parse_token_prices(GIGA_TOKEN_PRICES) if prices is None else prices
+        lines = ["Прогноз расхода токенов на прогон:"]
+        for (stage, model), entry in self.stages.items():
+            lines.append(
+                f"- {stage} ({model}): запросов {entry['requests']}, "
+                f"prompt ≈ {entry['prompt_tokens']}, completion ≈ {entry['completion_tokens']}"
+            )
+        lines.append(f"- всего ≈ {self.total_tokens()} токенов")
+        cost = self.cost(prices)
+        if cost is not None:
+            lines.append(f"- стоимость ≈ {cost:.2f} (GIGA_TOKEN_PRICES)")
+        if self.overflows:
+            lines.append(f"- запросов, не помещающихся в окно модели ({GIGA_CONTEXT_TOKENS} токенов): {self.overflows}")
+        return "\n".join(lines)
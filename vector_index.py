@@ -0,0 +1,306 @@
+"""
+Этап 5 (необязательный): эмбеддинги итоговых инструкций и локальный векторный индекс.
+
+Итоговые файлы пайплайна (out/<pdf>/instructions_incremental.md и instructions_merged.md)
+делятся на фрагменты по тегам [SOURCE: page XXX] и заголовкам «## Страница NNN»
+(md_chunks), фрагменты отправляются пачками в POST /embeddings, векторы складываются
+в индекс на диске — без внешней векторной БД:
+
+  <index-dir>/vectors.npy   — матрица float32 (фрагменты × размерность), векторы
+                              нормированы; читается через memmap, в память целиком не грузится;
+  <index-dir>/chunks.jsonl  — по строке на строку матрицы: PDF, файл, страница, раздел,
+                              хэш и текст фрагмента;
+  <index-dir>/index.json    — модель эмбеддингов, размерность, число фрагментов.
+
+При обновлении индекса эмбеддинги считаются только для новых и изменённых фрагментов
+(по хэшу текста), векторы остальных переносятся из прежнего индекса.
+Поиск — косинусная близость запроса ко всем фрагментам, top-k.
+"""
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple
+
+try:
+    import numpy as np
+except ImportError as e:
+    raise ImportError(
+        "Для векторного индекса требуется библиотека numpy. "
+        "Установите её командой: pip install numpy"
+    ) from e
+
+from img_parse import AccessToken, _update_token_stats, get_client
+from md_chunks import split_markdown_chunks
+from response_cache import content_hash
+
+# эндпоинт GigaChat API для эмбеддингов
+GIGA_EMBEDDINGS_URL = os.getenv(
+    "GIGA_CHAT_EMBEDDINGS_URL",
+    "https://gigachat.devices.sberbank.ru/api/v1/embeddings",
+)
+GIGA_EMBEDDINGS_MODEL = os.getenv("GIGA_EMBEDDINGS_MODEL", "Embeddings")
+# Сколько фрагментов отправлять в одном запросе /embeddings
+GIGA_EMBEDDINGS_BATCH = int(os.getenv("GIGA_EMBEDDINGS_BATCH", "32"))
+# Максимальная длина фрагмента для эмбеддинга, символы (у модели Embeddings окно ~512 токенов)
+GIGA_EMBEDDINGS_CHUNK_CHARS = int(os.getenv("GIGA_EMBEDDINGS_CHUNK_CHARS", "1000"))
+
+# Итоговые файлы пайплайна, которые попадают в индекс
+INDEXED_FILES = ("instructions_incremental.md", "instructions_merged.md")
+
+VECTORS_FILE = "vectors.npy"
+CHUNKS_FILE = "chunks.jsonl"
+INDEX_FILE = "index.json"
+
+
+class IndexedChunk(NamedTuple):
+    # Имя каталога PDF в out/ (имя PDF без расширения)
+    pdf: str
+    # Файл, из которого взят фрагмент (instructions_incremental.md / instructions_merged.md)
+    source: str
+    page: int | None
+    section: str
+    text: str
+    hash: str
+
+
+class SearchHit(NamedTuple):
+    score: float
+    chunk: IndexedChunk
+
+
+def collect_chunks(out_root: Path, max_chars: int = GIGA_EMBEDDINGS_CHUNK_CHARS) -> List[IndexedChunk]:
+    """Фрагменты итоговых файлов всех PDF в out_root (в порядке PDF, файла и документа)."""
+    chunks: List[IndexedChunk] = []
+    for pdf_dir in sorted(path for path in Path(out_root).iterdir() if path.is_dir()):
+        for name in INDEXED_FILES:
+            md_path = pdf_dir / name
+            if not md_path.exists():
+                continue
+            for chunk in split_markdown_chunks(md_path.read_text(encoding="utf-8"), max_chars):
+                chunks.append(
+                    IndexedChunk(
+                        pdf=pdf_dir.name,
+                        source=name,
+                        page=chunk.page,
+                        section=chunk.section,
+                        text=chunk.text,
+                        hash=content_hash(chunk.text.encode("utf-8")),
+                    )
+                )
+    return chunks
+
+
+def embed_texts(
+    texts: List[str],
+    access_token: AccessToken,
+    model: str = GIGA_EMBEDDINGS_MODEL,
+    batch_size: int = GIGA_EMBEDDINGS_BATCH,
+) -> np.ndarray:
+    """Эмбеддинги строк (POST /embeddings пачками по batch_size): матрица float32, строки нормированы."""
+    rows: List[List[float]] = []
+    for start in range(0, len(texts), max(1, batch_size)):
+        chunk = texts[start:start + batch_size]
+        resp = get_client().send(
+            "POST",
+            GIGA_EMBEDDINGS_URL,
+            access_token,
+            content_type="application/json",
+            json={"model": model, "input": chunk},
+        )
+        resp.raise_for_status()
+        data = resp.json().get("data") or []
+        if len(data) != len(chunk):
+            raise RuntimeError(f"/embeddings вернул {len(data)} векторов вместо {len(chunk)}")
+        # usage у эмбеддингов — у каждого вектора отдельно
+        prompt_tokens = sum(int((item.get("usage") or {}).get("prompt_tokens", 0)) for item in data)
+        _update_token_stats({"usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}})
+        rows.extend(item["embedding"] for item in sorted(data, key=lambda item: item.get("index", 0)))
+    if not rows:
+        return np.zeros((0, 0), dtype=np.float32)
+    vectors = np.asarray(rows, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class VectorIndex:
+    """Индекс на диске: векторы (memmap) и метаданные фрагментов. Пустой, если каталога ещё нет."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path)
+        self.model: str | None = None
+        self.chunks: List[IndexedChunk] = []
+        self.vectors: np.ndarray | None = None
+        index_path = self.path / INDEX_FILE
+        if not index_path.exists():
+            return
+        info = json.loads(index_path.read_text(encoding="utf-8"))
+        self.model = info.get("model")
+        with open(self.path / CHUNKS_FILE, encoding="utf-8") as f:
+            self.chunks = [IndexedChunk(**json.loads(line)) for line in f if line.strip()]
+        if self.chunks:
+            self.vectors = np.load(self.path / VECTORS_FILE, mmap_mode="r")
+            if self.vectors.shape[0] != len(self.chunks):
+                raise RuntimeError(
+                    f"Индекс {self.path} повреждён: векторов {self.vectors.shape[0]}, фрагментов {len(self.chunks)}"
+                )
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def vectors_by_hash(self, model: str) -> Dict[str, np.ndarray]:
+        """Векторы фрагментов по хэшу текста (пусто, если индекс построен другой моделью)."""
+        if self.vectors is None or self.model != model:
+            return {}
+        # Копия в памяти: файл индекса будет перезаписан
+        vectors = np.array(self.vectors)
+        return {chunk.hash: vectors[row] for row, chunk in enumerate(self.chunks)}
+
+    def search(self, query_vector: np.ndarray, top_k: int = 5, pdf: str | None = None) -> List[SearchHit]:
+        """Top-k фрагментов по косинусной близости к нормированному вектору запроса."""
+        if self.vectors is None:
+            return []
+        scores = np.asarray(self.vectors @ query_vector, dtype=np.float32)
+        if pdf is not None:
+            mask = np.array([chunk.pdf == pdf for chunk in self.chunks])
+            scores = np.where(mask, scores, -np.inf)
+        top_k = min(top_k, int(np.isfinite(scores).sum()))
+        if top_k <= 0:
+            return []
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [SearchHit(float(scores[row]), self.chunks[row]) for row in best]
+
+
+def _write_index(path: Path, model: str, chunks: List[IndexedChunk], vectors: np.ndarray) -> None:
+    """Файлы индекса пишутся во временные и заменяются разом, как манифест пайплайна."""
+    path.mkdir(parents=True, exist_ok=True)
+    tmp_vectors = path / (VECTORS_FILE + ".tmp")
+    with open(tmp_vectors, "wb") as f:
+        np.save(f, vectors.astype(np.float32, copy=False))
+    tmp_chunks = path / (CHUNKS_FILE + ".tmp")
+    with open(tmp_chunks, "w", encoding="utf-8") as f:
+        for chunk in chunks:
+            f.write(json.dumps(chunk._asdict(), ensure_ascii=False) + "\n")
+    tmp_info = path / (INDEX_FILE + ".tmp")
+    info = {"model": model, "dim": int(vectors.shape[1]) if vectors.ndim == 2 else 0, "chunks": len(chunks)}
+    tmp_info.write_text(json.dumps(info, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp_vectors, path / VECTORS_FILE)
+    os.replace(tmp_chunks, path / CHUNKS_FILE)
+    os.replace(tmp_info, path / INDEX_FILE)
+
+
+def update_index(
+    out_root: Path,
+    index_dir: Path,
+    access_token: AccessToken,
+    model: str = GIGA_EMBEDDINGS_MODEL,
+    batch_size: int = GIGA_EMBEDDINGS_BATCH,
+) -> Dict[str, int]:
+    """
+    Перестроить индекс по текущим итоговым файлам out_root.
+    Эмбеддинги запрашиваются только для фрагментов, которых нет в прежнем индексе
+    (по хэшу текста); удалённые фрагменты из индекса уходят.
+    Возвращает {"chunks": всего, "embedded": посчитано заново, "reused": взято из индекса}.
+    """
+    chunks = collect_chunks(out_root)
+    known = VectorIndex(index_dir).vectors_by_hash(model)
+    # Хэши прежнего индекса: повтор текста внутри текущего прогона «взятым из индекса» не считается
+    previous = set(known)
+    missing = list(dict.fromkeys(chunk.hash for chunk in chunks if chunk.hash not in known))
+    text_by_hash = {chunk.hash: chunk.text for chunk in chunks}
+    if missing:
+        fresh = embed_texts([text_by_hash[h] for h in missing], access_token, model, batch_size)
+        known.update(zip(missing, fresh))
+    vectors = np.stack([known[chunk.hash] for chunk in chunks]) if chunks else np.zeros((0, 0), dtype=np.float32)
+    _write_index(Path(index_dir), model, chunks, vectors)
+    reused = sum(chunk.hash in previous for chunk in chunks)
+    return {"chunks": len(chunks), "embedded": len(missing), "reused": reused}
+
+
+def search_index(
+    index_dir: Path,
+    query: str,
+    access_token: AccessToken,
+    top_k: int = 5,
+    pdf: str | None = None,
+) -> List[SearchHit]:
+    """Найти top_k фрагментов, ближайших к запросу query."""
+    index = VectorIndex(index_dir)
+    if not len(index):
+        return []
+    query_vector = embed_texts([query], access_token, index.model or GIGA_EMBEDDINGS_MODEL)[0]
+    return index.search(query_vector, top_k, pdf)
+
+
+def _format_hit(rank: int, hit: SearchHit) -> Iterator[str]:
+    page = f"стр. {hit.chunk.page:03d}" if hit.chunk.page is not None else "без страницы"
+    yield f"{rank}. [{hit.score:.3f}] {hit.chunk.pdf} — {page} ({hit.chunk.source})"
+    for line in hit.chunk.text.splitlines():
+        yield f"   {line}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=(
+            "Локальный векторный индекс по итоговым инструкциям пайплайна: обновление "
+            "(эмбеддинги GigaChat только для изменённых фрагментов) и поиск top-k."
+        )
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=str,
+        default="out",
+        help="Каталог результатов пайплайна (out/<pdf>/instructions_*.md). По умолчанию out.",
+    )
+    parser.add_argument(
+        "--index-dir",
+        type=str,
+        default=None,
+        help="Каталог индекса. По умолчанию <out-dir>/vector_index.",
+    )
+    parser.add_argument(
+        "--query",
+        type=str,
+        default=None,
+        help="Поисковый запрос. Без него индекс обновляется по текущим файлам <out-dir>.",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=5,
+        help="Сколько фрагментов выводить при поиске. По умолчанию 5.",
+    )
+    parser.add_argument(
+        "--pdf",
+        type=str,
+        default=None,
+        help="Искать только во фрагментах одного PDF (имя каталога в <out-dir>).",
+    )
+    args = parser.parse_args()
+
+    from img_parse import TokenManager
+
+    out_root = Path(args.out_dir)
+    index_dir = Path(args.index_dir) if args.index_dir else out_root / "vector_index"
+    access_token = TokenManager()
+
+    if args.query is None:
+        stats = update_index(out_root, index_dir, access_token)
+        print(
+            f"Векторный индекс ({index_dir}): фрагментов {stats['chunks']}, "
+            f"эмбеддингов посчитано {stats['embedded']}, взято из индекса {stats['reused']}"
+        )
+        return
+
+    hits = search_index(index_dir, args.query, access_token, args.top_k, args.pdf)
+    if not hits:
+        print(f"Ничего не найдено (индекс {index_dir} пуст или не построен).")
+        return
+    for rank, hit in enumerate(hits, 1):
+        print("\n".join(_format_hit(rank, hit)))
+
+
+if __name__ == "__main__":
+    main()